@@ -0,0 +1,324 @@
+"""
+In-process BM25 index built on NumPy sparse term-document matrices.
+
+This is a drop-in alternative to building a Lucene index with pyserini: documents are
+tokenized in Python, stored as a CSR term-document matrix and scored with Lucene's BM25
+formula, so no JVM or subprocess is involved. Indexes can be saved as a single `.npz`
+file next to where pyserini would write its index directory.
+"""
+
+import os
+import re
+import math
+import shutil
+import numpy as np
+from array import array
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+
+TOKEN_PATTERN = re.compile(r"\w+")
+DOTTED_PATH_PATTERN = re.compile(r"\w+(?:\.\w+)+")
+IDENTIFIER_PART_PATTERN = re.compile(r"[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|\d+")
+MAX_TOKEN_LENGTH = 255  # same as Lucene's StandardAnalyzer
+MAX_QUERY_TERMS = 512  # well below Lucene's default maxClauseCount of 1024
+
+# Lucene's EnglishAnalyzer.ENGLISH_STOP_WORDS_SET, as used by pyserini's default analyzer
+STOP_WORDS = frozenset(
+    [
+        "a", "an", "and", "are", "as", "at", "be", "but", "by", "for", "if", "in",
+        "into", "is", "it", "no", "not", "of", "on", "or", "such", "that", "the",
+        "their", "then", "there", "these", "they", "this", "to", "was", "will", "with",
+    ]
+)
+
+BM25Hit = namedtuple("BM25Hit", ["docid", "score"])
+
+
+def tokenize(text):
+    """
+    Splits text into lowercased word tokens, dropping stop words and overly long tokens.
+
+    Args:
+        text (str): The text to tokenize.
+
+    Returns:
+        list: The tokens in the order they appear in the text.
+    """
+    return [
+        token
+        for token in TOKEN_PATTERN.findall(text.lower())
+        if token not in STOP_WORDS and len(token) <= MAX_TOKEN_LENGTH
+    ]
+
+
+def split_identifier(token):
+    """
+    Splits a code identifier into its lowercased parts, e.g. `parseHTTPResponse_v2` into
+    `parse`, `http`, `response`, `v` and `2`. Returns no parts for a plain word.
+    """
+    parts = [
+        part.lower()
+        for chunk in token.split("_")
+        for part in IDENTIFIER_PART_PATTERN.findall(chunk)
+    ]
+    return parts if len(parts) > 1 else list()
+
+
+def compile_query(text, max_terms=MAX_QUERY_TERMS, part_weight=0.5, dotted_paths=False):
+    """
+    Turns free text, such as a problem statement, into a bounded set of weighted query terms.
+
+    The text is tokenized once. Every token counts as a term, the parts of camelCase and
+    snake_case identifiers count `part_weight` each, and with `dotted_paths` dotted paths such
+    as `os.path.join` are kept whole too. Terms are weighted by 1 + log(count), so a term
+    repeated throughout a stack trace does not drown out the rest, and only the `max_terms`
+    heaviest are kept, ties broken by first appearance.
+
+    Args:
+        text (str): The query text.
+        max_terms (int, optional): The maximum number of terms. Defaults to MAX_QUERY_TERMS.
+        part_weight (float, optional): The count of an identifier part relative to a whole token.
+        dotted_paths (bool, optional): Whether to add whole dotted paths as terms. Only Lucene's
+            tokenizer indexes them; `tokenize` splits them into words. Defaults to False.
+
+    Returns:
+        dict: Maps each query term to its weight, heaviest first.
+    """
+    counts = Counter()
+    if dotted_paths:
+        for path in DOTTED_PATH_PATTERN.findall(text):
+            counts[path.lower()] += 1
+    for token in TOKEN_PATTERN.findall(text):
+        counts[token.lower()] += 1
+        for part in split_identifier(token):
+            counts[part] += part_weight
+    terms = [
+        (term, 1 + math.log(count) if count >= 1 else count)
+        for term, count in counts.items()
+        if term not in STOP_WORDS and len(term) <= MAX_TOKEN_LENGTH
+    ]
+    order = sorted(range(len(terms)), key=lambda i: -terms[i][1])[:max_terms]
+    return dict(terms[i] for i in order)
+
+
+class BM25Index:
+    """
+    A BM25 index over a fixed set of documents.
+
+    Term frequencies are stored as a CSR matrix with one row per term, so scoring a query
+    only touches the postings of the query terms. Raw term frequencies and document lengths
+    are kept, which means k1 and b can be changed at query time without rebuilding.
+
+    Args:
+        docids (list): The document IDs, in index order.
+        vocab (list): The terms, in row order.
+        indptr (np.ndarray): Row pointers of the term-document matrix.
+        doc_indices (np.ndarray): Column (document) indices of the term-document matrix.
+        term_freqs (np.ndarray): Term frequencies of the term-document matrix.
+        doc_lengths (np.ndarray): Number of tokens in each document.
+        k1 (float, optional): BM25 k1 parameter. Defaults to pyserini's 0.9.
+        b (float, optional): BM25 b parameter. Defaults to pyserini's 0.4.
+    """
+
+    INDEX_FILE = "bm25.npz"
+
+    def __init__(
+        self, docids, vocab, indptr, doc_indices, term_freqs, doc_lengths, k1=0.9, b=0.4
+    ):
+        self.docids = list(docids)
+        self.vocab = list(vocab)
+        self.indptr = indptr
+        self.doc_indices = doc_indices
+        self.term_freqs = term_freqs
+        self.doc_lengths = doc_lengths
+        self.k1 = k1
+        self.b = b
+        self.term_to_id = {term: i for i, term in enumerate(self.vocab)}
+        self.avgdl = float(doc_lengths.mean()) if len(doc_lengths) else 0.0
+
+    @classmethod
+    def from_term_counts(cls, docids, term_counts, **kwargs):
+        """
+        Builds an index from precomputed term counts.
+
+        Args:
+            docids (list): The document IDs. Read after `term_counts` is exhausted, so it can be
+                a list filled in while `term_counts` is generated.
+            term_counts (iterable): One mapping of term to frequency per document.
+
+        Returns:
+            BM25Index: The built index.
+        """
+        term_to_id = dict()
+        # compact typed arrays instead of lists of Python ints, since they hold every posting
+        rows, cols, data = array("q"), array("i"), array("f")
+        doc_lengths = array("f")
+        for doc_idx, counts in enumerate(term_counts):
+            for term, tf in counts.items():
+                rows.append(term_to_id.setdefault(term, len(term_to_id)))
+                cols.append(doc_idx)
+                data.append(tf)
+            doc_lengths.append(sum(counts.values()))
+        docids = list(docids)
+        rows = np.asarray(rows, dtype=np.int64)
+        order = np.argsort(rows, kind="stable")
+        indptr = np.zeros(len(term_to_id) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=len(term_to_id)), out=indptr[1:])
+        return cls(
+            docids,
+            list(term_to_id),
+            indptr,
+            np.asarray(cols, dtype=np.int32)[order],
+            np.asarray(data, dtype=np.float32)[order],
+            np.asarray(doc_lengths, dtype=np.float32),
+            **kwargs,
+        )
+
+    @classmethod
+    def from_documents(cls, documents, **kwargs):
+        """
+        Builds an index from raw document text.
+
+        Args:
+            documents (dict or iterable): A dictionary mapping document IDs to document text,
+                or (docid, text) pairs. Pairs are tokenized as they are generated, so only
+                one document's text is held at a time.
+
+        Returns:
+            BM25Index: The built index.
+        """
+        if isinstance(documents, dict):
+            documents = documents.items()
+        docids = list()
+
+        def iter_term_counts():
+            for docid, text in documents:
+                docids.append(docid)
+                yield Counter(tokenize(text))
+
+        return cls.from_term_counts(docids, iter_term_counts(), **kwargs)
+
+    @classmethod
+    def exists(cls, index_path):
+        return Path(index_path, cls.INDEX_FILE).exists()
+
+    def save(self, index_path):
+        """
+        Saves the index to `index_path/bm25.npz`. The directory is written under a temporary
+        name and renamed into place, so a partially written index is never picked up.
+        """
+        index_path = Path(index_path)
+        tmp_path = index_path.with_name(index_path.name + f".tmp{os.getpid()}")
+        tmp_path.mkdir(parents=True, exist_ok=True)
+        np.savez(
+            Path(tmp_path, self.INDEX_FILE),
+            docids=np.array(self.docids, dtype=str),
+            vocab=np.array(self.vocab, dtype=str),
+            indptr=self.indptr,
+            doc_indices=self.doc_indices,
+            term_freqs=self.term_freqs,
+            doc_lengths=self.doc_lengths,
+            params=np.array([self.k1, self.b], dtype=np.float64),
+        )
+        if index_path.exists():
+            shutil.rmtree(index_path)
+        os.replace(tmp_path, index_path)
+        return index_path
+
+    @classmethod
+    def load(cls, index_path):
+        with np.load(Path(index_path, cls.INDEX_FILE)) as data:
+            k1, b = data["params"].tolist()
+            return cls(
+                data["docids"].tolist(),
+                data["vocab"].tolist(),
+                data["indptr"],
+                data["doc_indices"],
+                data["term_freqs"],
+                data["doc_lengths"],
+                k1=k1,
+                b=b,
+            )
+
+    def get_scores(self, query, k1=None, b=None):
+        """
+        Scores every document in the index against the query.
+
+        Args:
+            query (str or dict): The query text, or a mapping of term to weight as returned by
+                `compile_query`.
+            k1 (float, optional): Overrides the index's k1 parameter.
+            b (float, optional): Overrides the index's b parameter.
+
+        Returns:
+            np.ndarray: The BM25 score of each document, in index order.
+        """
+        k1 = self.k1 if k1 is None else k1
+        b = self.b if b is None else b
+        num_docs = len(self.docids)
+        scores = np.zeros(num_docs, dtype=np.float32)
+        if num_docs == 0 or self.avgdl == 0:
+            # every document is empty, so no term can match
+            return scores
+        norms = k1 * (1 - b + b * self.doc_lengths / self.avgdl)
+        if isinstance(query, str):
+            query = Counter(tokenize(query))
+        for term, weight in query.items():
+            term_id = self.term_to_id.get(term)
+            if term_id is None:
+                continue
+            start, end = self.indptr[term_id], self.indptr[term_id + 1]
+            docs = self.doc_indices[start:end]
+            tfs = self.term_freqs[start:end]
+            df = end - start
+            idf = np.log(1 + (num_docs - df + 0.5) / (df + 0.5))
+            scores[docs] += weight * idf * tfs / (tfs + norms[docs])
+        return scores
+
+    def search(self, query, k=10, remove_dups=False, k1=None, b=None):
+        """
+        Searches the index, mirroring `LuceneSearcher.search`.
+
+        Args:
+            query (str or dict): The query text or weighted terms, see `get_scores`.
+            k (int, optional): The number of hits to return. Defaults to 10.
+            remove_dups (bool, optional): Accepted for compatibility; document IDs are unique.
+            k1 (float, optional): Overrides the index's k1 parameter.
+            b (float, optional): Overrides the index's b parameter.
+
+        Returns:
+            list: `BM25Hit`s sorted by descending score.
+        """
+        scores = self.get_scores(query, k1=k1, b=b)
+        candidates = np.flatnonzero(scores > 0)
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+        candidates = candidates[np.lexsort((candidates, -scores[candidates]))]
+        return [BM25Hit(self.docids[i], float(scores[i])) for i in candidates]
+
+    def batch_search(self, queries, qids, k=10, threads=1, k1=None, b=None):
+        """
+        Searches many queries at once, mirroring `LuceneSearcher.batch_search`.
+
+        Args:
+            queries (list): The query texts or weighted terms, see `get_scores`.
+            qids (list): The query IDs, one per query.
+            k (int, optional): The number of hits to return per query. Defaults to 10.
+            threads (int, optional): The number of threads to search with. Defaults to 1.
+
+        Returns:
+            dict: Maps each query ID to its list of `BM25Hit`s.
+        """
+
+        def search_one(query):
+            return self.search(query, k=k, k1=k1, b=b)
+
+        if threads <= 1:
+            return {qid: search_one(query) for qid, query in zip(qids, queries)}
+        with ThreadPoolExecutor(threads) as executor:
+            return dict(zip(qids, executor.map(search_one, queries)))
+
+    def close(self):
+        pass
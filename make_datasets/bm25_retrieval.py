@@ -1,25 +1,62 @@
 import json
 import os
 import ast
+import itertools
 import jedi
 import shutil
+import threading
 import traceback
+import tempfile
 import subprocess
+from contextlib import nullcontext
 from filelock import FileLock
 from typing import Any
 from datasets import load_from_disk, load_dataset
-from pyserini.search.lucene import LuceneSearcher
 from git import Repo
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
+from multiprocessing import Manager
+from queue import Empty
 from pathlib import Path
 from tqdm.auto import tqdm
 from argparse import ArgumentParser
 
 try:
-    from utils import list_files
-    from utils import string_to_bool
+    from utils import list_files, list_blobs, is_test, get_git_object_reader, get_file_manifest
+    from utils import string_to_bool, git_clone
+    from bm25_engine import BM25Index, tokenize, compile_query, MAX_QUERY_TERMS
+    from document_cache import DocumentCache
+    from mirror_cache import MirrorCache
+    from disk_budget import DiskBudget
+    from document_encoder import DocumentEncoder
+    from worktree_pool import WorktreePool
+    from pipeline import Stage, run_pipeline
+    from result_sink import ResultSink, load_completed_ids, merge_segments
+    from chunking import ChunkEncoder, CHUNK_AGGREGATIONS, CHUNK_OVERSAMPLING
+    from chunking import expand_document, aggregate_hits
+    from static_docs import extract_docs, get_module_name
+    from file_ingestion import read_file
 except:
-    from .utils import list_files
-    from .utils import string_to_bool
+    from .utils import list_files, list_blobs, is_test, get_git_object_reader, get_file_manifest
+    from .utils import string_to_bool, git_clone
+    from .bm25_engine import BM25Index, tokenize, compile_query, MAX_QUERY_TERMS
+    from .document_cache import DocumentCache
+    from .mirror_cache import MirrorCache
+    from .disk_budget import DiskBudget
+    from .document_encoder import DocumentEncoder
+    from .worktree_pool import WorktreePool
+    from .pipeline import Stage, run_pipeline
+    from .result_sink import ResultSink, load_completed_ids, merge_segments
+    from .chunking import ChunkEncoder, CHUNK_AGGREGATIONS, CHUNK_OVERSAMPLING
+    from .chunking import expand_document, aggregate_hits
+    from .static_docs import extract_docs, get_module_name
+    from .file_ingestion import read_file
+
+try:
+    from pyserini.search.lucene import LuceneSearcher, querybuilder
+except ImportError:
+    LuceneSearcher = None
 
 import logging
 
@@ -35,9 +72,11 @@ class ContextManager:
         repo_path (str): The path to the Git repository.
         base_commit (str): The commit hash to switch to.
         verbose (bool, optional): Whether to print verbose output. Defaults to False.
+        worktree_pool (WorktreePool, optional): If given, the commit is checked out in a leased worktree
+            instead of the repository itself. Defaults to None.
 
     Attributes:
-        repo_path (str): The path to the Git repository.
+        repo_path (str): The path to the checkout; the leased worktree while inside the context.
         base_commit (str): The commit hash to switch to.
         verbose (bool): Whether to print verbose output.
         repo (git.Repo): The Git repository object.
@@ -45,18 +84,23 @@ class ContextManager:
     Methods:
         __enter__(): Switches to the specified commit and returns the context manager object.
         get_readme_files(): Returns a list of filenames for all README files in the repository.
-        __exit__(exc_type, exc_val, exc_tb): Does nothing.
+        __exit__(exc_type, exc_val, exc_tb): Releases the leased worktree, if any.
     """
 
-    def __init__(self, repo_path, base_commit, verbose=False):
+    def __init__(self, repo_path, base_commit, verbose=False, worktree_pool=None):
         self.repo_path = Path(repo_path).resolve().as_posix()
+        self.clone_path = self.repo_path
         self.base_commit = base_commit
         self.verbose = verbose
+        self.worktree_pool = worktree_pool
         self.repo = Repo(self.repo_path)
 
     def __enter__(self):
         if self.verbose:
             print(f"Switching to {self.base_commit}")
+        if self.worktree_pool is not None:
+            self.repo_path = self.worktree_pool.acquire(self.base_commit).as_posix()
+            return self
         try:
             self.repo.git.reset("--hard", self.base_commit)
             self.repo.git.clean("-fdxq")
@@ -67,27 +111,34 @@ class ContextManager:
         return self
 
     def get_readme_files(self):
-        files = os.listdir(self.repo_path)
-        files = list(filter(lambda x: os.path.isfile(x), files))
-        files = list(filter(lambda x: x.lower().startswith("readme"), files))
-        return files
+        return get_file_manifest(self.repo_path).get_readme_files(self.base_commit)
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        pass
+        if self.repo_path != self.clone_path:
+            self.worktree_pool.release(self.repo_path)
+            self.repo_path = self.clone_path
+
+
+def read_source(filename, source=None):
+    """
+    Returns `source` if the file contents were already read (e.g. from the git object database),
+    otherwise reads the file from disk.
+    """
+    if source is not None:
+        return source
+    return read_file(filename)[0]
 
 
-def file_name_and_contents(filename, relative_path):
+def file_name_and_contents(filename, relative_path, source=None):
     text = relative_path + "\n"
-    with open(filename) as f:
-        text += f.read()
+    text += read_source(filename, source)
     return text
 
 
-def file_name_and_documentation(filename, relative_path):
+def file_name_and_documentation(filename, relative_path, source=None):
     text = relative_path + "\n"
     try:
-        with open(filename) as f:
-            node = ast.parse(f.read())
+        node = ast.parse(read_source(filename, source))
         data = ast.get_docstring(node)
         if data:
             text += f"{data}"
@@ -101,15 +152,13 @@ def file_name_and_documentation(filename, relative_path):
     except Exception as e:
         logger.error(e)
         logger.error(f"Failed to parse file {str(filename)}. Using simple filecontent.")
-        with open(filename) as f:
-            text += f.read()
+        text += read_source(filename, source)
     return text
 
 
-def file_name_and_docs_jedi(filename, relative_path):
+def file_name_and_docs_jedi(filename, relative_path, source=None):
     text = relative_path + "\n"
-    with open(filename) as f:
-        source_code = f.read()
+    source_code = read_source(filename, source)
     try:
         script = jedi.Script(source_code, path=filename)
         module = script.get_context()
@@ -138,7 +187,7 @@ def file_name_and_docs_jedi(filename, relative_path):
                 docstring = name.docstring()
                 if docstring:
                     text += f"{docstring}\n\n"
-            except:
+            except Exception:
                 continue
     except Exception as e:
         logger.error(e)
@@ -148,14 +197,66 @@ def file_name_and_docs_jedi(filename, relative_path):
     return text
 
 
+def file_name_and_docs_ast(filename, relative_path, source=None):
+    """
+    Produces the same text as `file_name_and_docs_jedi` from a single walk of the syntax tree,
+    without resolving any names. See static_docs.py.
+    """
+    text = relative_path + "\n"
+    source_code = read_source(filename, source)
+    try:
+        text += extract_docs(source_code, get_module_name(filename))
+    except Exception as e:
+        logger.error(e)
+        logger.error(f"Failed to parse file {str(filename)}. Using simple filecontent.")
+        text = f"{relative_path}\n{source_code}"
+    return text
+
+
 DOCUMENT_ENCODING_FUNCTIONS = {
     "file_name_and_contents": file_name_and_contents,
     "file_name_and_documentation": file_name_and_documentation,
     "file_name_and_docs_jedi": file_name_and_docs_jedi,
+    "file_name_and_docs_ast": file_name_and_docs_ast,
 }
+# encoders that look at the checkout around the file, to name its module and, for jedi, to
+# follow its imports, so their output depends on the commit being checked out
+CHECKOUT_ENCODING_FUNCTIONS = {file_name_and_docs_jedi, file_name_and_docs_ast}
 
 
-def clone_repo(repo, root_dir, token):
+def needs_checkout(document_encoding_func):
+    """
+    Returns whether an encoding function, or the function a ChunkEncoder wraps, reads the
+    checkout around each file and so cannot encode files read from the git object database.
+    """
+    document_encoding_func = getattr(
+        document_encoding_func, "document_encoding_func", document_encoding_func
+    )
+    return document_encoding_func in CHECKOUT_ENCODING_FUNCTIONS
+
+
+def get_document_reader(repo_dir, document_encoding_func, checkout_free):
+    """
+    Returns the GitObjectReader to read the documents of `repo_dir` with, or None if they are
+    read from a checkout: without `checkout_free`, or for encoders that need the checkout.
+    Either way the same file gets the same text, so cached documents are shared by both modes.
+    """
+    if not checkout_free or needs_checkout(document_encoding_func):
+        return None
+    return get_git_object_reader(repo_dir)
+
+RETRIEVAL_BACKENDS = ["pyserini", "numpy"]
+# ephemeral pyserini indexes are built on tmpfs when it is available
+EPHEMERAL_DIR = "/dev/shm"
+# documents.jsonl is written through a buffer of this many bytes instead of flushing every line
+DOCUMENTS_BUFFER_SIZE = 1 << 20
+
+
+def get_repo_dir(repo, root_dir):
+    return Path(root_dir, f"repo__{repo.replace('/', '__')}")
+
+
+def clone_repo(repo, root_dir, token, sparse=False, mirror_dir=None):
     """
     Clones a GitHub repository to a specified directory.
 
@@ -163,39 +264,359 @@ def clone_repo(repo, root_dir, token):
         repo (str): The GitHub repository to clone.
         root_dir (str): The root directory to clone the repository to.
         token (str): The GitHub personal access token to use for authentication.
+        sparse (bool, optional): Whether to make a partial clone that only fetches the Python
+            files and READMEs of the commits that are read, see `utils.git_clone`.
+        mirror_dir (str, optional): If given, the clone borrows its objects from a mirror
+            kept in this directory, see `MirrorCache`.
 
     Returns:
         Path: The path to the cloned repository directory.
     """
-    repo_dir = Path(root_dir, f"repo__{repo.replace('/', '__')}")
+    repo_dir = get_repo_dir(repo, root_dir)
 
     if not repo_dir.exists():
-        repo_url = f"https://{token}@github.com/{repo}.git"
-        logger.info(f"Cloning {repo} {os.getpid()}")
-        Repo.clone_from(repo_url, repo_dir)
+        # several pipeline stages or processes may ask for the same repo at once
+        with FileLock(Path(root_dir, f".clone__{repo_dir.name}.lock").as_posix()):
+            if not repo_dir.exists():
+                repo_url = f"https://{token}@github.com/{repo}.git"
+                logger.info(f"Cloning {repo} {os.getpid()}")
+                mirror = None
+                if mirror_dir is not None:
+                    mirror = MirrorCache(mirror_dir).get(repo, repo_url)
+                git_clone(repo_url, repo_dir, sparse=sparse, mirror=mirror)
     return repo_dir
 
 
-def build_documents(repo_dir, commit, document_encoding_func):
+def iter_encoded_files(document_encoding_func, files, cache=None, encoder=None):
+    """
+    Encodes files one at a time, taking documents encoded before from the cache.
+
+    Args:
+        document_encoding_func (function): A function that takes a filename and a relative path and returns the encoded document text.
+        files (iterable): (filename, relative_path, blob_sha, source) tuples, where source is the file contents if
+            already read, or None to read the file from disk. It is consumed lazily, so a generator that reads
+            each source on demand keeps a single file in memory.
+        cache (DocumentCache, optional): If given, files whose blob was already encoded are read from the cache.
+        encoder (DocumentEncoder, optional): If given, cache misses are encoded by it, in parallel and with a time
+            budget per file, `encoder.batch_size` files at a time. Files that fall back to a cheaper encoding are
+            not cached.
+
+    Yields:
+        str: The encoded text of each file, in order.
+    """
+    if encoder is None:
+        for filename, relative_path, blob_sha, source in files:
+            if cache is None:
+                yield document_encoding_func(filename, relative_path, source=source)
+            else:
+                yield cache.encode(
+                    document_encoding_func, filename, relative_path, blob_sha, source=source
+                )
+        return
+    files = iter(files)
+    while True:
+        batch = list(itertools.islice(files, encoder.batch_size))
+        if not batch:
+            return
+        texts = [None] * len(batch)
+        pending = list()
+        for i, (_, relative_path, blob_sha, _) in enumerate(batch):
+            if cache is not None:
+                texts[i] = cache.lookup(document_encoding_func, relative_path, blob_sha)
+            if texts[i] is None:
+                pending.append(i)
+        encoded = encoder.encode(
+            [(batch[i][0], batch[i][1], batch[i][3]) for i in pending]
+        )
+        for i, (text, fell_back) in zip(pending, encoded):
+            texts[i] = text
+            if cache is not None and not fell_back:
+                cache.store(document_encoding_func, batch[i][1], batch[i][2], text)
+        yield from texts
+
+
+def encode_files(document_encoding_func, files, cache=None, encoder=None):
+    """
+    Same as `iter_encoded_files`, but returns a list.
     """
-    Builds a dictionary of documents from a given repository directory and commit.
+    return list(
+        iter_encoded_files(document_encoding_func, files, cache=cache, encoder=encoder)
+    )
+
+
+def iter_documents(
+    repo_dir,
+    commit,
+    document_encoding_func,
+    cache=None,
+    reader=None,
+    worktree_pool=None,
+    encoder=None,
+):
+    """
+    Encodes the documents of a given repository directory and commit one at a time. The commit
+    stays checked out (or the worktree leased) until the generator is exhausted or closed.
 
     Args:
         repo_dir (str): The path to the repository directory.
         commit (str): The commit hash to use.
         document_encoding_func (function): A function that takes a filename and a relative path and returns the encoded document text.
+        cache (DocumentCache, optional): If given, files whose blob was already encoded are read from the cache.
+        reader (GitObjectReader, optional): If given, files are read from the git object database instead of
+            checking out `commit`.
+        worktree_pool (WorktreePool, optional): If given, `commit` is checked out in a leased worktree.
+        encoder (DocumentEncoder, optional): If given, files are encoded by it, see `iter_encoded_files`.
+
+    Yields:
+        tuple: (relative_path, text) for each document.
+    """
+    if reader is None:
+        context = ContextManager(repo_dir, commit, worktree_pool=worktree_pool)
+    else:
+        context = nullcontext()
+    with context as cm:
+        if reader is not None:
+            filenames = reader.list_files(commit, include_tests=False)
+            blob_shas = reader.list_blobs(commit)
+        else:
+            repo_dir = cm.repo_path
+            filenames = list_files(repo_dir, include_tests=False, commit=commit)
+            blob_shas = list_blobs(repo_dir, commit)
+        # sources are read as the encoder asks for them, not all up front
+        files = (
+            (
+                os.path.join(repo_dir, relative_path),
+                relative_path,
+                blob_shas.get(relative_path),
+                reader.read_text(blob_shas[relative_path]) if reader is not None else None,
+            )
+            for relative_path in filenames
+        )
+        texts = iter_encoded_files(document_encoding_func, files, cache=cache, encoder=encoder)
+        yield from zip(filenames, texts)
+    if cache is not None:
+        cache.flush()
+
+
+def build_documents(
+    repo_dir,
+    commit,
+    document_encoding_func,
+    cache=None,
+    reader=None,
+    worktree_pool=None,
+    encoder=None,
+):
+    """
+    Builds a dictionary of documents from a given repository directory and commit. See
+    `iter_documents` for the arguments.
 
     Returns:
         dict: A dictionary where the keys are the relative paths of the documents and the values are the encoded document text.
     """
-    documents = dict()
-    with ContextManager(repo_dir, commit):
-        filenames = list_files(repo_dir, include_tests=False)
-        for relative_path in filenames:
-            filename = os.path.join(repo_dir, relative_path)
-            text = document_encoding_func(filename, relative_path)
-            documents[relative_path] = text
-    return documents
+    return dict(
+        iter_documents(
+            repo_dir,
+            commit,
+            document_encoding_func,
+            cache=cache,
+            reader=reader,
+            worktree_pool=worktree_pool,
+            encoder=encoder,
+        )
+    )
+
+
+class IncrementalDocuments:
+    """
+    The encoded documents of one repository, kept in sync with a commit by applying diffs.
+
+    The first update encodes every file like `build_documents`. Later updates only run
+    `git diff --name-status` against the previous commit and re-encode the files that were
+    added or modified, so moving between nearby commits costs time proportional to the diff.
+
+    Args:
+        repo_dir (str): The path to the repository directory.
+        document_encoding_func (function): The function to use for encoding documents.
+        cache (DocumentCache, optional): If given, used to skip encoding blobs that were encoded before.
+        reader (GitObjectReader, optional): If given, files are read from the git object database instead of a checkout.
+        worktree_pool (WorktreePool, optional): If given, commits are checked out in leased worktrees.
+        encoder (DocumentEncoder, optional): If given, files are encoded by it, see `encode_files`.
+
+    Attributes:
+        commit (str): The commit the documents currently reflect, or None before the first update.
+        documents (dict): Maps relative paths to encoded document text.
+    """
+
+    def __init__(
+        self,
+        repo_dir,
+        document_encoding_func,
+        cache=None,
+        reader=None,
+        worktree_pool=None,
+        encoder=None,
+    ):
+        self.repo_dir = repo_dir
+        self.checkout_dir = repo_dir
+        self.document_encoding_func = document_encoding_func
+        self.cache = cache
+        self.reader = reader
+        self.worktree_pool = worktree_pool
+        self.encoder = encoder
+        self.blob_shas = dict()
+        self.commit = None
+        self.documents = dict()
+        self.term_counts = dict()
+
+    def get_changed_files(self, commit):
+        """
+        Returns the paths that were added or modified and the paths that were deleted between
+        the current commit and `commit`.
+        """
+        diff = Repo(self.repo_dir).git.diff(
+            "--name-status", "--no-renames", self.commit, commit
+        )
+        changed, deleted = list(), list()
+        for line in diff.splitlines():
+            status, relative_path = line.split("\t", 1)
+            if status.startswith("D"):
+                deleted.append(relative_path)
+            else:
+                changed.append(relative_path)
+        return changed, deleted
+
+    def encode(self, relative_paths):
+        files = list()
+        for relative_path in relative_paths:
+            filename = os.path.join(self.checkout_dir, relative_path)
+            source = None
+            if self.reader is not None:
+                source = self.reader.read_text(self.blob_shas[relative_path])
+            files.append((filename, relative_path, self.blob_shas.get(relative_path), source))
+        texts = encode_files(
+            self.document_encoding_func, files, cache=self.cache, encoder=self.encoder
+        )
+        for relative_path, text in zip(relative_paths, texts):
+            self.documents[relative_path] = text
+            self.term_counts.pop(relative_path, None)
+
+    def remove(self, relative_path):
+        self.documents.pop(relative_path, None)
+        self.term_counts.pop(relative_path, None)
+
+    def update(self, commit):
+        """
+        Brings the documents up to date with `commit`.
+
+        Args:
+            commit (str): The commit hash to use.
+
+        Returns:
+            dict: A dictionary where the keys are the relative paths of the documents and the values are the encoded document text.
+        """
+        if commit == self.commit:
+            return self.documents
+        changed, deleted = None, list()
+        if self.commit is not None:
+            try:
+                changed, deleted = self.get_changed_files(commit)
+            except Exception as e:
+                logger.warning(
+                    f"Failed to diff {self.commit}..{commit}, rebuilding documents: {e}"
+                )
+        if self.reader is None:
+            context = ContextManager(
+                self.repo_dir, commit, worktree_pool=self.worktree_pool
+            )
+        else:
+            context = nullcontext()
+        with context as cm:
+            self.checkout_dir = self.repo_dir if cm is None else cm.repo_path
+            if self.reader is not None:
+                self.blob_shas = self.reader.list_blobs(commit)
+            else:
+                self.blob_shas = list_blobs(self.checkout_dir, commit)
+            if changed is None:
+                self.documents.clear()
+                self.term_counts.clear()
+                if self.reader is not None:
+                    changed = self.reader.list_files(commit, include_tests=False)
+                else:
+                    changed = list_files(self.checkout_dir, include_tests=False, commit=commit)
+            else:
+                for relative_path in deleted:
+                    self.remove(relative_path)
+            to_encode = list()
+            for relative_path in changed:
+                filename = Path(self.checkout_dir, relative_path)
+                exists = relative_path in self.blob_shas
+                if filename.suffix != ".py" or is_test(relative_path) or not exists:
+                    self.remove(relative_path)
+                    continue
+                to_encode.append(relative_path)
+            self.encode(to_encode)
+        if self.cache is not None:
+            self.cache.flush()
+        logger.info(
+            f"Updated documents of {self.repo_dir} to {commit} ({len(changed)} changed, {len(deleted)} deleted)"
+        )
+        self.commit = commit
+        return self.documents
+
+    def build_bm25_index(self):
+        """
+        Builds a BM25Index of the current documents, reusing the term counts of unchanged files.
+        """
+        chunked = isinstance(self.document_encoding_func, ChunkEncoder)
+        docids, term_counts = list(), list()
+        for relative_path, text in self.documents.items():
+            if relative_path not in self.term_counts:
+                self.term_counts[relative_path] = [
+                    (docid, Counter(tokenize(doc_text)))
+                    for docid, doc_text in expand_document(relative_path, text, chunked)
+                ]
+            for docid, counts in self.term_counts[relative_path]:
+                docids.append(docid)
+                term_counts.append(counts)
+        return BM25Index.from_term_counts(docids, term_counts)
+
+
+_INCREMENTAL_DOCUMENTS = dict()
+
+
+def get_incremental_documents(
+    repo_dir,
+    document_encoding_func,
+    cache=None,
+    reader=None,
+    worktree_pool=None,
+    encoder=None,
+):
+    """
+    Returns the IncrementalDocuments of a repository, creating it on first use. Only the most
+    recently used repository is kept in memory, since instances are indexed grouped by repo.
+    """
+    key = (Path(repo_dir).as_posix(), document_encoding_func.__name__)
+    if key not in _INCREMENTAL_DOCUMENTS:
+        _INCREMENTAL_DOCUMENTS.clear()
+        _INCREMENTAL_DOCUMENTS[key] = IncrementalDocuments(
+            repo_dir,
+            document_encoding_func,
+            cache=cache,
+            reader=reader,
+            worktree_pool=worktree_pool,
+            encoder=encoder,
+        )
+    return _INCREMENTAL_DOCUMENTS[key]
+
+
+def get_index_key(repo, commit):
+    """
+    Returns the key an index is stored under. The encoding style is part of root_dir, so
+    instances that share (repo, commit, document_encoding_style) share one index.
+    """
+    return f"{repo.replace('/', '__')}__{commit}"
 
 
 def make_index(
@@ -206,9 +627,16 @@ def make_index(
     document_encoding_func,
     python,
     instance_id,
+    backend="pyserini",
+    incremental=False,
+    cache=None,
+    reader=None,
+    worktree_pool=None,
+    encoder=None,
+    index_key=None,
 ):
     """
-    Builds an index for a given set of documents using Pyserini.
+    Builds an index for a given set of documents using Pyserini or the in-process NumPy BM25 engine.
 
     Args:
         repo_dir (str): The path to the repository directory.
@@ -218,25 +646,215 @@ def make_index(
         document_encoding_func (function): The function to use for encoding documents.
         python (str): The path to the Python executable.
         instance_id (int): The ID of the current instance.
+        backend (str, optional): One of RETRIEVAL_BACKENDS. Defaults to "pyserini".
+        incremental (bool, optional): Whether to reuse the documents of the previously indexed commit of this repo
+            and only re-encode the files changed since. Defaults to False.
+        cache (DocumentCache, optional): A cache of encoded documents keyed by blob SHA. Defaults to None.
+        reader (GitObjectReader, optional): Reads documents from the git object database instead of a checkout.
+            Defaults to None.
+        worktree_pool (WorktreePool, optional): Checks commits out in leased worktrees. Defaults to None.
+        encoder (DocumentEncoder, optional): Encodes files in parallel with a time budget per file. Defaults to None.
+        index_key (str, optional): The key to store the index under, see `get_index_key`. Defaults to instance_id.
 
     Returns:
         index_path (Path): The path to the built index.
     """
-    index_path = Path(root_dir, f"index__{str(instance_id)}", "index")
+    if index_key is None:
+        index_key = str(instance_id)
+    index_path = Path(root_dir, f"index__{index_key}", "index")
     if index_path.exists():
         return index_path
-    thread_prefix = f"(pid {os.getpid()}) "
-    documents_path = Path(root_dir, instance_id, "documents.jsonl")
+    index_path.parent.mkdir(parents=True, exist_ok=True)
+    with FileLock(Path(index_path.parent, "build.lock").as_posix()):
+        if index_path.exists():  # built by another process while we waited
+            return index_path
+        return build_index(
+            index_path,
+            repo_dir,
+            commit,
+            document_encoding_func,
+            python,
+            backend=backend,
+            incremental=incremental,
+            cache=cache,
+            reader=reader,
+            worktree_pool=worktree_pool,
+            encoder=encoder,
+        )
+
+
+def build_index(
+    index_path,
+    repo_dir,
+    commit,
+    document_encoding_func,
+    python,
+    backend="pyserini",
+    incremental=False,
+    cache=None,
+    reader=None,
+    worktree_pool=None,
+    encoder=None,
+):
+    """
+    Encodes the documents of `commit` and builds an index of them at `index_path`.
+    See `make_index` for the arguments.
+
+    Returns:
+        index_path (Path): The path to the built index.
+    """
+    documents_path = prepare_index(
+        index_path,
+        repo_dir,
+        commit,
+        document_encoding_func,
+        backend=backend,
+        incremental=incremental,
+        cache=cache,
+        reader=reader,
+        worktree_pool=worktree_pool,
+        encoder=encoder,
+    )
+    if documents_path is None:
+        return index_path
+    return run_pyserini_index(documents_path, index_path, python)
+
+
+def iter_snapshot_documents(
+    repo_dir,
+    commit,
+    document_encoding_func,
+    incremental=False,
+    cache=None,
+    reader=None,
+    worktree_pool=None,
+    encoder=None,
+):
+    """
+    Yields the (docid, text) pairs of every document of `commit`, with files split into
+    chunks for a ChunkEncoder. See `make_index` for the arguments.
+    """
+    chunked = isinstance(document_encoding_func, ChunkEncoder)
+    if incremental:
+        repo_documents = get_incremental_documents(
+            repo_dir,
+            document_encoding_func,
+            cache=cache,
+            reader=reader,
+            worktree_pool=worktree_pool,
+            encoder=encoder,
+        )
+        documents = repo_documents.update(commit).items()
+    else:
+        documents = iter_documents(
+            repo_dir,
+            commit,
+            document_encoding_func,
+            cache=cache,
+            reader=reader,
+            worktree_pool=worktree_pool,
+            encoder=encoder,
+        )
+    for relative_path, encoded in documents:
+        yield from expand_document(relative_path, encoded, chunked)
+
+
+def build_memory_index(
+    repo_dir,
+    commit,
+    document_encoding_func,
+    incremental=False,
+    cache=None,
+    reader=None,
+    worktree_pool=None,
+    encoder=None,
+):
+    """
+    Builds an in-memory BM25Index of the documents of `commit`. See `make_index` for the arguments.
+
+    Returns:
+        BM25Index: The index, which is not written anywhere.
+    """
+    if incremental:
+        repo_documents = get_incremental_documents(
+            repo_dir,
+            document_encoding_func,
+            cache=cache,
+            reader=reader,
+            worktree_pool=worktree_pool,
+            encoder=encoder,
+        )
+        repo_documents.update(commit)
+        return repo_documents.build_bm25_index()
+    documents = iter_snapshot_documents(
+        repo_dir,
+        commit,
+        document_encoding_func,
+        cache=cache,
+        reader=reader,
+        worktree_pool=worktree_pool,
+        encoder=encoder,
+    )
+    return BM25Index.from_documents(documents)
+
+
+def prepare_index(
+    index_path,
+    repo_dir,
+    commit,
+    document_encoding_func,
+    backend="pyserini",
+    incremental=False,
+    cache=None,
+    reader=None,
+    worktree_pool=None,
+    encoder=None,
+):
+    """
+    Encodes the documents of `commit`. With the numpy backend the index is built right away;
+    with pyserini the documents are written to a `documents.jsonl` for `run_pyserini_index`.
+    Unless `incremental` keeps them for the next commit, documents are streamed from the
+    encoder into the index or file and never held in memory together.
+    See `make_index` for the arguments.
+
+    Returns:
+        documents_path (Path): The path to the written documents, or None if the index was already built.
+    """
+    kwargs = dict(
+        incremental=incremental,
+        cache=cache,
+        reader=reader,
+        worktree_pool=worktree_pool,
+        encoder=encoder,
+    )
+    if backend == "numpy":
+        build_memory_index(repo_dir, commit, document_encoding_func, **kwargs).save(index_path)
+        return None
+    documents = iter_snapshot_documents(repo_dir, commit, document_encoding_func, **kwargs)
+    documents_path = Path(index_path.parent, "documents", "documents.jsonl")
     if not documents_path.parent.exists():
         documents_path.parent.mkdir(parents=True)
-    documents = build_documents(repo_dir, commit, document_encoding_func)
-    with open(documents_path, "w") as docfile:
-        for relative_path, contents in documents.items():
-            print(
-                json.dumps({"id": relative_path, "contents": contents}),
-                file=docfile,
-                flush=True,
-            )
+    with open(documents_path, "w", buffering=DOCUMENTS_BUFFER_SIZE) as docfile:
+        for docid, contents in documents:
+            docfile.write(json.dumps({"id": docid, "contents": contents}) + "\n")
+    return documents_path
+
+
+def run_pyserini_index(documents_path, index_path, python, store_extras=True):
+    """
+    Runs `pyserini.index` over the documents written by `prepare_index`.
+
+    Args:
+        documents_path (Path): The path to the documents.jsonl file.
+        index_path (Path): The path to write the index to.
+        python (str): The path to the Python executable.
+        store_extras (bool, optional): Whether to store positions, document vectors and raw
+            documents, which BM25 search does not need. Defaults to True.
+
+    Returns:
+        index_path (Path): The path to the built index.
+    """
+    thread_prefix = f"(pid {os.getpid()}) "
     cmd = [
         python,
         "-m",
@@ -251,10 +869,9 @@ def make_index(
         documents_path.parent.as_posix(),
         "--index",
         index_path.as_posix(),
-        "--storePositions",
-        "--storeDocvectors",
-        "--storeRaw",
     ]
+    if store_extras:
+        cmd += ["--storePositions", "--storeDocvectors", "--storeRaw"]
     try:
         proc = subprocess.Popen(
             cmd,
@@ -273,7 +890,7 @@ def make_index(
         logger.error(f"return code: {proc.returncode}")
         raise Exception(
             thread_prefix
-            + f"Failed to build index for {instance_id} with error {error}"
+            + f"Failed to build index for {index_path.parent.name} with error {error}"
         )
     return index_path
 
@@ -281,6 +898,7 @@ def make_index(
 def get_remaining_instances(instances, output_file):
     """
     Filters a list of instances to exclude those that have already been processed and saved in a file.
+    Instances still in unmerged result segments count as processed.
 
     Args:
         instances (List[Dict]): A list of instances, where each instance is a dictionary with an "instance_id" key.
@@ -289,21 +907,14 @@ def get_remaining_instances(instances, output_file):
     Returns:
         List[Dict]: A list of instances that have not been processed yet.
     """
-    instance_ids = set()
+    output_file.parent.mkdir(parents=True, exist_ok=True)
     remaining_instances = list()
-    if output_file.exists():
-        with FileLock(output_file.as_posix() + ".lock"):
-            with open(output_file) as f:
-                for line in f:
-                    instance = json.loads(line)
-                    instance_id = instance["instance_id"]
-                    instance_ids.add(instance_id)
-            logger.warning(
-                f"Found {len(instance_ids)} existing instances in {output_file}. Will skip them."
-            )
-    else:
-        output_file.parent.mkdir(parents=True, exist_ok=True)
+    instance_ids = load_completed_ids(output_file)
+    if not instance_ids:
         return instances
+    logger.warning(
+        f"Found {len(instance_ids)} existing instances in {output_file}. Will skip them."
+    )
     for instance in instances:
         instance_id = instance["instance_id"]
         if instance_id not in instance_ids:
@@ -311,75 +922,422 @@ def get_remaining_instances(instances, output_file):
     return remaining_instances
 
 
-def search(instance, index_path):
+def load_searcher(index_path):
+    """
+    Opens a searcher for the given index, picking the backend from what is stored on disk.
+
+    Args:
+        index_path (Path): The path to the index.
+
+    Returns:
+        LuceneSearcher or BM25Index: An object exposing `search(query, k, remove_dups)`.
+    """
+    if BM25Index.exists(index_path):
+        return BM25Index.load(index_path)
+    if LuceneSearcher is None:
+        raise ImportError(
+            f"pyserini is required to search {index_path}. Install it or use --backend numpy."
+        )
+    return LuceneSearcher(index_path.as_posix())
+
+
+class SearcherCache:
+    """
+    Keeps searchers open across calls, keyed by index path, closing the least recently used
+    one once more than `max_size` are open.
+
+    Args:
+        max_size (int, optional): The maximum number of open searchers. Defaults to 16.
+    """
+
+    def __init__(self, max_size=16):
+        self.max_size = max_size
+        self.searchers = OrderedDict()
+
+    def get(self, index_path):
+        key = Path(index_path).as_posix()
+        if key in self.searchers:
+            self.searchers.move_to_end(key)
+            return self.searchers[key]
+        return self.put(index_path, load_searcher(Path(index_path)))
+
+    def put(self, index_path, searcher):
+        """
+        Adds an open searcher, e.g. an in-memory BM25Index, under `index_path`.
+        """
+        self.searchers[Path(index_path).as_posix()] = searcher
+        while len(self.searchers) > self.max_size:
+            _, evicted = self.searchers.popitem(last=False)
+            evicted.close()
+        return searcher
+
+    def close(self):
+        while self.searchers:
+            _, searcher = self.searchers.popitem()
+            searcher.close()
+
+
+SEARCHER_CACHE = SearcherCache()
+
+
+def build_query(searcher, problem_statement, max_query_terms=MAX_QUERY_TERMS):
+    """
+    Compiles a problem statement into a bounded weighted query for the given searcher.
+
+    The NumPy engine scores the weighted terms directly. For Lucene the terms become a
+    BooleanQuery of boosted term queries, analyzed like the indexed documents. Either way the
+    query stays under Lucene's maxClauseCount, so every instance is searched exactly once.
+
+    Args:
+        searcher (LuceneSearcher or BM25Index): The searcher the query is for.
+        problem_statement (str): The text to search for.
+        max_query_terms (int, optional): The maximum number of query terms.
+
+    Returns:
+        dict or Query: A query accepted by `searcher.search`.
+    """
+    # only Lucene's tokenizer keeps dotted paths whole, so only Lucene indexes can match them
+    weighted_terms = compile_query(
+        problem_statement,
+        max_terms=max_query_terms,
+        dotted_paths=not isinstance(searcher, BM25Index),
+    )
+    if isinstance(searcher, BM25Index):
+        return weighted_terms
+    should = querybuilder.JBooleanClauseOccur["should"].value
+    builder = querybuilder.get_boolean_query_builder()
+    for term, weight in weighted_terms.items():
+        try:
+            term_query = querybuilder.get_term_query(term)
+        except Exception:
+            continue  # the analyzer produced no token, e.g. for a stop word
+        builder.add(querybuilder.get_boost_query(term_query, weight), should)
+    return builder.build()
+
+
+def get_num_hits(k, chunk_aggregation=None):
+    """
+    Returns how many hits to retrieve for `k` results: more for chunk indexes, where several
+    chunks of one file can be among the hits.
+    """
+    return k if chunk_aggregation is None else k * CHUNK_OVERSAMPLING
+
+
+def make_results(instance_id, hits, k=None, chunk_aggregation=None):
+    if chunk_aggregation is not None:
+        return {
+            "instance_id": instance_id,
+            "hits": aggregate_hits(hits, k, aggregation=chunk_aggregation),
+        }
+    results = {"instance_id": instance_id, "hits": []}
+    for hit in hits:
+        results["hits"].append({"docid": hit.docid, "score": hit.score})
+    return results
+
+
+def search(
+    instance,
+    index_path,
+    k=20,
+    searcher_cache=SEARCHER_CACHE,
+    max_query_terms=MAX_QUERY_TERMS,
+    chunk_aggregation=None,
+):
     """
     Searches for relevant documents in the given index for the given instance.
 
     Args:
         instance (dict): The instance to search for.
         index_path (str): The path to the index to search in.
+        k (int, optional): The number of hits to return. Defaults to 20.
+        searcher_cache (SearcherCache, optional): Where to keep the searcher open for later calls.
+        max_query_terms (int, optional): The maximum number of query terms, see `build_query`.
+        chunk_aggregation (str, optional): For chunk indexes, how chunk scores are aggregated into
+            file scores, one of CHUNK_AGGREGATIONS. Defaults to None, for file indexes.
 
     Returns:
         dict: A dictionary containing the instance ID and a list of hits, where each hit is a dictionary containing the
-        document ID and its score.
+        document ID and its score, and for chunk indexes the `spans` of its matching chunks.
     """
     try:
         instance_id = instance["instance_id"]
-        searcher = LuceneSearcher(index_path.as_posix())
-        cutoff = len(instance["problem_statement"])
-        while True:
-            try:
-                hits = searcher.search(
-                    instance["problem_statement"][:cutoff],
-                    k=20,
-                    remove_dups=True,
-                )
-            except Exception as e:
-                if "maxClauseCount" in str(e):
-                    cutoff = int(round(cutoff * 0.8))
-                    continue
-                else:
-                    raise e
-            break
-        results = {"instance_id": instance_id, "hits": []}
-        for hit in hits:
-            results["hits"].append({"docid": hit.docid, "score": hit.score})
-        return results
+        searcher = searcher_cache.get(index_path)
+        query = build_query(searcher, instance["problem_statement"], max_query_terms)
+        hits = searcher.search(
+            query, k=get_num_hits(k, chunk_aggregation), remove_dups=True
+        )
+        return make_results(instance_id, hits, k, chunk_aggregation)
     except Exception as e:
         logger.error(f"Failed to process {instance_id}")
         logger.error(traceback.format_exc())
         return None
 
 
-def search_indexes(remaining_instance, output_file, all_index_paths):
+def batch_search(
+    instances,
+    index_path,
+    k=20,
+    threads=1,
+    searcher_cache=SEARCHER_CACHE,
+    max_query_terms=MAX_QUERY_TERMS,
+    chunk_aggregation=None,
+):
+    """
+    Searches one index for several instances at once, on `threads` threads.
+
+    pyserini's `batch_search` only takes query strings, so compiled Lucene queries are searched
+    with `search` on a thread pool over the open searcher instead, like `BM25Index.batch_search`
+    does. If the batch fails, the instances are searched one by one with `search`, so a single
+    bad instance only loses its own results.
+
+    Args:
+        instances (list): The instances to search for.
+        index_path (str): The path to the index shared by these instances.
+        k (int, optional): The number of hits to return per instance. Defaults to 20.
+        threads (int, optional): The number of search threads. Defaults to 1.
+        searcher_cache (SearcherCache, optional): Where to keep the searcher open for later calls.
+        max_query_terms (int, optional): The maximum number of query terms, see `build_query`.
+        chunk_aggregation (str, optional): See `search`.
+
+    Returns:
+        list: The results of each instance, in order, with None for instances that failed.
+    """
+    try:
+        searcher = searcher_cache.get(index_path)
+        qids = [instance["instance_id"] for instance in instances]
+        queries = [
+            build_query(searcher, instance["problem_statement"], max_query_terms)
+            for instance in instances
+        ]
+        num_hits = get_num_hits(k, chunk_aggregation)
+        if isinstance(searcher, BM25Index):
+            all_hits = searcher.batch_search(queries, qids, k=num_hits, threads=threads)
+        else:
+
+            def search_one(query):
+                return searcher.search(query, k=num_hits, remove_dups=True)
+
+            if threads <= 1 or len(queries) <= 1:
+                all_hits = dict(zip(qids, map(search_one, queries)))
+            else:
+                with ThreadPoolExecutor(min(threads, len(queries))) as executor:
+                    all_hits = dict(zip(qids, executor.map(search_one, queries)))
+        return [
+            make_results(qid, all_hits.get(qid, list()), k, chunk_aggregation)
+            for qid in qids
+        ]
+    except Exception:
+        logger.warning(
+            f"Batch search of {index_path} failed, searching {len(instances)} instances one at a time"
+        )
+        return [
+            search(
+                instance,
+                index_path,
+                k=k,
+                searcher_cache=searcher_cache,
+                max_query_terms=max_query_terms,
+                chunk_aggregation=chunk_aggregation,
+            )
+            for instance in instances
+        ]
+
+
+def search_ephemeral(
+    instances,
+    repo_dir,
+    commit,
+    document_encoding_func,
+    python=None,
+    backend="numpy",
+    k=20,
+    threads=1,
+    chunk_aggregation=None,
+    incremental=False,
+    cache=None,
+    reader=None,
+    worktree_pool=None,
+    encoder=None,
+):
+    """
+    Indexes one snapshot, searches it for `instances` and discards the index, for indexes that
+    are searched only once. With the numpy backend the index is only ever held in memory. With
+    pyserini it is built in a temporary directory on tmpfs (EPHEMERAL_DIR) when available,
+    without the positions, document vectors and raw documents that search does not use.
+
+    Args:
+        instances (list): The instances of the snapshot to search for.
+        repo_dir (str): The path to the repository directory.
+        commit (str): The commit to index.
+        document_encoding_func (function): The function to use for encoding documents.
+        python (str, optional): The Python executable that runs `pyserini.index`.
+        backend (str, optional): One of RETRIEVAL_BACKENDS. Defaults to "numpy".
+        k, threads, chunk_aggregation: See `batch_search`.
+        incremental, cache, reader, worktree_pool, encoder: See `make_index`.
+
+    Returns:
+        list: The results of each instance, in order, with None for instances that failed.
+    """
+    kwargs = dict(
+        incremental=incremental,
+        cache=cache,
+        reader=reader,
+        worktree_pool=worktree_pool,
+        encoder=encoder,
+    )
+    searcher_cache = SearcherCache(max_size=1)
+    search_kwargs = dict(
+        k=k,
+        threads=threads,
+        searcher_cache=searcher_cache,
+        chunk_aggregation=chunk_aggregation,
+    )
+    if backend == "numpy":
+        index_key = f"memory__{commit}"
+        searcher_cache.put(
+            index_key, build_memory_index(repo_dir, commit, document_encoding_func, **kwargs)
+        )
+        try:
+            return batch_search(instances, index_key, **search_kwargs)
+        finally:
+            searcher_cache.close()
+    ephemeral_dir = EPHEMERAL_DIR if os.path.isdir(EPHEMERAL_DIR) else None
+    with tempfile.TemporaryDirectory(prefix="index__", dir=ephemeral_dir) as tmp_dir:
+        index_path = Path(tmp_dir, "index")
+        documents_path = prepare_index(
+            index_path, repo_dir, commit, document_encoding_func, backend=backend, **kwargs
+        )
+        run_pyserini_index(documents_path, index_path, python, store_extras=False)
+        try:
+            return batch_search(instances, index_path, **search_kwargs)
+        finally:
+            searcher_cache.close()
+
+
+def run_ephemeral_retrieval(
+    remaining_instances,
+    root_dir_name,
+    document_encoding_func,
+    python,
+    token,
+    sink,
+    backend="numpy",
+    incremental=False,
+    cache=None,
+    checkout_free=False,
+    max_worktrees=0,
+    encoder=None,
+    k=20,
+    search_threads=1,
+    chunk_aggregation=None,
+    sparse_clone=False,
+    mirror_dir=None,
+    disk_budget=None,
+):
     """
-    Searches the indexes for the given instances and writes the results to the output file.
+    Retrieves for every (repo, base_commit) snapshot with `search_ephemeral`, writing the results
+    as each snapshot is searched. No index is kept. See `run_retrieval_pipeline` for the arguments.
+
+    Returns:
+        int: The number of instances with results.
+    """
+    snapshot_instances = dict()
+    for instance in remaining_instances:
+        index_key = get_index_key(instance["repo"], instance["base_commit"])
+        snapshot_instances.setdefault(index_key, list()).append(instance)
+    snapshots = list(snapshot_instances.values())
+    # consecutive commits of a repo share a clone, and with incremental the smallest diffs
+    snapshots = sorted(snapshots, key=lambda x: (x[0]["repo"], x[0].get("created_at", "")))
+    logger.info(
+        f"Retrieving with ephemeral indexes over {len(snapshots)} unique snapshots "
+        f"for {len(remaining_instances)} instances"
+    )
+    num_results = 0
+    with tqdm(total=len(remaining_instances), desc="Retrieving") as pbar:
+        for instances in snapshots:
+            repo, commit = instances[0]["repo"], instances[0]["base_commit"]
+            try:
+                repo_lease = nullcontext()
+                if disk_budget is not None:
+                    repo_lease = disk_budget.lease(get_repo_dir(repo, root_dir_name))
+                with repo_lease:
+                    repo_dir = clone_repo(
+                        repo, root_dir_name, token, sparse=sparse_clone, mirror_dir=mirror_dir
+                    )
+                    worktree_pool = None
+                    if max_worktrees > 0:
+                        worktree_pool = WorktreePool(repo_dir, max_worktrees=max_worktrees)
+                    all_results = search_ephemeral(
+                        instances,
+                        repo_dir,
+                        commit,
+                        document_encoding_func,
+                        python=python,
+                        backend=backend,
+                        k=k,
+                        threads=search_threads,
+                        chunk_aggregation=chunk_aggregation,
+                        incremental=incremental,
+                        cache=cache,
+                        reader=get_document_reader(
+                            repo_dir, document_encoding_func, checkout_free
+                        ),
+                        worktree_pool=worktree_pool,
+                        encoder=encoder,
+                    )
+            except Exception:
+                logger.error(f"Failed to process {repo}/{commit}")
+                logger.error(traceback.format_exc())
+                all_results = list()
+            for results in all_results:
+                if results is not None:
+                    sink.write(results)
+                    num_results += 1
+            pbar.update(len(instances))
+    return num_results
+
+
+def search_indexes(
+    remaining_instance, sink, all_index_paths, k=20, threads=1, chunk_aggregation=None
+):
+    """
+    Searches the indexes for the given instances and writes the results to the sink.
+    Instances that share an index are searched together in one batch.
 
     Args:
         remaining_instance (list): A list of instances to search for.
-        output_file (str): The path to the output file to write the results to.
+        sink (ResultSink): Where to write the results.
         all_index_paths (dict): A dictionary mapping instance IDs to the paths of their indexes.
+        k (int, optional): The number of hits to retrieve per instance. Defaults to 20.
+        threads (int, optional): The number of threads to use for each batch search. Defaults to 1.
+        chunk_aggregation (str, optional): For chunk indexes, see `search`. Defaults to None.
     """
-    for instance in tqdm(remaining_instance, desc="Retrieving"):
+    instances_by_index = dict()
+    for instance in remaining_instance:
         instance_id = instance["instance_id"]
         if instance_id not in all_index_paths:
             continue
-        index_path = all_index_paths[instance_id]
-        results = search(instance, index_path)
-        if results is None:
-            continue
-        with FileLock(output_file.as_posix() + ".lock"):
-            with open(output_file, "a") as out_file:
-                print(json.dumps(results), file=out_file, flush=True)
+        index_key = Path(all_index_paths[instance_id]).as_posix()
+        instances_by_index.setdefault(index_key, list()).append(instance)
+    with tqdm(
+        total=sum(map(len, instances_by_index.values())), desc="Retrieving"
+    ) as pbar:
+        for index_path, instances in instances_by_index.items():
+            all_results = batch_search(
+                instances,
+                Path(index_path),
+                k=k,
+                threads=threads,
+                chunk_aggregation=chunk_aggregation,
+            )
+            for results in all_results:
+                sink.write(results)
+            pbar.update(len(instances))
+    SEARCHER_CACHE.close()
 
 
 def get_missing_ids(instances, output_file):
-    with open(output_file) as f:
-        written_ids = set()
-        for line in f:
-            instance = json.loads(line)
-            instance_id = instance["instance_id"]
-            written_ids.add(instance_id)
+    written_ids = load_completed_ids(output_file)
     missing_ids = set()
     for instance in instances:
         instance_id = instance["instance_id"]
@@ -394,29 +1352,82 @@ def get_index_paths_worker(
     document_encoding_func,
     python,
     token,
+    backend="pyserini",
+    incremental=False,
+    cache=None,
+    checkout_free=False,
+    max_worktrees=0,
+    encoder=None,
+    sparse_clone=False,
+    mirror_dir=None,
+    disk_budget=None,
 ):
     index_path = None
     repo = instance["repo"]
     commit = instance["base_commit"]
     instance_id = instance["instance_id"]
     try:
-        repo_dir = clone_repo(repo, root_dir_name, token)
-        query = instance["problem_statement"]
-        index_path = make_index(
-            repo_dir,
-            root_dir_name,
-            query,
-            commit,
-            document_encoding_func,
-            python,
-            instance_id,
-        )
+        repo_lease = nullcontext()
+        if disk_budget is not None:
+            # the clone and its worktrees are not evicted while this snapshot is indexed
+            repo_lease = disk_budget.lease(get_repo_dir(repo, root_dir_name))
+        with repo_lease:
+            repo_dir = clone_repo(
+                repo, root_dir_name, token, sparse=sparse_clone, mirror_dir=mirror_dir
+            )
+            reader = get_document_reader(repo_dir, document_encoding_func, checkout_free)
+            worktree_pool = None
+            if max_worktrees > 0:
+                worktree_pool = WorktreePool(repo_dir, max_worktrees=max_worktrees)
+            query = instance["problem_statement"]
+            index_path = make_index(
+                repo_dir,
+                root_dir_name,
+                query,
+                commit,
+                document_encoding_func,
+                python,
+                instance_id,
+                backend=backend,
+                incremental=incremental,
+                cache=cache,
+                reader=reader,
+                worktree_pool=worktree_pool,
+                encoder=encoder,
+                index_key=get_index_key(repo, commit),
+            )
     except:
         logger.error(f"Failed to process {repo}/{commit} (instance {instance_id})")
         logger.error(traceback.format_exc())
     return instance_id, index_path
 
 
+def get_index_paths_repo_worker(
+    instances, results_queue, *args, cache=None, encoder=None, **kwargs
+):
+    """
+    Indexes all instances of one repo in a worker process, so no two workers share a clone.
+    Each result is put on `results_queue` as soon as it is ready.
+
+    Returns:
+        tuple: The document cache hits and misses and the encoding fallbacks of this worker.
+    """
+    for instance in instances:
+        results_queue.put(
+            get_index_paths_worker(
+                instance, *args, cache=cache, encoder=encoder, **kwargs
+            )
+        )
+    hits, misses, fallbacks = 0, 0, 0
+    if cache is not None:
+        cache.close()
+        hits, misses = cache.hits, cache.misses
+    if encoder is not None:
+        encoder.close()
+        fallbacks = encoder.fallbacks
+    return hits, misses, fallbacks
+
+
 def get_index_paths(
     remaining_instances: list[dict[str, Any]],
     root_dir_name: str,
@@ -424,6 +1435,16 @@ def get_index_paths(
     python: str,
     token: str,
     output_file: str,
+    backend: str = "pyserini",
+    incremental: bool = False,
+    cache: DocumentCache = None,
+    checkout_free: bool = False,
+    max_worktrees: int = 0,
+    num_workers: int = 1,
+    encoder: DocumentEncoder = None,
+    sparse_clone: bool = False,
+    mirror_dir: str = None,
+    disk_budget: DiskBudget = None,
 ) -> dict[str, str]:
     """
     Retrieves the index paths for the given instances using multiple processes.
@@ -435,23 +1456,356 @@ def get_index_paths(
         python: The path to the Python executable.
         token: The token to use for authentication.
         output_file: The output file.
-        num_workers: The number of worker processes to use.
+        backend: The retrieval backend used to build the indexes.
+        incremental: Whether to update one set of documents per repo across commits instead of rebuilding them.
+        cache: An optional cache of encoded documents keyed by blob SHA.
+        checkout_free: Whether to read documents from the git object database instead of checking out each commit.
+        max_worktrees: If positive, check commits out in a pool of up to this many git worktrees per repo.
+        num_workers: The number of worker processes to use. Instances are split between workers by repo.
+        encoder: An optional encoder that encodes files in parallel with a time budget per file.
+        sparse_clone: Whether to clone repos partially, fetching only the Python files and READMEs that are read.
+        mirror_dir: An optional directory of bare mirrors that clones borrow their objects from.
+        disk_budget: An optional quota on root_dir. Clones are leased while they are indexed and the
+            least recently used unleased clones and indexes are evicted when it is exceeded.
 
     Returns:
         A dictionary mapping instance IDs to index paths.
     """
     all_index_paths = dict()
-    for instance in tqdm(remaining_instances, desc="Indexing"):
-        instance_id, index_path = get_index_paths_worker(
-            instance,
-            root_dir_name,
-            document_encoding_func,
-            python,
-            token,
+    worker_args = (root_dir_name, document_encoding_func, python, token)
+    worker_kwargs = dict(
+        backend=backend,
+        incremental=incremental,
+        cache=cache,
+        checkout_free=checkout_free,
+        max_worktrees=max_worktrees,
+        encoder=encoder,
+        sparse_clone=sparse_clone,
+        mirror_dir=mirror_dir,
+        disk_budget=disk_budget,
+    )
+    # index each (repo, base_commit) snapshot once and share it between its instances
+    snapshot_instance_ids = dict()
+    snapshots = list()
+    for instance in remaining_instances:
+        index_key = get_index_key(instance["repo"], instance["base_commit"])
+        if index_key not in snapshot_instance_ids:
+            snapshot_instance_ids[index_key] = list()
+            snapshots.append(instance)
+        snapshot_instance_ids[index_key].append(instance["instance_id"])
+    logger.info(
+        f"Indexing {len(snapshots)} unique snapshots for {len(remaining_instances)} instances"
+    )
+    if incremental:
+        # consecutive commits of the same repo give the smallest diffs
+        snapshots = sorted(
+            snapshots, key=lambda x: (x["repo"], x.get("created_at", ""))
         )
+
+    def add_result(instance, index_path, pbar):
+        instance_ids = snapshot_instance_ids[
+            get_index_key(instance["repo"], instance["base_commit"])
+        ]
+        pbar.update(len(instance_ids))
         if index_path is None:
-            continue
-        all_index_paths[instance_id] = index_path
+            return
+        for instance_id in instance_ids:
+            all_index_paths[instance_id] = index_path
+
+    if num_workers <= 1:
+        with tqdm(total=len(remaining_instances), desc="Indexing") as pbar:
+            for instance in snapshots:
+                _, index_path = get_index_paths_worker(
+                    instance, *worker_args, **worker_kwargs
+                )
+                add_result(instance, index_path, pbar)
+        return all_index_paths
+    instances_by_id = {instance["instance_id"]: instance for instance in snapshots}
+    repo_groups = dict()
+    for instance in snapshots:
+        repo_groups.setdefault(instance["repo"], list()).append(instance)
+    # start the largest repos first so they do not end up as the stragglers
+    repo_groups = sorted(repo_groups.values(), key=len, reverse=True)
+    with Manager() as manager, ProcessPoolExecutor(num_workers) as executor:
+        results_queue = manager.Queue()
+        futures = [
+            executor.submit(
+                get_index_paths_repo_worker,
+                instances,
+                results_queue,
+                *worker_args,
+                **worker_kwargs,
+            )
+            for instances in repo_groups
+        ]
+        with tqdm(total=len(remaining_instances), desc="Indexing") as pbar:
+            while pbar.n < pbar.total:
+                try:
+                    instance_id, index_path = results_queue.get(timeout=1)
+                except Empty:
+                    if all(future.done() for future in futures) and results_queue.empty():
+                        break
+                    continue
+                add_result(instances_by_id[instance_id], index_path, pbar)
+        for future in futures:
+            try:
+                hits, misses, fallbacks = future.result()
+            except Exception:
+                logger.error(traceback.format_exc())
+                continue
+            if cache is not None:
+                cache.hits += hits
+                cache.misses += misses
+            if encoder is not None:
+                encoder.fallbacks += fallbacks
+    return all_index_paths
+
+
+def encode_snapshot_worker(
+    instance,
+    repo_dir,
+    index_path,
+    document_encoding_func,
+    backend="pyserini",
+    incremental=False,
+    cache=None,
+    checkout_free=False,
+    max_worktrees=0,
+    encoder=None,
+):
+    """
+    Encodes the documents of one (repo, base_commit) snapshot in a pipeline worker process.
+    See `prepare_index` for what is written to disk.
+
+    Returns:
+        tuple: (documents_path, (hits, misses, fallbacks)), where documents_path is None if the
+        index is already built, (hits, misses) are the document cache counts of this call and
+        fallbacks is the number of files that ran out of encoding time.
+    """
+    if index_path.exists():
+        return None, (0, 0, 0)
+    reader = get_document_reader(repo_dir, document_encoding_func, checkout_free)
+    worktree_pool = None
+    if max_worktrees > 0:
+        worktree_pool = WorktreePool(repo_dir, max_worktrees=max_worktrees)
+    hits, misses = (cache.hits, cache.misses) if cache is not None else (0, 0)
+    fallbacks = encoder.fallbacks if encoder is not None else 0
+    checkout_lock = nullcontext()
+    if reader is None and worktree_pool is None:
+        # snapshots of one repo would otherwise reset the same working tree concurrently
+        checkout_lock = FileLock(
+            Path(Path(repo_dir).parent, f".checkout__{Path(repo_dir).name}.lock").as_posix()
+        )
+    index_path.parent.mkdir(parents=True, exist_ok=True)
+    with checkout_lock, FileLock(Path(index_path.parent, "build.lock").as_posix()):
+        if index_path.exists():
+            return None, (0, 0, 0)
+        documents_path = prepare_index(
+            index_path,
+            repo_dir,
+            instance["base_commit"],
+            document_encoding_func,
+            backend=backend,
+            incremental=incremental,
+            cache=cache,
+            reader=reader,
+            worktree_pool=worktree_pool,
+            encoder=encoder,
+        )
+    if encoder is not None:
+        fallbacks = encoder.fallbacks - fallbacks
+    if cache is None:
+        return documents_path, (0, 0, fallbacks)
+    cache.flush()
+    return documents_path, (cache.hits - hits, cache.misses - misses, fallbacks)
+
+
+def run_retrieval_pipeline(
+    remaining_instances,
+    root_dir_name,
+    document_encoding_func,
+    python,
+    token,
+    sink,
+    backend="pyserini",
+    incremental=False,
+    cache=None,
+    checkout_free=False,
+    max_worktrees=0,
+    encoder=None,
+    k=20,
+    search_threads=1,
+    chunk_aggregation=None,
+    clone_workers=2,
+    encode_workers=4,
+    index_workers=2,
+    search_workers=2,
+    queue_size=8,
+    sparse_clone=False,
+    mirror_dir=None,
+    disk_budget=None,
+):
+    """
+    Clones, encodes, indexes and searches as four concurrent stages connected by bounded queues,
+    so the first results are written while later repositories are still being cloned.
+
+    Encoding is CPU-bound and runs in a pool of `encode_workers` processes; cloning, running
+    `pyserini.index` and searching mostly wait on subprocesses and I/O and run on threads.
+    Each (repo, base_commit) snapshot is indexed once and searched for all of its instances.
+
+    Args:
+        remaining_instances (list): The instances to retrieve for.
+        root_dir_name (Path): The directory holding clones and indexes.
+        document_encoding_func (function): The function to use for encoding documents.
+        python (str): The path to the Python executable.
+        token (str): The GitHub token to clone with.
+        sink (ResultSink): Where to write the results.
+        backend, incremental, cache, checkout_free, max_worktrees, encoder: See `get_index_paths`.
+        k (int, optional): The number of hits to retrieve per instance. Defaults to 20.
+        search_threads (int, optional): The number of threads per batch search. Defaults to 1.
+        chunk_aggregation (str, optional): For chunk indexes, see `search`. Defaults to None.
+        clone_workers, encode_workers, index_workers, search_workers (int, optional): The
+            concurrency of each stage.
+        queue_size (int, optional): The capacity of the queues between stages. Defaults to 8.
+        sparse_clone (bool, optional): See `get_index_paths`. Defaults to False.
+        mirror_dir (str, optional): See `get_index_paths`. Defaults to None.
+        disk_budget (DiskBudget, optional): A quota on root_dir. Clones are leased from the clone
+            stage until they are encoded, and indexes until they are searched. Defaults to None.
+
+    Returns:
+        dict: A dictionary mapping instance IDs to index paths.
+    """
+    all_index_paths = dict()
+    snapshot_instances = dict()
+    for instance in remaining_instances:
+        index_key = get_index_key(instance["repo"], instance["base_commit"])
+        snapshot_instances.setdefault(index_key, list()).append(instance)
+    snapshots = list(snapshot_instances)
+    if incremental:
+        snapshots = sorted(
+            snapshots,
+            key=lambda x: (
+                snapshot_instances[x][0]["repo"],
+                snapshot_instances[x][0].get("created_at", ""),
+            ),
+        )
+    logger.info(
+        f"Running the retrieval pipeline over {len(snapshots)} unique snapshots "
+        f"for {len(remaining_instances)} instances"
+    )
+    encode_counts = [0, 0, 0]
+    counts_lock = threading.Lock()
+    index_leases = dict()
+    if disk_budget is not None:
+        index_dirs = [Path(root_dir_name, f"index__{index_key}") for index_key in snapshots]
+        index_leases = dict(zip(snapshots, disk_budget.acquire_many(index_dirs)))
+
+    def release_index(index_key):
+        with counts_lock:
+            lease_token = index_leases.pop(index_key, None)
+        if lease_token is not None:
+            disk_budget.release(Path(root_dir_name, f"index__{index_key}"), lease_token)
+
+    def clone(index_key):
+        instance = snapshot_instances[index_key][0]
+        repo_dir = get_repo_dir(instance["repo"], root_dir_name)
+        lease_token = None
+        if disk_budget is not None:
+            lease_token = disk_budget.acquire(repo_dir)
+        try:
+            clone_repo(
+                instance["repo"],
+                root_dir_name,
+                token,
+                sparse=sparse_clone,
+                mirror_dir=mirror_dir,
+            )
+        except Exception:
+            if lease_token is not None:
+                disk_budget.release(repo_dir, lease_token)
+            raise
+        return index_key, repo_dir, lease_token
+
+    def encode(item):
+        index_key, repo_dir, lease_token = item
+        index_path = Path(root_dir_name, f"index__{index_key}", "index")
+        future = executor.submit(
+            encode_snapshot_worker,
+            snapshot_instances[index_key][0],
+            repo_dir,
+            index_path,
+            document_encoding_func,
+            backend=backend,
+            incremental=incremental,
+            cache=cache,
+            checkout_free=checkout_free,
+            max_worktrees=max_worktrees,
+            encoder=encoder,
+        )
+        try:
+            documents_path, (hits, misses, fallbacks) = future.result()
+        finally:
+            if lease_token is not None:
+                disk_budget.release(repo_dir, lease_token)
+        with counts_lock:
+            encode_counts[0] += hits
+            encode_counts[1] += misses
+            encode_counts[2] += fallbacks
+        return index_key, index_path, documents_path
+
+    def index(item):
+        index_key, index_path, documents_path = item
+        if documents_path is not None:
+            run_pyserini_index(documents_path, index_path, python)
+        return index_key, index_path
+
+    def search(item):
+        index_key, index_path = item
+        # searchers are not shared between threads, and each index is searched only once here
+        searcher_cache = SearcherCache(max_size=1)
+        try:
+            all_results = batch_search(
+                snapshot_instances[index_key],
+                index_path,
+                k=k,
+                threads=search_threads,
+                searcher_cache=searcher_cache,
+                chunk_aggregation=chunk_aggregation,
+            )
+        finally:
+            searcher_cache.close()
+            release_index(index_key)
+        return index_key, index_path, all_results
+
+    stages = [
+        Stage("clone", clone, clone_workers),
+        Stage("encode", encode, max(encode_workers, 1)),
+        Stage("index", index, index_workers),
+        Stage("search", search, search_workers),
+    ]
+    # spawn rather than fork, since the pipeline's threads are already running when the
+    # executor starts its first worker
+    mp_context = multiprocessing.get_context("spawn")
+    try:
+        with ProcessPoolExecutor(
+            max(encode_workers, 1), mp_context=mp_context
+        ) as executor, tqdm(total=len(remaining_instances), desc="Retrieving") as pbar:
+            for index_key, index_path, all_results in run_pipeline(
+                snapshots, stages, queue_size=queue_size
+            ):
+                for results in all_results:
+                    sink.write(results)
+                for instance in snapshot_instances[index_key]:
+                    all_index_paths[instance["instance_id"]] = index_path
+                pbar.update(len(snapshot_instances[index_key]))
+    finally:
+        for index_key in list(index_leases):  # snapshots that were not searched
+            release_index(index_key)
+    if cache is not None:
+        cache.hits += encode_counts[0]
+        cache.misses += encode_counts[1]
+    if encoder is not None:
+        encoder.fallbacks += encode_counts[2]
     return all_index_paths
 
 
@@ -471,8 +1825,55 @@ def main(
     num_shards,
     splits,
     leave_indexes,
+    backend,
+    incremental,
+    document_cache_path,
+    checkout_free,
+    max_worktrees,
+    num_workers,
+    k,
+    search_threads,
+    pipeline,
+    clone_workers,
+    index_workers,
+    search_workers,
+    queue_size,
+    chunks,
+    chunk_aggregation,
+    encode_workers,
+    encode_timeout,
+    sparse_clone,
+    mirror_dir,
+    disk_budget_gb,
+    ephemeral,
 ):
     document_encoding_func = DOCUMENT_ENCODING_FUNCTIONS[document_encoding_style]
+    fallback_func = file_name_and_contents
+    index_style, output_style = document_encoding_style, document_encoding_style
+    if chunks:
+        document_encoding_func = ChunkEncoder(document_encoding_func)
+        fallback_func = ChunkEncoder(fallback_func)
+        index_style = document_encoding_func.__name__
+        output_style = f"{index_style}-{chunk_aggregation}"
+    else:
+        chunk_aggregation = None
+    encoder = None
+    if encode_workers > 0 or encode_timeout is not None:
+        # the pipeline already encodes each snapshot in one of `encode_workers` processes
+        encoder = DocumentEncoder(
+            document_encoding_func,
+            fallback_func,
+            num_workers=0 if pipeline else encode_workers,
+            timeout=encode_timeout,
+        )
+    if checkout_free and needs_checkout(document_encoding_func):
+        logger.warning(
+            f"{document_encoding_style} resolves module names from the checkout, "
+            "so documents are read from checkouts despite --checkout_free"
+        )
+    cache = None
+    if document_cache_path is not None:
+        cache = DocumentCache(document_cache_path)
     token = os.environ.get("GITHUB_TOKEN", "git")
     if Path(dataset_name_or_path).exists():
         dataset = load_from_disk(dataset_name_or_path)
@@ -490,35 +1891,147 @@ def main(
         instances += list(dataset[split])
     python = subprocess.run("which python", shell=True, capture_output=True)
     python = python.stdout.decode("utf-8").strip()
-    output_file = Path(
-        output_dir, dataset_name, document_encoding_style + ".retrieval.jsonl"
-    )
+    output_file = Path(output_dir, dataset_name, output_style + ".retrieval.jsonl")
     remaining_instances = get_remaining_instances(instances, output_file)
-    root_dir, root_dir_name = get_root_dir(
-        dataset_name, output_dir, document_encoding_style
-    )
-    try:
-        all_index_paths = get_index_paths(
-            remaining_instances,
-            root_dir_name,
-            document_encoding_func,
-            python,
-            token,
-            output_file,
-        )
-    except KeyboardInterrupt:
-        logger.info(f"Cleaning up {root_dir}")
-        del_dirs = list(root_dir.glob("repo__*"))
-        if leave_indexes:
-            index_dirs = list(root_dir.glob("index__*"))
-            del_dirs += index_dirs
-        for dirname in del_dirs:
-            shutil.rmtree(dirname, ignore_errors=True)
-    logger.info(f"Finished indexing {len(all_index_paths)} instances")
-    search_indexes(remaining_instances, output_file, all_index_paths)
+    root_dir, root_dir_name = get_root_dir(dataset_name, output_dir, index_style)
+    disk_budget = None
+    if disk_budget_gb is not None:
+        disk_budget = DiskBudget(root_dir, int(disk_budget_gb * 2**30))
+    with ResultSink(output_file, shard_id=shard_id) as sink:
+        if ephemeral:
+            num_results = run_ephemeral_retrieval(
+                remaining_instances,
+                root_dir_name,
+                document_encoding_func,
+                python,
+                token,
+                sink,
+                backend=backend,
+                incremental=incremental,
+                cache=cache,
+                checkout_free=checkout_free,
+                max_worktrees=max_worktrees,
+                encoder=encoder,
+                k=k,
+                search_threads=search_threads,
+                chunk_aggregation=chunk_aggregation,
+                sparse_clone=sparse_clone,
+                mirror_dir=mirror_dir,
+                disk_budget=disk_budget,
+            )
+            logger.info(f"Finished retrieval for {num_results} instances")
+            if cache is not None:
+                cache.log_stats()
+                cache.close()
+            if encoder is not None:
+                encoder.log_stats()
+                encoder.close()
+        elif pipeline:
+            all_index_paths = run_retrieval_pipeline(
+                remaining_instances,
+                root_dir_name,
+                document_encoding_func,
+                python,
+                token,
+                sink,
+                backend=backend,
+                incremental=incremental,
+                cache=cache,
+                checkout_free=checkout_free,
+                max_worktrees=max_worktrees,
+                encoder=encoder,
+                k=k,
+                search_threads=search_threads,
+                chunk_aggregation=chunk_aggregation,
+                clone_workers=clone_workers,
+                encode_workers=encode_workers,
+                index_workers=index_workers,
+                search_workers=search_workers,
+                queue_size=queue_size,
+                sparse_clone=sparse_clone,
+                mirror_dir=mirror_dir,
+                disk_budget=disk_budget,
+            )
+            logger.info(f"Finished retrieval for {len(all_index_paths)} instances")
+            if cache is not None:
+                cache.log_stats()
+                cache.close()
+            if encoder is not None:
+                encoder.log_stats()
+                encoder.close()
+        else:
+            index_dirs, index_leases = list(), list()
+            if disk_budget is not None:
+                # every index is searched after all are built, so none may be evicted before then
+                index_dirs = sorted(
+                    {
+                        Path(root_dir_name, f"index__{get_index_key(x['repo'], x['base_commit'])}")
+                        for x in remaining_instances
+                    }
+                )
+                index_leases = disk_budget.acquire_many(index_dirs)
+            try:
+                all_index_paths = dict()
+                try:
+                    all_index_paths = get_index_paths(
+                        remaining_instances,
+                        root_dir_name,
+                        document_encoding_func,
+                        python,
+                        token,
+                        output_file,
+                        backend=backend,
+                        incremental=incremental,
+                        cache=cache,
+                        checkout_free=checkout_free,
+                        max_worktrees=max_worktrees,
+                        num_workers=num_workers,
+                        encoder=encoder,
+                        sparse_clone=sparse_clone,
+                        mirror_dir=mirror_dir,
+                        disk_budget=disk_budget,
+                    )
+                except KeyboardInterrupt:
+                    if disk_budget is not None:
+                        raise
+                    logger.info(f"Cleaning up {root_dir}")
+                    del_dirs = list(root_dir.glob("repo__*"))
+                    if leave_indexes:
+                        index_dirs = list(root_dir.glob("index__*"))
+                        del_dirs += index_dirs
+                    for dirname in del_dirs:
+                        shutil.rmtree(dirname, ignore_errors=True)
+                logger.info(f"Finished indexing {len(all_index_paths)} instances")
+                if cache is not None:
+                    cache.log_stats()
+                    cache.close()
+                if encoder is not None:
+                    encoder.log_stats()
+                    encoder.close()
+                search_indexes(
+                    remaining_instances,
+                    sink,
+                    all_index_paths,
+                    k=k,
+                    threads=search_threads,
+                    chunk_aggregation=chunk_aggregation,
+                )
+            finally:
+                if disk_budget is not None:
+                    disk_budget.release_many(index_dirs, index_leases)
+    # also merges the segments of earlier runs that stopped before merging
+    merge_segments(output_file)
     missing_ids = get_missing_ids(instances, output_file)
     logger.warning(f"Missing indexes for {len(missing_ids)} instances.")
     logger.info(f"Saved retrieval results to {output_file}")
+    if disk_budget is not None:
+        # keep the most recently used clones and indexes for later runs
+        used_bytes = disk_budget.enforce()
+        logger.info(
+            f"Keeping {used_bytes / 2**30:.2f} GiB of clones and indexes in {root_dir} "
+            f"(budget {disk_budget_gb} GiB)"
+        )
+        return
     del_dirs = list(root_dir.glob("repo__*"))
     logger.info(f"Cleaning up {root_dir}")
     if leave_indexes:
@@ -546,5 +2059,111 @@ if __name__ == "__main__":
     parser.add_argument("--shard_id", type=int)
     parser.add_argument("--num_shards", type=int, default=20)
     parser.add_argument("--leave_indexes", type=string_to_bool, default=True)
+    parser.add_argument(
+        "--backend",
+        choices=RETRIEVAL_BACKENDS,
+        default="pyserini",
+        help="Index with pyserini (Lucene) or with the in-process NumPy BM25 engine.",
+    )
+    parser.add_argument(
+        "--ephemeral",
+        type=string_to_bool,
+        default=False,
+        help="Build each index in memory (numpy) or on tmpfs (pyserini), search it once and discard it.",
+    )
+    parser.add_argument(
+        "--incremental",
+        type=string_to_bool,
+        default=False,
+        help="Reuse encoded documents across the commits of a repo and only re-encode files changed in between.",
+    )
+    parser.add_argument(
+        "--document_cache_path",
+        type=str,
+        default=None,
+        help="SQLite file caching encoded documents by git blob SHA across instances and runs.",
+    )
+    parser.add_argument(
+        "--checkout_free",
+        type=string_to_bool,
+        default=False,
+        help="Read documents with git ls-tree/cat-file instead of resetting the working tree for every instance.",
+    )
+    parser.add_argument(
+        "--sparse_clone",
+        type=string_to_bool,
+        default=False,
+        help="Clone with --filter=blob:none and a sparse checkout of *.py and README files, fetching file contents only for the commits that are read.",
+    )
+    parser.add_argument(
+        "--mirror_dir",
+        type=str,
+        default=None,
+        help="Directory of bare mirrors shared across runs and scripts. Clones borrow their objects from the mirrors with git clone --shared.",
+    )
+    parser.add_argument(
+        "--disk_budget_gb",
+        type=float,
+        default=None,
+        help="Keep clones, worktrees and indexes across runs within this many GiB, evicting the least recently used. Replaces the cleanup at the end of a run.",
+    )
+    parser.add_argument(
+        "--max_worktrees",
+        type=int,
+        default=0,
+        help="If positive, check commits out in a pool of up to this many git worktrees per repo.",
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=1,
+        help="Number of processes to index with. Each repo is indexed by a single process.",
+    )
+    parser.add_argument("--k", type=int, default=20, help="Number of hits to retrieve per instance.")
+    parser.add_argument(
+        "--search_threads",
+        type=int,
+        default=1,
+        help="Threads per batch search over instances that share an index.",
+    )
+    parser.add_argument(
+        "--pipeline",
+        type=string_to_bool,
+        default=False,
+        help="Run cloning, encoding (with --encode_workers processes, at least one), indexing and searching as concurrent stages.",
+    )
+    parser.add_argument("--clone_workers", type=int, default=2, help="Pipeline clone threads.")
+    parser.add_argument("--index_workers", type=int, default=2, help="Pipeline indexing threads.")
+    parser.add_argument("--search_workers", type=int, default=2, help="Pipeline search threads.")
+    parser.add_argument(
+        "--queue_size",
+        type=int,
+        default=8,
+        help="Capacity of the bounded queues between pipeline stages.",
+    )
+    parser.add_argument(
+        "--chunks",
+        type=string_to_bool,
+        default=False,
+        help="Index functions and classes as separate documents and aggregate their scores per file.",
+    )
+    parser.add_argument(
+        "--chunk_aggregation",
+        choices=CHUNK_AGGREGATIONS,
+        default="max",
+        help="How chunk scores are combined into a file score when --chunks is set.",
+    )
+    parser.add_argument(
+        "--encode_workers",
+        type=int,
+        default=0,
+        help="Processes used to encode the files of each snapshot. 0 encodes them in the indexing process.",
+    )
+    parser.add_argument(
+        "--encode_timeout",
+        type=float,
+        default=None,
+        help="Seconds a file may take to encode before it falls back to file_name_and_contents.",
+    )
     args = parser.parse_args()
     main(**vars(args))
@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+
+"""
+Sweeps BM25 parameters (k1, b, number of hits and query length) over one set of indexes and
+reports the recall of each setting against the files edited by each instance's patch.
+"""
+
+import os
+import re
+import json
+import itertools
+import subprocess
+import numpy as np
+from argparse import ArgumentParser
+from datasets import load_from_disk, load_dataset
+from pathlib import Path
+from tqdm.auto import tqdm
+
+try:
+    from bm25_retrieval import DOCUMENT_ENCODING_FUNCTIONS, DocumentCache
+    from bm25_retrieval import get_root_dir, get_index_paths, SearcherCache
+    from bm25_engine import BM25Index, compile_query
+    from utils import string_to_bool
+except:
+    from .bm25_retrieval import DOCUMENT_ENCODING_FUNCTIONS, DocumentCache
+    from .bm25_retrieval import get_root_dir, get_index_paths, SearcherCache
+    from .bm25_engine import BM25Index, compile_query
+    from .utils import string_to_bool
+
+import logging
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+logger = logging.getLogger(__name__)
+
+PATCH_FILES_PATTERN = re.compile(r"\-\-\- a/(.+)")
+
+
+def get_gold_files(instance):
+    return set(PATCH_FILES_PATTERN.findall(instance["patch"]))
+
+
+def get_setting_name(k1, b, k, max_query_terms):
+    return f"k1-{k1}__b-{b}__k-{k}__qt-{max_query_terms}"
+
+
+def sweep_index(instances, index_path, searcher_cache, k1s, bs, ks, query_term_limits):
+    """
+    Searches one index for its instances under every setting of the grid.
+
+    Each (k1, b, query length) setting is scored once with the largest k, and the smaller ks
+    are prefixes of that ranking, so the index is loaded once and every search is a rescoring
+    of the stored term frequencies.
+
+    Returns:
+        dict: Maps each setting name to the results of the instances, in order.
+    """
+    if not BM25Index.exists(index_path):
+        raise ValueError(
+            f"{index_path} is a pyserini index; sweeps need indexes built with --backend numpy"
+        )
+    index = searcher_cache.get(index_path)
+    max_k = max(ks)
+    all_results = dict()
+    for max_query_terms in query_term_limits:
+        queries = [
+            compile_query(instance["problem_statement"], max_terms=max_query_terms)
+            for instance in instances
+        ]
+        for k1, b in itertools.product(k1s, bs):
+            hits = [index.search(query, k=max_k, k1=k1, b=b) for query in queries]
+            for k in ks:
+                all_results[get_setting_name(k1, b, k, max_query_terms)] = [
+                    {
+                        "instance_id": instance["instance_id"],
+                        "hits": [
+                            {"docid": hit.docid, "score": hit.score}
+                            for hit in instance_hits[:k]
+                        ],
+                    }
+                    for instance, instance_hits in zip(instances, hits)
+                ]
+    return all_results
+
+
+def get_recalls(instances, results):
+    """
+    Returns the average recall, the fraction of instances with all gold files retrieved and the
+    fraction with any gold file retrieved, as in eval_retrieval.py.
+    """
+    recalls = list()
+    for instance, instance_results in zip(instances, results):
+        gold_files = get_gold_files(instance)
+        if not gold_files:
+            continue
+        retrieved_files = {hit["docid"] for hit in instance_results["hits"]}
+        recalls.append(len(retrieved_files & gold_files) / len(gold_files))
+    recalls = np.array(recalls)
+    if len(recalls) == 0:
+        return {"avg_recall": 0.0, "all_recall": 0.0, "any_recall": 0.0, "num_instances": 0}
+    return {
+        "avg_recall": float(np.mean(recalls)),
+        "all_recall": float(np.mean(recalls == 1)),
+        "any_recall": float(np.mean(recalls > 0)),
+        "num_instances": len(recalls),
+    }
+
+
+def run_sweep(instances_by_index, sweep_dir, k1s, bs, ks, query_term_limits):
+    """
+    Sweeps every index and writes one retrieval file per setting and a `summary.json` of the
+    recall of each setting to `sweep_dir`. Indexes that are not numpy indexes are skipped.
+
+    Args:
+        instances_by_index (dict): Maps each index path to the instances to search it for.
+        sweep_dir (Path): The directory to write the results to.
+        k1s, bs, ks, query_term_limits (list): The values of each parameter to sweep.
+
+    Returns:
+        list: The summary rows, best average recall first.
+    """
+    settings = [
+        get_setting_name(*setting)
+        for setting in itertools.product(k1s, bs, ks, query_term_limits)
+    ]
+    sweep_dir.mkdir(parents=True, exist_ok=True)
+    out_files = {
+        setting: open(Path(sweep_dir, f"{setting}.retrieval.jsonl"), "w")
+        for setting in settings
+    }
+    searcher_cache = SearcherCache(max_size=1)
+    swept_instances = list()
+    all_setting_results = {setting: list() for setting in settings}
+    try:
+        for index_path, index_instances in tqdm(
+            instances_by_index.items(), desc="Sweeping"
+        ):
+            try:
+                setting_results = sweep_index(
+                    index_instances,
+                    Path(index_path),
+                    searcher_cache,
+                    k1s,
+                    bs,
+                    ks,
+                    query_term_limits,
+                )
+            except ValueError as e:
+                logger.warning(f"Skipping {len(index_instances)} instances: {e}")
+                continue
+            swept_instances += index_instances
+            for setting, results in setting_results.items():
+                all_setting_results[setting] += results
+                out_files[setting].write(
+                    "".join(json.dumps(result) + "\n" for result in results)
+                )
+    finally:
+        for out_file in out_files.values():
+            out_file.close()
+        searcher_cache.close()
+    summary = list()
+    for setting in settings:
+        recalls = get_recalls(swept_instances, all_setting_results[setting])
+        summary.append({"setting": setting, **recalls})
+    summary.sort(key=lambda x: -x["avg_recall"])
+    summary_file = Path(sweep_dir, "summary.json")
+    with open(summary_file, "w") as f:
+        json.dump(summary, f, indent=2)
+    for row in summary[:10]:
+        logger.info(
+            f"{row['setting']}: avg {row['avg_recall']*100:.2f} / all {row['all_recall']*100:.2f} / any {row['any_recall']*100:.2f}"
+        )
+    logger.info(f"Saved {len(settings)} retrieval files and {summary_file}")
+    return summary
+
+
+def main(
+    dataset_name_or_path,
+    document_encoding_style,
+    output_dir,
+    splits,
+    k1,
+    b,
+    k,
+    max_query_terms,
+    document_cache_path,
+    checkout_free,
+    num_workers,
+):
+    document_encoding_func = DOCUMENT_ENCODING_FUNCTIONS[document_encoding_style]
+    cache = None
+    if document_cache_path is not None:
+        cache = DocumentCache(document_cache_path)
+    token = os.environ.get("GITHUB_TOKEN", "git")
+    if Path(dataset_name_or_path).exists():
+        dataset = load_from_disk(dataset_name_or_path)
+        dataset_name = os.path.basename(dataset_name_or_path)
+    else:
+        dataset = load_dataset(dataset_name_or_path)
+        dataset_name = dataset_name_or_path.replace("/", "__")
+    if set(splits) - set(dataset.keys()) != set():
+        raise ValueError(f"Unknown splits {set(splits) - set(dataset.keys())}")
+    instances = list()
+    for split in splits:
+        instances += list(dataset[split])
+    python = subprocess.run("which python", shell=True, capture_output=True)
+    python = python.stdout.decode("utf-8").strip()
+    # a root of its own, since the indexes under get_root_dir may have been built by pyserini
+    root_dir, root_dir_name = get_root_dir(
+        dataset_name, output_dir, f"{document_encoding_style}_sweep"
+    )
+    # term statistics are stored raw, so one numpy index per snapshot serves every setting
+    all_index_paths = get_index_paths(
+        instances,
+        root_dir_name,
+        document_encoding_func,
+        python,
+        token,
+        None,
+        backend="numpy",
+        cache=cache,
+        checkout_free=checkout_free,
+        num_workers=num_workers,
+    )
+    if cache is not None:
+        cache.log_stats()
+        cache.close()
+    instances_by_index = dict()
+    for instance in instances:
+        if instance["instance_id"] in all_index_paths:
+            index_key = Path(all_index_paths[instance["instance_id"]]).as_posix()
+            instances_by_index.setdefault(index_key, list()).append(instance)
+    sweep_dir = Path(output_dir, dataset_name, f"{document_encoding_style}_sweep")
+    run_sweep(instances_by_index, sweep_dir, k1, b, k, max_query_terms)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--dataset_name_or_path",
+        type=str,
+        default="princeton-nlp/SWE-bench",
+        help="Dataset to use for test set from HuggingFace Datasets or path to a save_to_disk directory.",
+    )
+    parser.add_argument(
+        "--document_encoding_style",
+        choices=DOCUMENT_ENCODING_FUNCTIONS.keys(),
+        default="file_name_and_contents",
+    )
+    parser.add_argument("--output_dir", default="./retreival_results")
+    parser.add_argument("--splits", nargs="+", default=["test"])
+    parser.add_argument("--k1", type=float, nargs="+", default=[0.6, 0.9, 1.2, 1.5])
+    parser.add_argument("--b", type=float, nargs="+", default=[0.3, 0.4, 0.6, 0.75])
+    parser.add_argument("--k", type=int, nargs="+", default=[5, 10, 20, 50])
+    parser.add_argument(
+        "--max_query_terms",
+        type=int,
+        nargs="+",
+        default=[64, 128, 512],
+        help="Query length cutoffs, in compiled query terms.",
+    )
+    parser.add_argument("--document_cache_path", type=str, default=None)
+    parser.add_argument("--checkout_free", type=string_to_bool, default=False)
+    parser.add_argument("--num_workers", type=int, default=1)
+    args = parser.parse_args()
+    main(**vars(args))
@@ -0,0 +1,198 @@
+"""
+Function- and class-level chunks for BM25 retrieval.
+
+With chunking, each Python file is split at the boundaries of its top-level functions and
+classes (and of the methods of classes that are too long to keep whole), every chunk is
+indexed as its own document, and the chunk hits of a query are aggregated back to file-level
+hits. Each file hit keeps the line spans of its matching chunks, so prompt builders can
+include just those regions instead of the whole file.
+
+Chunk document IDs have the form `<relative_path>::L<start>-L<end>`, with 1-based,
+inclusive line numbers.
+"""
+
+import ast
+import json
+import re
+import logging
+import textwrap
+
+try:
+    from file_ingestion import read_file
+except:
+    from .file_ingestion import read_file
+
+logger = logging.getLogger(__name__)
+
+CHUNK_AGGREGATIONS = ["max", "sum"]
+MAX_CHUNK_LINES = 200
+CHUNK_ID_PATTERN = re.compile(r"^(.*)::L(\d+)-L(\d+)$")
+# the line ends that `ast` line numbers count
+LINE_END_PATTERN = re.compile(r"\r\n?|\n")
+# chunk hits retrieved per requested file hit, since several chunks of a file can match
+CHUNK_OVERSAMPLING = 5
+
+
+def make_chunk_id(relative_path, start, end):
+    return f"{relative_path}::L{start}-L{end}"
+
+
+def parse_chunk_id(docid):
+    """
+    Returns (relative_path, start, end) for a chunk ID and (docid, None, None) for a file ID.
+    """
+    match = CHUNK_ID_PATTERN.match(docid)
+    if match is None:
+        return docid, None, None
+    return match.group(1), int(match.group(2)), int(match.group(3))
+
+
+def split_lines(source):
+    """
+    Splits source code into lines at "\n", "\r\n" and "\r", the line ends that `ast` line
+    numbers count, unlike `str.splitlines`, which also splits at e.g. form feeds.
+    """
+    lines = LINE_END_PATTERN.split(source)
+    if lines[-1] == "":  # after the newline at the end of the last line
+        lines.pop()
+    return lines
+
+
+def _node_start(node):
+    if getattr(node, "decorator_list", None):
+        return min(decorator.lineno for decorator in node.decorator_list)
+    return node.lineno
+
+
+def _split_body(body, first_line, last_line, max_chunk_lines):
+    """
+    Splits the lines first_line..last_line, holding the statements `body`, into spans. Each
+    function or class gets its own span and the statements between them are grouped together.
+    """
+    spans = list()
+    start = first_line
+    for node in body:
+        if not isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            continue
+        node_start, node_end = _node_start(node), node.end_lineno
+        if node_start > start:
+            spans.append((start, node_start - 1))
+        if isinstance(node, ast.ClassDef) and node_end - node_start + 1 > max_chunk_lines:
+            spans.extend(_split_body(node.body, node_start, node_end, max_chunk_lines))
+        else:
+            spans.append((node_start, node_end))
+        start = node_end + 1
+    if start <= last_line:
+        spans.append((start, last_line))
+    return spans
+
+
+def split_into_chunks(source, max_chunk_lines=MAX_CHUNK_LINES):
+    """
+    Splits Python source code at function and class boundaries.
+
+    Args:
+        source (str): The source code.
+        max_chunk_lines (int, optional): Classes longer than this are split into their methods.
+
+    Returns:
+        list: (start, end) line spans, 1-based and inclusive, covering every line of the source.
+            Files that fail to parse are returned as a single span.
+    """
+    lines = split_lines(source)
+    if not lines:
+        return [(1, 1)]
+    try:
+        tree = ast.parse(source)
+    except (SyntaxError, ValueError):
+        return [(1, len(lines))]
+    spans = _split_body(tree.body, 1, len(lines), max_chunk_lines)
+    # drop spans of blank lines only, e.g. between two functions
+    return [
+        (start, end)
+        for start, end in spans
+        if any(line.strip() for line in lines[start - 1 : end])
+    ] or [(1, len(lines))]
+
+
+class ChunkEncoder:
+    """
+    Wraps one of the DOCUMENT_ENCODING_FUNCTIONS to encode each chunk of a file separately.
+
+    Called like the wrapped function, it returns a JSON list of [start, end, text] entries,
+    so the chunks of a file are cached and diffed as a single document until `expand_document`
+    splits them into index documents.
+
+    Args:
+        document_encoding_func (function): The function used to encode each chunk.
+        max_chunk_lines (int, optional): See `split_into_chunks`.
+    """
+
+    def __init__(self, document_encoding_func, max_chunk_lines=MAX_CHUNK_LINES):
+        self.document_encoding_func = document_encoding_func
+        self.max_chunk_lines = max_chunk_lines
+        self.__name__ = f"{document_encoding_func.__name__}__chunks"
+
+    def __call__(self, filename, relative_path, source=None):
+        if source is None:
+            source = read_file(filename)[0]
+        lines = split_lines(source)
+        chunks = list()
+        for start, end in split_into_chunks(source, self.max_chunk_lines):
+            # the methods of a class that is split are indented
+            chunk_source = "".join(line + "\n" for line in lines[start - 1 : end])
+            chunk_source = textwrap.dedent(chunk_source)
+            text = self.document_encoding_func(filename, relative_path, source=chunk_source)
+            chunks.append([start, end, text])
+        return json.dumps(chunks)
+
+
+def expand_document(relative_path, text, chunked):
+    """
+    Returns the index documents of one encoded file as a list of (docid, text).
+
+    Args:
+        relative_path (str): The path of the file relative to the repository root.
+        text (str): The encoded document, as returned by the encoding function.
+        chunked (bool): Whether `text` was encoded by a `ChunkEncoder`.
+    """
+    if not chunked:
+        return [(relative_path, text)]
+    return [
+        (make_chunk_id(relative_path, start, end), chunk_text)
+        for start, end, chunk_text in json.loads(text)
+    ]
+
+
+def aggregate_hits(hits, k, aggregation="max"):
+    """
+    Aggregates chunk hits into file hits.
+
+    Args:
+        hits (list): Hits with `docid` and `score`, as returned by a searcher of a chunk index.
+        k (int): The number of file hits to return.
+        aggregation (str, optional): How chunk scores are combined per file, one of
+            CHUNK_AGGREGATIONS. Defaults to "max".
+
+    Returns:
+        list: Dictionaries with the file `docid`, its aggregated `score` and the `spans` of its
+            matching chunks, each with `start`, `end` and `score`, sorted by descending score.
+    """
+    if aggregation not in CHUNK_AGGREGATIONS:
+        raise ValueError(f"Unknown chunk aggregation {aggregation}")
+    files = dict()
+    for hit in hits:
+        relative_path, start, end = parse_chunk_id(hit.docid)
+        file_hit = files.setdefault(
+            relative_path, {"docid": relative_path, "score": 0.0, "spans": list()}
+        )
+        if aggregation == "max":
+            file_hit["score"] = max(file_hit["score"], hit.score)
+        else:
+            file_hit["score"] += hit.score
+        if start is not None:
+            file_hit["spans"].append({"start": start, "end": end, "score": hit.score})
+    file_hits = sorted(files.values(), key=lambda x: -x["score"])[:k]
+    for file_hit in file_hits:
+        file_hit["spans"].sort(key=lambda x: x["start"])
+    return file_hits
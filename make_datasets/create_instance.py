@@ -2,6 +2,8 @@ import json
 import logging
 import os
 import traceback
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 from pathlib import Path
 from tempfile import TemporaryDirectory
@@ -11,9 +13,11 @@ from tqdm.auto import tqdm
 try:
     from tokenize_dataset import TOKENIZER_FUNCS
     from utils import AutoContextManager, ingest_directory_contents
+    from file_ingestion import read_files
 except:
     from .tokenize_dataset import TOKENIZER_FUNCS
     from .utils import AutoContextManager, ingest_directory_contents
+    from .file_ingestion import read_files
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
 logger = logging.getLogger(__name__)
@@ -163,6 +167,45 @@ def make_code_text_edits_only(files_dict, patch, add_line_numbers=True):
     return all_text.strip("\n")
 
 
+def get_hit_spans(instance):
+    """
+    Returns the 1-based, inclusive line spans of each retrieved file that came from a chunk index
+    """
+    return {
+        hit["docid"]: [(span["start"], span["end"]) for span in hit["spans"]]
+        for hit in instance.get("hits", list())
+        if hit.get("spans")
+    }
+
+
+def make_code_text_spans(files_dict, spans, add_line_numbers=True):
+    """
+    Like make_code_text, but only includes the given line spans of files that have any
+    """
+    all_text = ""
+    for filename, contents in sorted(files_dict.items()):
+        if filename not in spans:
+            all_text += make_code_text({filename: contents}, add_line_numbers) + "\n"
+            continue
+        all_text += f"[start of {filename}]\n"
+        if add_line_numbers:
+            content_lines = add_lines_list(contents)
+        else:
+            content_lines = contents.split("\n")
+        last_end = 0
+        for start, end in sorted(spans[filename]):
+            if start > last_end + 1:
+                all_text += "...\n"
+            all_text += "\n".join(content_lines[max(start - 1, last_end) : end])
+            all_text += "\n"
+            last_end = max(last_end, end)
+        if last_end < len(content_lines):
+            all_text += "...\n"
+        all_text = all_text.strip("\n")
+        all_text += f"\n[end of {filename}]\n"
+    return all_text.strip("\n")
+
+
 def prompt_style_2(instance):
     premise = "You will be provided with a partial code base and an issue statement explaining a problem to resolve."
     readmes_text = make_code_text(instance["readmes"])
@@ -257,6 +300,44 @@ def prompt_style_3(instance):
     return final_text
 
 
+def prompt_style_3_spans(instance):
+    premise = "You will be provided with a partial code base and an issue statement explaining a problem to resolve."
+    readmes_text = make_code_text(instance["readmes"])
+    code_text = make_code_text_spans(instance["file_contents"], get_hit_spans(instance))
+    example_explanation = (
+        f"Here is an example of a patch file. It consists of changes to the code base. "
+        + f"It specifies the file names, the line numbers of each change, and the removed and added lines. "
+        + f"A single patch file can contain changes to multiple files."
+    )
+    final_instruction = (
+        f"I need you to solve the provided issue by generating a single patch file that I can apply "
+        + f"directly to this repository using git apply. Please respond with a single patch "
+        + f"file in the format shown above."
+    )
+    problem_statement = instance["problem_statement"]
+    final_text = [
+        premise,
+        "<issue>",
+        problem_statement,
+        "</issue>",
+        "",
+        "<code>",
+        readmes_text,
+        code_text,
+        "</code>",
+        "",
+        example_explanation,
+        "<patch>",
+        PATCH_EXAMPLE,
+        "</patch>",
+        "",
+        final_instruction,
+        "Respond below:",
+    ]
+    final_text = "\n".join(final_text)
+    return final_text
+
+
 def full_file_gen(instance):
     premise = "You will be provided with a partial code base and an issue statement explaining a problem to resolve."
     readmes_text = make_code_text(instance["readmes"], add_line_numbers=False)
@@ -285,11 +366,19 @@ def full_file_gen(instance):
     return final_text
 
 
-def ingest_files(filenames):
+def ingest_files(filenames, reader=None, commit=None, root_dir=None):
+    """
+    Reads the given files, from the working tree or, if `reader` is given, from `commit` in the git object database.
+    Relative filenames are read from `root_dir`, if given, rather than from the current directory.
+    """
+    if reader is None:
+        paths = filenames if root_dir is None else [os.path.join(root_dir, f) for f in filenames]
+        return {filename: text for filename, (text, _) in zip(filenames, read_files(paths))}
     files_dict = dict()
     for filename in filenames:
-        with open(filename) as f:
-            content = f.read()
+        content = reader.read_text(f"{commit}:{filename}")
+        if content is None:
+            raise FileNotFoundError(f"{filename} not found in {commit}")
         files_dict[filename] = content
     return files_dict
 
@@ -297,6 +386,7 @@ def ingest_files(filenames):
 PROMPT_FUNCTIONS = {
     "style-2": prompt_style_2,
     "style-3": prompt_style_3,
+    "style-3-spans": prompt_style_3_spans,
     "full_file_gen": full_file_gen,
     "style-2-edits-only": prompt_style_2_edits_only,
 }
@@ -338,6 +428,66 @@ def get_oracle_filenames(instance):
     return gold_docs
 
 
+def make_text_inputs(
+    instance,
+    cm,
+    prompt_style,
+    file_source,
+    max_context_len=None,
+    tokenizer_name=None,
+):
+    """
+    Reads the context files of an instance through an entered ContextManager and returns its
+    prompt. `instance` gets the `readmes` and `file_contents` fields. See `add_text_inputs`.
+    """
+    instance["readmes"] = cm.read_files(cm.get_readme_files())
+    if max_context_len is not None:
+        tokenizer, tokenizer_func = TOKENIZER_FUNCS[tokenizer_name]
+        instance["file_contents"] = dict()
+        base_text_inputs = PROMPT_FUNCTIONS[prompt_style](instance)
+        base_text_input_length = len(tokenizer_func(base_text_inputs, tokenizer))
+    if file_source in {"oracle"}:
+        instance["file_contents"] = cm.read_files(get_oracle_filenames(instance))
+    elif file_source in {"bm25"}:
+        instance["file_contents"] = cm.read_files([x["docid"] for x in instance["hits"]])
+    elif file_source in {"all"}:
+        instance["file_contents"] = ingest_directory_contents(
+            cm.repo_path, reader=cm.reader, commit=cm.base_commit
+        )
+    elif file_source in {"none"}:
+        instance["file_contents"] = dict()
+    else:
+        raise ValueError(f"Invalid file source {file_source}")
+    if max_context_len is not None:
+        cur_input_len = base_text_input_length
+        include_files = list()
+        hit_spans = get_hit_spans(instance)
+        for filename in [x["docid"] for x in instance["hits"]]:
+            if prompt_style == "style-3-spans":
+                content = make_code_text_spans(
+                    {filename: instance["file_contents"][filename]},
+                    hit_spans,
+                )
+            else:
+                content = make_code_text({filename: instance["file_contents"][filename]})
+            if tokenizer_name in {"llama"}:
+                tokens = tokenizer_func("\n" + content, tokenizer)
+                idx = tokens.index(13)
+                assert (
+                    idx <= 2
+                ), "Expected newline token id (13) to be one of the first three tokens"
+                tokens = tokens[idx + 1 :]  # remove newline tokens
+            else:
+                tokens = tokenizer_func(content, tokenizer)
+            if cur_input_len + len(tokens) < max_context_len:
+                include_files.append(filename)
+                cur_input_len += len(tokens)
+        instance["file_contents"] = {
+            filename: instance["file_contents"][filename] for filename in include_files
+        }
+    return PROMPT_FUNCTIONS[prompt_style](instance)
+
+
 def add_text_inputs(
     input_instances,
     retrieval_file,
@@ -347,6 +497,11 @@ def add_text_inputs(
     max_context_len=None,
     tokenizer_name=None,
     verbose=False,
+    checkout=True,
+    max_worktrees=0,
+    sparse_clone=False,
+    mirror_dir=None,
+    num_threads=1,
 ):
     """Adds text inputs context for prediction in-place.
 
@@ -357,83 +512,57 @@ def add_text_inputs(
     - prompt_style: specify the function to generate instructions and prompt provided an instance (from PROMPT_FUNCTIONS)
     - file_source: where to collect file_contents (e.g. oracle or bm25)
     - verbose: set ContextManager verbose to True
+    - checkout: if False, read files from the git object database instead of checking out each base_commit
+    - max_worktrees: if positive, check out base_commits in a shared pool of git worktrees per repo
+    - sparse_clone: if True, clone partially, fetching only the Python files and READMEs of the base_commits
+    - mirror_dir: if given, clone from persistent bare mirrors in this directory instead of downloading each repo
+    - num_threads: the number of repos to process at once; the instances of one repo are processed in order
     """
     if max_context_len is not None:
         assert (
             tokenizer_name is not None
         ), "Must specify tokenizer_name if using max_context_len"
-        tokenizer, tokenizer_func = TOKENIZER_FUNCS[tokenizer_name]
     input_instances_copy = deepcopy(input_instances)
     if file_source in {"bm25"}:
         add_retrieval_results(input_instances_copy, retrieval_file, k, file_source)
-    orig_dir = os.getcwd()
+    instances_by_repo = defaultdict(list)
+    for instance_id, instance in input_instances_copy.items():
+        instances_by_repo[instance["repo"]].append((instance_id, instance))
+    context_kwargs = dict(
+        verbose=verbose,
+        checkout=checkout,
+        max_worktrees=max_worktrees,
+        sparse=sparse_clone,
+        mirror_dir=mirror_dir,
+    )
     with TemporaryDirectory(
         dir="/scratch" if os.path.exists("/scratch") else "/tmp"
-    ) as root_dir:
-        for instance_id, instance in tqdm(
-            input_instances_copy.items(),
-            total=len(input_instances_copy),
-            desc="Adding text inputs",
-        ):
-            try:
-                with AutoContextManager(
-                    instance, root_dir, verbose=verbose
-                ) as cm:
-                    readmes = cm.get_readme_files()
-                    instance["readmes"] = ingest_files(readmes)
-                    if max_context_len is not None:
-                        instance["file_contents"] = dict()
-                        base_text_inputs = PROMPT_FUNCTIONS[prompt_style](instance)
-                        base_text_input_length = len(
-                            tokenizer_func(base_text_inputs, tokenizer)
+    ) as root_dir, tqdm(
+        total=len(input_instances_copy), desc="Adding text inputs"
+    ) as progress:
+
+        def add_repo_text_inputs(repo_instances):
+            for instance_id, instance in repo_instances:
+                try:
+                    with AutoContextManager(instance, root_dir, **context_kwargs) as cm:
+                        input_instances[instance_id]["text_inputs"] = make_text_inputs(
+                            instance,
+                            cm,
+                            prompt_style,
+                            file_source,
+                            max_context_len=max_context_len,
+                            tokenizer_name=tokenizer_name,
                         )
-                    if file_source in {"oracle"}:
-                        instance["file_contents"] = ingest_files(
-                            get_oracle_filenames(instance)
-                        )
-                    elif file_source in {"bm25"}:
-                        instance["file_contents"] = ingest_files(
-                            [x["docid"] for x in instance["hits"]]
-                        )
-                    elif file_source in {"all"}:
-                        instance["file_contents"] = ingest_directory_contents(
-                            cm.repo_path
-                        )
-                    elif file_source in {"none"}:
-                        instance["file_contents"] = dict()
-                    else:
-                        raise ValueError(f"Invalid file source {file_source}")
-                    if max_context_len is not None:
-                        cur_input_len = base_text_input_length
-                        include_files = list()
-                        for filename in [x["docid"] for x in instance["hits"]]:
-                            content = make_code_text(
-                                {filename: instance["file_contents"][filename]}
-                            )
-                            if tokenizer_name in {"llama"}:
-                                tokens = tokenizer_func("\n" + content, tokenizer)
-                                idx = tokens.index(13)
-                                assert (
-                                    idx <= 2
-                                ), "Expected newline token id (13) to be one of the first three tokens"
-                                tokens = tokens[idx + 1 :]  # remove newline tokens
-                            else:
-                                tokens = tokenizer_func(content, tokenizer)
-                            if cur_input_len + len(tokens) < max_context_len:
-                                include_files.append(filename)
-                                cur_input_len += len(tokens)
-                        instance["file_contents"] = {
-                            filename: instance["file_contents"][filename]
-                            for filename in include_files
-                        }
-                    input_instances[instance_id]["text_inputs"] = PROMPT_FUNCTIONS[
-                        prompt_style
-                    ](instance)
-            except Exception as e:
-                print(f"Failed on instance {instance_id}", e)
-                traceback.print_exc()
-                input_instances[instance_id]["text_inputs"] = None
-            finally:
-                # if AutoContextManager fails to exit properly future exits will return the wrong directory
-                os.chdir(orig_dir)
-    os.chdir(orig_dir)
+                except Exception as e:
+                    print(f"Failed on instance {instance_id}", e)
+                    traceback.print_exc()
+                    input_instances[instance_id]["text_inputs"] = None
+                progress.update()
+
+        # each repo has one checkout, so the instances of a repo never run at the same time
+        if num_threads > 1:
+            with ThreadPoolExecutor(num_threads) as executor:
+                list(executor.map(add_repo_text_inputs, instances_by_repo.values()))
+        else:
+            for repo_instances in instances_by_repo.values():
+                add_repo_text_inputs(repo_instances)
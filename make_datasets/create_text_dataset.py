@@ -83,6 +83,10 @@ def main(
     max_context_len,
     tokenizer_name,
     push_to_hub_user,
+    checkout_free,
+    sparse_clone,
+    mirror_dir,
+    num_threads,
 ):
     if push_to_hub_user is not None:
         hub_token = os.environ.get("HUGGING_FACE_HUB_TOKEN", None)
@@ -90,6 +94,10 @@ def main(
         assert output_dir is None, "Cannot provide output_dir if pushing to the Hub"
     if max_context_len is not None:
         assert tokenizer_name is not None
+    # oracle files may be outside the sparse patterns, which only checkout-free reads can fetch
+    assert not (
+        sparse_clone and file_source == "oracle" and not checkout_free
+    ), "Must use checkout_free with sparse_clone and the oracle file source"
     if push_to_hub_user is None and not Path(output_dir).exists():
         Path(output_dir).mkdir(parents=True)
     output_file = f"SWE-bench__{prompt_style}__fs-{file_source}"
@@ -132,6 +140,10 @@ def main(
             file_source,
             max_context_len=max_context_len,
             tokenizer_name=tokenizer_name,
+            checkout=not checkout_free,
+            sparse_clone=sparse_clone,
+            mirror_dir=mirror_dir,
+            num_threads=num_threads,
         )
     columns = [
         "instance_id",
@@ -244,4 +256,28 @@ if __name__ == "__main__":
         type=str,
         help="Username to use for pushing to the Hub. If not provided, will save to disk.",
     )
+    parser.add_argument(
+        "--checkout_free",
+        type=string_to_bool,
+        default=False,
+        help="Read files from the git object database instead of checking out each base_commit.",
+    )
+    parser.add_argument(
+        "--sparse_clone",
+        type=string_to_bool,
+        default=False,
+        help="Clone with --filter=blob:none and a sparse checkout of *.py and README files, fetching file contents only for the commits that are read.",
+    )
+    parser.add_argument(
+        "--mirror_dir",
+        type=str,
+        default=None,
+        help="Directory of bare mirrors shared across runs and scripts. Clones borrow their objects from the mirrors with git clone --shared.",
+    )
+    parser.add_argument(
+        "--num_threads",
+        type=int,
+        default=1,
+        help="Number of repositories to clone and read at once.",
+    )
     main(**vars(parser.parse_args()))
@@ -0,0 +1,285 @@
+"""
+A disk quota for the clones, worktrees and indexes that bm25_retrieval.py keeps in its root_dir.
+
+`bm25_retrieval.main` used to delete every `repo__*` directory at the end of a run, and either
+every `index__*` directory or none of them, depending on `--leave_indexes`. That cleanup fills
+the disk during a long run and throws away clones and indexes a later run could reuse.
+`DiskBudget` records the size and last use of every clone (together with its
+`.worktrees` pool) and every index. Whenever the total exceeds `max_bytes`, it evicts the least
+recently used entries that no one is using.
+
+An entry is in use while it is leased. Leases are tokens recorded in a JSON file guarded by a
+FileLock, like the leases of `WorktreePool`. They are tagged with the pid of their owner, so
+the leases of processes that died are ignored. Evicted directories are renamed away while the
+lock is held and deleted after it is released. A process that checks for a directory under a
+lease therefore never sees it half deleted.
+"""
+
+import os
+import json
+import time
+import uuid
+import shutil
+import logging
+from contextlib import contextmanager
+from filelock import FileLock
+from pathlib import Path
+
+try:
+    from worktree_pool import _pid_alive
+except:
+    from .worktree_pool import _pid_alive
+
+logger = logging.getLogger(__name__)
+
+# the top-level directories of a root_dir that count against the budget
+ENTRY_PREFIXES = ("repo__", "index__")
+WORKTREES_SUFFIX = ".worktrees"
+EVICTED_PREFIX = ".evicted__"
+
+
+def get_disk_usage(path):
+    """
+    Returns the number of bytes allocated to the files under `path`, without following symlinks.
+    """
+    total = 0
+    stack = [Path(path).as_posix()]
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except (FileNotFoundError, NotADirectoryError, PermissionError):
+            continue
+        with entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    else:
+                        total += entry.stat(follow_symlinks=False).st_blocks * 512
+                except FileNotFoundError:
+                    continue
+    return total
+
+
+class DiskBudget:
+    """
+    Keeps the clones, worktrees and indexes under `root_dir` within `max_bytes`, evicting the
+    least recently used ones that are not leased.
+
+    Args:
+        root_dir (str): The directory holding `repo__*` clones and `index__*` indexes.
+        max_bytes (int): The quota. Leased entries are never evicted, so the quota can be
+            exceeded while more than `max_bytes` are in use.
+
+    Methods:
+        acquire(path): Leases the entry holding `path` and returns a lease token.
+        release(path, token): Ends a lease, measures the entry and enforces the quota.
+        acquire_many(paths), release_many(paths, tokens): The same for several entries at once.
+        lease(path): Context manager around acquire and release.
+        enforce(): Evicts entries until the quota is met.
+    """
+
+    STATE_FILE = ".disk_budget.json"
+
+    def __init__(self, root_dir, max_bytes):
+        self.root_dir = Path(root_dir).resolve()
+        self.max_bytes = max_bytes
+        self.root_dir.mkdir(parents=True, exist_ok=True)
+        self.lock = FileLock(Path(self.root_dir, ".disk_budget.lock").as_posix())
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["lock"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = FileLock(Path(self.root_dir, ".disk_budget.lock").as_posix())
+
+    @property
+    def state_path(self):
+        return Path(self.root_dir, self.STATE_FILE)
+
+    def _load_state(self):
+        if not self.state_path.exists():
+            return dict()
+        with open(self.state_path) as f:
+            return json.load(f)
+
+    def _save_state(self, state):
+        tmp_path = self.state_path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.state_path)
+
+    def get_entry_name(self, path):
+        """
+        Returns the name of the entry that `path` belongs to: the top-level directory of
+        root_dir containing it, where a clone's worktree pool belongs to the clone.
+        """
+        name = Path(path).resolve().relative_to(self.root_dir).parts[0]
+        if name.endswith(WORKTREES_SUFFIX):
+            name = name[: -len(WORKTREES_SUFFIX)]
+        return name
+
+    def get_entry_paths(self, name):
+        paths = [Path(self.root_dir, name)]
+        if name.startswith("repo__"):
+            paths.append(Path(self.root_dir, name + WORKTREES_SUFFIX))
+        return paths
+
+    def _measure(self, name):
+        return sum(get_disk_usage(path) for path in self.get_entry_paths(name))
+
+    def _is_leased(self, entry):
+        return any(_pid_alive(pid) for pid in entry["leases"].values())
+
+    def acquire(self, path, pid=None):
+        """
+        Leases the entry holding `path`, which need not exist yet, so it is not evicted.
+
+        Args:
+            path (str): A clone, worktree or index directory under root_dir, or a path inside one.
+            pid (int, optional): The process the lease belongs to. Defaults to this process.
+
+        Returns:
+            str: The token to pass to `release`.
+        """
+        return self.acquire_many([path], pid=pid)[0]
+
+    def acquire_many(self, paths, pid=None):
+        """
+        Leases several entries at once. See `acquire`.
+
+        Returns:
+            list: A token per path.
+        """
+        tokens = list()
+        with self.lock:
+            state = self._load_state()
+            now = time.time()
+            for path in paths:
+                name = self.get_entry_name(path)
+                # the size of an entry first seen here is measured by the next _sync
+                entry = state.setdefault(name, {"size": None, "last_used": now, "leases": {}})
+                token = uuid.uuid4().hex
+                entry["leases"][token] = pid or os.getpid()
+                entry["last_used"] = now
+                tokens.append(token)
+            self._save_state(state)
+        return tokens
+
+    def release(self, path, token):
+        """
+        Ends a lease, records the entry's current size and enforces the quota.
+
+        Args:
+            path (str): The path passed to `acquire`.
+            token (str): The token returned by `acquire`.
+        """
+        self.release_many([path], [token])
+
+    def release_many(self, paths, tokens):
+        """
+        Ends several leases at once. See `release`.
+        """
+        names = [self.get_entry_name(path) for path in paths]
+        # measure outside the lock; the entries cannot be evicted while the leases are held
+        sizes = {name: self._measure(name) for name in set(names)}
+        with self.lock:
+            state = self._load_state()
+            now = time.time()
+            for name, token in zip(names, tokens):
+                if name in state:
+                    state[name]["leases"].pop(token, None)
+                    state[name]["size"] = sizes[name]
+                    state[name]["last_used"] = now
+            evicted = self._evict(state)
+            self._save_state(state)
+        self._delete(evicted)
+
+    @contextmanager
+    def lease(self, path):
+        token = self.acquire(path)
+        try:
+            yield path
+        finally:
+            self.release(path, token)
+
+    def enforce(self):
+        """
+        Evicts the least recently used entries that are not leased until the quota is met.
+
+        Returns:
+            int: The number of bytes used after eviction.
+        """
+        with self.lock:
+            state = self._load_state()
+            evicted = self._evict(state)
+            self._save_state(state)
+        self._delete(evicted)
+        return sum(entry["size"] or 0 for entry in state.values())
+
+    def _sync(self, state):
+        """
+        Adds entries created without a lease, e.g. by an earlier run, and drops deleted ones.
+        """
+        names = set()
+        for path in self.root_dir.iterdir():
+            if not path.name.startswith(ENTRY_PREFIXES) or not path.is_dir():
+                continue
+            names.add(self.get_entry_name(path))
+        for name in names - set(state):
+            paths = [path for path in self.get_entry_paths(name) if path.exists()]
+            state[name] = {
+                "size": self._measure(name),
+                "last_used": max(path.stat().st_mtime for path in paths),
+                "leases": {},
+            }
+        for name in set(state) - names:
+            if not self._is_leased(state[name]):
+                del state[name]
+        for name in names:
+            if state[name]["size"] is None:
+                state[name]["size"] = self._measure(name)
+
+    def _evict(self, state):
+        """
+        Picks entries to evict while holding the lock and moves them out of the way.
+
+        Returns:
+            list: The renamed directories, to delete once the lock is released.
+        """
+        self._sync(state)
+        for entry in state.values():
+            entry["leases"] = {
+                token: pid for token, pid in entry["leases"].items() if _pid_alive(pid)
+            }
+        total = sum(entry["size"] or 0 for entry in state.values())
+        evicted = list()
+        candidates = sorted(
+            (name for name, entry in state.items() if not entry["leases"]),
+            key=lambda name: state[name]["last_used"],
+        )
+        for name in candidates:
+            if total <= self.max_bytes:
+                break
+            logger.info(f"Evicting {name} ({state[name]['size'] / 2**20:.1f} MiB)")
+            for path in self.get_entry_paths(name):
+                if not path.exists():
+                    continue
+                trash_name = f"{EVICTED_PREFIX}{path.name}.{uuid.uuid4().hex[:8]}"
+                trash_path = Path(self.root_dir, trash_name)
+                os.replace(path, trash_path)
+                evicted.append(trash_path)
+            total -= state.pop(name)["size"] or 0
+        if total > self.max_bytes:
+            logger.warning(
+                f"{total / 2**30:.2f} GiB in use under {self.root_dir}, over the "
+                f"{self.max_bytes / 2**30:.2f} GiB budget, but every remaining entry is leased"
+            )
+        return evicted
+
+    def _delete(self, paths):
+        for path in paths:
+            shutil.rmtree(path, ignore_errors=True)
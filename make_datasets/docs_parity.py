@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+"""
+Compares the file_name_and_docs_ast and file_name_and_docs_jedi document encodings on a corpus
+of Python files and reports the files where they differ, with the time each encoder took.
+"""
+
+import json
+import time
+import difflib
+from argparse import ArgumentParser
+from pathlib import Path
+from tqdm.auto import tqdm
+
+try:
+    from bm25_retrieval import file_name_and_docs_ast, file_name_and_docs_jedi
+    from utils import list_files, string_to_bool
+except:
+    from .bm25_retrieval import file_name_and_docs_ast, file_name_and_docs_jedi
+    from .utils import list_files, string_to_bool
+
+import logging
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+logger = logging.getLogger(__name__)
+
+
+def get_corpus(paths, include_tests):
+    """
+    Returns (filename, relative_path) for every Python file under `paths`. Directories are
+    searched recursively and their files are named relative to the directory.
+    """
+    corpus = list()
+    for path in paths:
+        path = Path(path)
+        if path.is_dir():
+            for relative_path in sorted(list_files(path, include_tests=include_tests)):
+                corpus.append((Path(path, relative_path).as_posix(), relative_path))
+        else:
+            corpus.append((path.as_posix(), path.name))
+    return corpus
+
+
+def compare_file(filename, relative_path):
+    """
+    Encodes one file with both encoders.
+
+    Returns:
+        dict: The timings of both encoders, the number of lines of the jedi output and of
+            changed lines and, if the outputs differ, a unified diff from the jedi output to the
+            ast output.
+    """
+    with open(filename) as f:
+        source = f.read()
+    start = time.perf_counter()
+    jedi_text = file_name_and_docs_jedi(filename, relative_path, source=source)
+    jedi_time = time.perf_counter() - start
+    start = time.perf_counter()
+    ast_text = file_name_and_docs_ast(filename, relative_path, source=source)
+    ast_time = time.perf_counter() - start
+    result = {
+        "relative_path": relative_path,
+        "jedi_time": jedi_time,
+        "ast_time": ast_time,
+        "equal": jedi_text == ast_text,
+        "num_lines": jedi_text.count("\n") + 1,
+        "changed_lines": 0,
+    }
+    if not result["equal"]:
+        diff = list(
+            difflib.unified_diff(
+                jedi_text.splitlines(keepends=True),
+                ast_text.splitlines(keepends=True),
+                fromfile="jedi",
+                tofile="ast",
+            )
+        )
+        result["changed_lines"] = sum(
+            line.startswith(("-", "+")) and not line.startswith(("---", "+++"))
+            for line in diff
+        )
+        result["diff"] = "".join(diff)
+    return result
+
+
+def main(paths, include_tests, max_files, show_diffs, output_file):
+    corpus = get_corpus(paths, include_tests)
+    if max_files is not None:
+        corpus = corpus[:max_files]
+    results = list()
+    for filename, relative_path in tqdm(corpus, desc="Comparing"):
+        try:
+            results.append(compare_file(filename, relative_path))
+        except (OSError, UnicodeDecodeError) as e:
+            logger.warning(f"Skipping {filename}: {e}")
+    if output_file is not None:
+        with open(output_file, "w") as f:
+            for result in results:
+                print(json.dumps(result), file=f)
+        logger.info(f"Saved results to {output_file}")
+    differences = [result for result in results if not result["equal"]]
+    for result in differences[:show_diffs]:
+        print(result["diff"])
+    jedi_time = sum(result["jedi_time"] for result in results)
+    ast_time = sum(result["ast_time"] for result in results)
+    num_lines = sum(result["num_lines"] for result in results)
+    changed_lines = sum(result["changed_lines"] for result in results)
+    logger.info(
+        f"{len(results) - len(differences)}/{len(results)} files identical, {len(differences)} differ"
+    )
+    logger.info(f"{changed_lines} lines added or removed out of {num_lines} jedi output lines")
+    logger.info(
+        f"jedi: {jedi_time:.2f}s, ast: {ast_time:.2f}s ({jedi_time / max(ast_time, 1e-9):.1f}x faster)"
+    )
+    for result in differences:
+        logger.info(f"Differs: {result['relative_path']}")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "paths",
+        nargs="+",
+        help="Python files, or directories (e.g. repository checkouts) to search for Python files.",
+    )
+    parser.add_argument("--include_tests", type=string_to_bool, default=False)
+    parser.add_argument("--max_files", type=int, default=None)
+    parser.add_argument(
+        "--show_diffs",
+        type=int,
+        default=10,
+        help="Number of differing files whose diffs are printed.",
+    )
+    parser.add_argument(
+        "--output_file",
+        type=str,
+        default=None,
+        help="Path to a .jsonl file with the timings and diff of every file.",
+    )
+    args = parser.parse_args()
+    main(**vars(args))
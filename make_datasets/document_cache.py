@@ -0,0 +1,131 @@
+"""
+Persistent cache for the output of the DOCUMENT_ENCODING_FUNCTIONS in bm25_retrieval.py.
+
+Encoded documents are keyed by (git blob SHA, relative path, encoding style), so a file
+that is byte-identical between two commits is only encoded once across all instances and
+runs. The cache is a single SQLite database that can be shared by several processes.
+"""
+
+import os
+import sqlite3
+import logging
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+
+class DocumentCache:
+    """
+    An SQLite-backed cache of encoded documents.
+
+    Args:
+        cache_path (str): The path to the SQLite database. Created if it does not exist.
+        commit_every (int, optional): Number of writes to batch per transaction. Defaults to 256.
+
+    Attributes:
+        hits (int): Number of lookups answered from the cache by this process.
+        misses (int): Number of lookups that had to be encoded by this process.
+    """
+
+    def __init__(self, cache_path, commit_every=256):
+        self.cache_path = Path(cache_path)
+        self.commit_every = commit_every
+        self.hits = 0
+        self.misses = 0
+        self._conn = None
+        self._pid = None
+        self._pending = 0
+
+    @property
+    def conn(self):
+        # sqlite connections must not be shared across forked processes
+        if self._conn is None or self._pid != os.getpid():
+            self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(self.cache_path.as_posix(), timeout=60)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS documents ("
+                "blob_sha TEXT, relative_path TEXT, style TEXT, text TEXT, "
+                "PRIMARY KEY (blob_sha, relative_path, style))"
+            )
+            self._conn.commit()
+            self._pid = os.getpid()
+            self._pending = 0
+        return self._conn
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_conn"] = None
+        return state
+
+    def get(self, blob_sha, relative_path, style):
+        row = self.conn.execute(
+            "SELECT text FROM documents WHERE blob_sha = ? AND relative_path = ? AND style = ?",
+            (blob_sha, relative_path, style),
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def put(self, blob_sha, relative_path, style, text):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?)",
+            (blob_sha, relative_path, style, text),
+        )
+        self._pending += 1
+        if self._pending >= self.commit_every:
+            self.flush()
+
+    def flush(self):
+        if self._conn is not None and self._pid == os.getpid():
+            self._conn.commit()
+            self._pending = 0
+
+    def encode(self, document_encoding_func, filename, relative_path, blob_sha, source=None):
+        """
+        Returns the encoded document, running `document_encoding_func` only on a cache miss.
+
+        Args:
+            document_encoding_func (function): A function that takes a filename and a relative path and returns the encoded document text.
+            filename (str): The path to the file on disk.
+            relative_path (str): The path of the file relative to the repository root.
+            blob_sha (str): The git blob SHA of the file. If None, the file is encoded without caching.
+            source (str, optional): The file contents, if already read.
+
+        Returns:
+            str: The encoded document text.
+        """
+        text = self.lookup(document_encoding_func, relative_path, blob_sha)
+        if text is not None:
+            return text
+        text = document_encoding_func(filename, relative_path, source=source)
+        self.store(document_encoding_func, relative_path, blob_sha, text)
+        return text
+
+    def lookup(self, document_encoding_func, relative_path, blob_sha):
+        """
+        Returns the cached document, or None on a miss, and counts the hit or miss.
+        """
+        if blob_sha is not None:
+            text = self.get(blob_sha, relative_path, document_encoding_func.__name__)
+            if text is not None:
+                self.hits += 1
+                return text
+        self.misses += 1
+        return None
+
+    def store(self, document_encoding_func, relative_path, blob_sha, text):
+        if blob_sha is not None:
+            self.put(blob_sha, relative_path, document_encoding_func.__name__, text)
+
+    def log_stats(self):
+        total = self.hits + self.misses
+        rate = self.hits / total * 100 if total else 0.0
+        logger.info(
+            f"Document cache {self.cache_path}: {self.hits} hits, {self.misses} misses ({rate:.1f}% hit rate)"
+        )
+
+    def close(self):
+        self.flush()
+        if self._conn is not None and self._pid == os.getpid():
+            self._conn.close()
+        self._conn = None
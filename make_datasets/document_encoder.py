@@ -0,0 +1,170 @@
+"""
+Parallel document encoding with a per-file time budget.
+
+Encoding a repository calls one of the DOCUMENT_ENCODING_FUNCTIONS in bm25_retrieval.py on
+every file in turn. The jedi-based encoder can take seconds on a large module and minutes on a
+pathological one. `DocumentEncoder` spreads files over a process pool and interrupts any file
+that runs past its budget with SIGALRM, encoding it with a cheap fallback function instead.
+Fallbacks are counted so they can be reported at the end of a run.
+"""
+
+import os
+import signal
+import logging
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class EncodingTimeout(BaseException):
+    """
+    Raised inside an encoding function that ran past its budget. It derives from BaseException
+    so that the `except Exception` handlers of the encoding functions do not swallow it.
+    """
+
+
+def _raise_timeout(signum, frame):
+    raise EncodingTimeout()
+
+
+def encode_with_budget(
+    document_encoding_func, fallback_func, filename, relative_path, source=None, timeout=None
+):
+    """
+    Encodes one file, falling back to `fallback_func` if it takes longer than `timeout` seconds.
+    The budget is only enforced on the main thread of a process, where SIGALRM is delivered.
+
+    Returns:
+        tuple: (text, fell_back)
+    """
+    if not timeout or threading.current_thread() is not threading.main_thread():
+        return document_encoding_func(filename, relative_path, source=source), False
+    previous_handler = signal.signal(signal.SIGALRM, _raise_timeout)
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        return document_encoding_func(filename, relative_path, source=source), False
+    except EncodingTimeout:
+        pass
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous_handler)
+    return fallback_func(filename, relative_path, source=source), True
+
+
+def _encode_job(args):
+    return encode_with_budget(*args)
+
+
+class DocumentEncoder:
+    """
+    Encodes files with `document_encoding_func`, in parallel and with a time budget per file.
+
+    Args:
+        document_encoding_func (function): The function to encode files with.
+        fallback_func (function): The function used for files that run out of time.
+        num_workers (int, optional): The number of encoding processes. With 0, files are encoded
+            in the calling process. Defaults to 0.
+        timeout (float, optional): The time budget per file in seconds. Defaults to None, no budget.
+        chunksize (int, optional): The number of files sent to a worker at once. Defaults to 8.
+
+    Attributes:
+        fallbacks (int): The number of files encoded with `fallback_func` by this process.
+        fallback_files (list): The relative paths of the most recent of those files, up to
+            MAX_FALLBACK_FILES, which `log_stats` lists.
+    """
+
+    MAX_FALLBACK_FILES = 100
+
+    def __init__(
+        self,
+        document_encoding_func,
+        fallback_func,
+        num_workers=0,
+        timeout=None,
+        chunksize=8,
+    ):
+        self.document_encoding_func = document_encoding_func
+        self.fallback_func = fallback_func
+        self.num_workers = num_workers
+        self.timeout = timeout
+        self.chunksize = chunksize
+        self.fallbacks = 0
+        self.fallback_files = list()
+        self._executor = None
+        self._pid = None
+
+    @property
+    def batch_size(self):
+        """
+        The number of files to pass to `encode` at once to keep every worker busy.
+        """
+        return max(self.num_workers, 1) * self.chunksize * 4
+
+    @property
+    def executor(self):
+        # a pool belongs to the process that started it, so forked copies start their own
+        if self._executor is None or self._pid != os.getpid():
+            self._executor = ProcessPoolExecutor(self.num_workers)
+            self._pid = os.getpid()
+        return self._executor
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_executor"] = None
+        state["_pid"] = None
+        return state
+
+    def encode(self, files):
+        """
+        Encodes several files.
+
+        Args:
+            files (list): (filename, relative_path, source) tuples, where source is the file
+                contents if already read, or None to read the file from disk.
+
+        Returns:
+            list: (text, fell_back) for each file, in order, where fell_back tells whether the
+                file was encoded with `fallback_func`.
+        """
+        jobs = [
+            (
+                self.document_encoding_func,
+                self.fallback_func,
+                filename,
+                relative_path,
+                source,
+                self.timeout,
+            )
+            for filename, relative_path, source in files
+        ]
+        if self.num_workers > 0 and len(jobs) > 1:
+            results = self.executor.map(_encode_job, jobs, chunksize=self.chunksize)
+        else:
+            results = map(_encode_job, jobs)
+        encoded = list()
+        for (_, relative_path, _), (text, fell_back) in zip(files, results):
+            if fell_back:
+                self.fallbacks += 1
+                self.fallback_files = self.fallback_files[-self.MAX_FALLBACK_FILES + 1 :]
+                self.fallback_files.append(relative_path)
+                logger.warning(
+                    f"Encoding {relative_path} took longer than {self.timeout}s, used {self.fallback_func.__name__}"
+                )
+            encoded.append((text, fell_back))
+        return encoded
+
+    def log_stats(self):
+        logger.info(
+            f"{self.fallbacks} files exceeded the {self.timeout}s encoding budget and fell back to {self.fallback_func.__name__}"
+        )
+        if self.fallback_files:
+            logger.info(
+                f"The last {len(self.fallback_files)} of them encoded in this process: "
+                + ", ".join(self.fallback_files)
+            )
+
+    def close(self):
+        if self._executor is not None and self._pid == os.getpid():
+            self._executor.shutdown()
+        self._executor = None
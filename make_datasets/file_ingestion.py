@@ -0,0 +1,123 @@
+"""
+Reads source files as text, for the document encoders and for building prompts.
+
+Files used to be read twice: once in full to run chardet over every byte, which takes seconds
+on large files, and once more to decode them. Here each file is read once and decoded as
+strict UTF-8 (almost every source file is UTF-8). Only when that fails is chardet run, on a
+bounded sample: the start of the file and the bytes around the first invalid UTF-8 sequence.
+Binary files are recognized by a NUL byte near the start, as git does, and are never passed
+to chardet. Reads from disk go through a thread pool, since they spend most of their time
+waiting on I/O.
+"""
+
+import codecs
+import chardet
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+BINARY_FILE_TEXT = "[BINARY DATA FILE]"
+# how far into a file to look for a NUL byte, the same as git's binary heuristic
+SNIFF_BYTES = 8000
+# the number of bytes chardet looks at from the start of a file and from its first non-UTF-8 byte
+DETECTION_BYTES = 32 * 1024
+READ_THREADS = 8
+
+# byte order marks, longest first since the UTF-32-LE mark starts with the UTF-16-LE one
+BOMS = [
+    (codecs.BOM_UTF32_LE, "utf-32"),
+    (codecs.BOM_UTF32_BE, "utf-32"),
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+]
+
+
+def decode_text(data, encoding="utf-8"):
+    """
+    Decodes bytes the way `open(..., encoding=encoding).read()` would, including its
+    universal newline translation.
+    """
+    return data.decode(encoding).replace("\r\n", "\n").replace("\r", "\n")
+
+
+def detect_encoding(data, error_offset=0):
+    """
+    Guesses the encoding of bytes that are not valid UTF-8 with chardet, from at most
+    2 * DETECTION_BYTES of them.
+
+    Args:
+        data (bytes): The file contents.
+        error_offset (int, optional): Where decoding as UTF-8 failed.
+
+    Returns:
+        str: The encoding, or None if chardet cannot tell.
+    """
+    sample = data[:DETECTION_BYTES]
+    if error_offset >= DETECTION_BYTES:
+        sample += data[error_offset : error_offset + DETECTION_BYTES]
+    return chardet.detect(sample)["encoding"]
+
+
+def decode_bytes(data, encoding=None):
+    """
+    Decodes file contents.
+
+    Args:
+        data (bytes): The file contents.
+        encoding (str, optional): A known encoding of the file, e.g. one returned by an earlier
+            call. Defaults to None, to work it out.
+
+    Returns:
+        tuple: (text, encoding), where text is BINARY_FILE_TEXT and encoding is None for files
+            that are binary or cannot be decoded.
+    """
+    if encoding is None:
+        encoding = next((name for bom, name in BOMS if data.startswith(bom)), None)
+    if encoding is None:
+        if b"\0" in data[:SNIFF_BYTES]:
+            return BINARY_FILE_TEXT, None
+        try:
+            return decode_text(data, "utf-8"), "utf-8"
+        except UnicodeDecodeError as e:
+            encoding = detect_encoding(data, e.start)
+        if encoding is None:
+            return BINARY_FILE_TEXT, None
+    try:
+        return decode_text(data, encoding), encoding
+    except (UnicodeDecodeError, LookupError):
+        return BINARY_FILE_TEXT, None
+
+
+def read_file(filename, encoding=None):
+    """
+    Reads and decodes one file from disk. See `decode_bytes`.
+
+    Returns:
+        tuple: (text, encoding)
+    """
+    with open(filename, "rb") as f:
+        data = f.read()
+    return decode_bytes(data, encoding)
+
+
+def read_files(filenames, encodings=None, num_threads=READ_THREADS):
+    """
+    Reads and decodes several files from disk on a thread pool.
+
+    Args:
+        filenames (list): The paths of the files.
+        encodings (list, optional): A known encoding, or None, for each file.
+        num_threads (int, optional): The number of reading threads. Defaults to READ_THREADS.
+
+    Returns:
+        list: (text, encoding) for each file, in order. Errors such as a missing file are
+            raised when the result of that file is reached.
+    """
+    if encodings is None:
+        encodings = [None] * len(filenames)
+    if num_threads <= 1 or len(filenames) <= 1:
+        return list(map(read_file, filenames, encodings))
+    with ThreadPoolExecutor(min(num_threads, len(filenames))) as executor:
+        return list(executor.map(read_file, filenames, encodings))
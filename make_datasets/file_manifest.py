@@ -0,0 +1,246 @@
+"""
+A per-repository manifest of the files of every commit that was read.
+
+Enumerating the files of a snapshot used to walk the checkout with `Path.rglob("*.py")`, test
+every path with `is_test` and list the directory again for READMEs, for every instance and in
+every consumer. `FileManifest` runs `git ls-tree -r -l` once per commit and stores the path,
+size, blob SHA and `is_test` flag of each file in an SQLite database. The encodings that
+consumers detect are stored per blob. The database lives in the clone's git directory, so it
+is shared by the clone's worktrees, by every script that reads the clone and by later runs,
+and it is deleted together with the clone. Listing the files of a commit that is already in
+the manifest is one indexed query, and the last listing is also kept in memory.
+"""
+
+import os
+import re
+import sqlite3
+import logging
+import threading
+import subprocess
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+SHA_PATTERN = re.compile(r"[0-9a-f]{40}|[0-9a-f]{64}")
+
+
+def get_git_common_dir(repo_path):
+    """
+    Returns the git directory shared by a clone and its worktrees.
+    """
+    git_dir = Path(repo_path, ".git")
+    if git_dir.is_dir():
+        return git_dir
+    output = subprocess.run(
+        ["git", "rev-parse", "--path-format=absolute", "--git-common-dir"],
+        cwd=repo_path,
+        check=True,
+        capture_output=True,
+    )
+    return Path(output.stdout.decode("utf-8").strip())
+
+
+class FileManifest:
+    """
+    The files of the commits of one repository, filled from `git ls-tree -r -l`.
+
+    Args:
+        repo_path (str): The path to the clone, or to one of its worktrees.
+        is_test (function): Tells test files apart. It is called with the path of each file
+            relative to the repository root, so the flag does not depend on where the clone or
+            worktree that first listed a commit lives.
+        sizes (bool, optional): Whether to record file sizes. `git ls-tree -l` reads every blob
+            to get its size, which in a partial clone means downloading it, so sizes are left
+            out (None) there. Defaults to True.
+
+    Attributes:
+        repo_path (str): The path to the repository.
+        manifest_path (Path): The path to the SQLite database.
+    """
+
+    FILENAME = "file_manifest.sqlite"
+    # bumped when the stored rows change meaning, to drop the rows of older versions
+    SCHEMA_VERSION = 1
+
+    def __init__(self, repo_path, is_test, sizes=True):
+        self.repo_path = Path(repo_path).resolve().as_posix()
+        self.is_test = is_test
+        self.sizes = sizes
+        self.manifest_path = Path(get_git_common_dir(self.repo_path), self.FILENAME)
+        self._conn = None
+        self._pid = None
+        self._entries = dict()
+        self._lock = threading.Lock()
+
+    @property
+    def conn(self):
+        # sqlite connections must not be shared across forked processes
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(
+                self.manifest_path.as_posix(), timeout=60, check_same_thread=False
+            )
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            version = self._conn.execute("PRAGMA user_version").fetchone()[0]
+            if version < self.SCHEMA_VERSION:
+                # is_test used to be computed from absolute paths
+                with self._conn:
+                    self._conn.execute("DROP TABLE IF EXISTS commits")
+                    self._conn.execute("DROP TABLE IF EXISTS files")
+                    self._conn.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS commits (commit_sha TEXT PRIMARY KEY)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                "commit_sha TEXT, path TEXT, size INTEGER, blob_sha TEXT, is_test INTEGER, "
+                "PRIMARY KEY (commit_sha, path))"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS encodings (blob_sha TEXT PRIMARY KEY, encoding TEXT)"
+            )
+            self._conn.commit()
+            self._pid = os.getpid()
+        return self._conn
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_conn"] = None
+        state["_lock"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _read_tree(self, commit):
+        """
+        Lists the regular files of a commit with `git ls-tree -r [-l]`, skipping symlinks and
+        submodules.
+
+        Returns:
+            list: (path, size, blob_sha, is_test) for each file.
+        """
+        output = subprocess.run(
+            ["git", "ls-tree", "-r", "-z"] + (["-l"] if self.sizes else []) + [commit],
+            cwd=self.repo_path,
+            check=True,
+            capture_output=True,
+        ).stdout.decode("utf-8", errors="surrogateescape")
+        rows = list()
+        for entry in output.split("\0"):
+            if not entry:
+                continue
+            info, path = entry.split("\t", 1)
+            mode, obj_type, sha, *size = info.split()
+            if obj_type != "blob" or mode == "120000":
+                continue
+            size = int(size[0]) if size else None
+            test = self.is_test(path)
+            rows.append((path, size, sha, int(test)))
+        return rows
+
+    def resolve_commit(self, commit):
+        """
+        Returns the full SHA of a commit given as a ref such as `HEAD`, a branch name or an
+        abbreviated SHA, so the manifest is keyed by commits rather than by what refs pointed to.
+        """
+        if SHA_PATTERN.fullmatch(commit):
+            return commit
+        output = subprocess.run(
+            ["git", "rev-parse", "--verify", commit + "^{commit}"],
+            cwd=self.repo_path,
+            check=True,
+            capture_output=True,
+        )
+        return output.stdout.decode("utf-8").strip()
+
+    def get_entries(self, commit):
+        """
+        Returns the files of a commit, reading the tree into the manifest the first time.
+
+        Returns:
+            list: (path, size, blob_sha, is_test) for each file, in `git ls-tree` order.
+        """
+        commit = self.resolve_commit(commit)
+        with self._lock:
+            return self._get_entries(commit)
+
+    def _get_entries(self, commit):
+        if commit in self._entries:
+            return self._entries[commit]
+        known = self.conn.execute(
+            "SELECT 1 FROM commits WHERE commit_sha = ?", (commit,)
+        ).fetchone()
+        if known is None:
+            rows = self._read_tree(commit)
+            with self.conn:
+                self.conn.execute("DELETE FROM files WHERE commit_sha = ?", (commit,))
+                self.conn.executemany(
+                    "INSERT INTO files VALUES (?, ?, ?, ?, ?)",
+                    [(commit, *row) for row in rows],
+                )
+                self.conn.execute("INSERT OR IGNORE INTO commits VALUES (?)", (commit,))
+        else:
+            rows = self.conn.execute(
+                "SELECT path, size, blob_sha, is_test FROM files WHERE commit_sha = ? ORDER BY rowid",
+                (commit,),
+            ).fetchall()
+        self._entries = {commit: [(path, size, sha, bool(test)) for path, size, sha, test in rows]}
+        return self._entries[commit]
+
+    def list_files(self, commit, include_tests=False):
+        """
+        Returns the Python files of a commit, like `utils.list_files` on its checkout.
+        """
+        return [
+            path
+            for path, _, _, test in self.get_entries(commit)
+            if path.endswith(".py") and (include_tests or not test)
+        ]
+
+    def list_blobs(self, commit):
+        """
+        Maps the path of every regular file in a commit to its blob SHA.
+        """
+        return {path: sha for path, _, sha, _ in self.get_entries(commit)}
+
+    def get_sizes(self, commit):
+        return {path: size for path, size, _, _ in self.get_entries(commit)}
+
+    def get_readme_files(self, commit):
+        return [
+            path
+            for path, _, _, _ in self.get_entries(commit)
+            if "/" not in path and path.lower().startswith("readme")
+        ]
+
+    def get_encodings(self, blob_shas):
+        """
+        Returns the stored encodings of the given blobs, where None means binary. Blobs whose
+        encoding was never stored are left out.
+        """
+        encodings = dict()
+        blob_shas = list(blob_shas)
+        query = "SELECT blob_sha, encoding FROM encodings WHERE blob_sha IN ({})"
+        with self._lock:
+            for start in range(0, len(blob_shas), 500):
+                batch = blob_shas[start : start + 500]
+                encodings.update(
+                    self.conn.execute(query.format(",".join("?" * len(batch))), batch).fetchall()
+                )
+        return encodings
+
+    def put_encodings(self, encodings):
+        """
+        Stores the detected encodings of blobs, given as a dict from blob SHA to encoding.
+        """
+        if not encodings:
+            return
+        with self._lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO encodings VALUES (?, ?)", list(encodings.items())
+            )
+
+    def close(self):
+        if self._conn is not None and self._pid == os.getpid():
+            self._conn.close()
+        self._conn = None
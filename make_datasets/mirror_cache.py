@@ -0,0 +1,167 @@
+"""
+A persistent cache of bare mirrors that working clones are made from.
+
+`bm25_retrieval.py` clones every repository into its own output directory and
+`create_text_dataset.py` clones into a temporary directory it deletes after each run, so the
+same repositories are downloaded again and again. With a mirror cache, each repository is
+fetched once into `<cache_dir>/<host>/<path>.git`, where `<path>` is the path of the URL it
+is fetched from with `/` replaced by `__`. Keying mirrors by URL keeps the clones of the
+`swe-bench` mirror organization made by `create_text_dataset.py` apart from the upstream
+clones of `bm25_retrieval.py`, whose histories can differ. A mirror is updated in place when
+it gets old, and working clones are made from it with `git clone --shared`. This only writes
+a checkout and an `objects/info/alternates` file pointing at the mirror, so it takes
+milliseconds.
+
+Mirrors are created and updated under a FileLock per repository, so several processes can
+share a cache. Automatic `git gc` is disabled in the mirrors, because pruning objects would
+break the clones that borrow them. Instead, after each fetch the mirrors maintain a
+commit-graph and a multi-pack-index, which keep history walks and object lookups fast as
+packs accumulate. Mirrors are bare clones of the branches and tags only. Their remote URL is
+stored without credentials, and any token in the URL is passed to each fetch through a
+credential helper instead.
+"""
+
+import os
+import time
+import shutil
+import logging
+import subprocess
+from filelock import FileLock
+from pathlib import Path
+from urllib.parse import urlsplit, urlunsplit, unquote
+
+logger = logging.getLogger(__name__)
+
+# only branches and tags are mirrored, not e.g. the refs/pull/* refs of every pull request
+FETCH_REFSPECS = ["+refs/heads/*:refs/heads/*", "+refs/tags/*:refs/tags/*"]
+# answers git's credential requests from the environment of the fetch, so tokens are neither
+# written to the mirror's config nor passed on the command line
+CREDENTIAL_HELPER = (
+    '!f() { test "$1" = get && echo "username=$MIRROR_USERNAME" '
+    '&& echo "password=$MIRROR_PASSWORD"; }; f'
+)
+
+
+def split_credentials(repo_url):
+    """
+    Splits the credentials off a URL such as `https://<token>@github.com/<owner>/<name>.git`.
+
+    Returns:
+        tuple: (url, env), the URL without credentials and the environment variables that
+            CREDENTIAL_HELPER reads them from, or None if the URL has none.
+    """
+    url = urlsplit(repo_url)
+    if url.username is None:
+        return repo_url, None
+    netloc = url.hostname + (f":{url.port}" if url.port is not None else "")
+    env = {
+        **os.environ,
+        "MIRROR_USERNAME": unquote(url.username),
+        "MIRROR_PASSWORD": unquote(url.password or ""),
+    }
+    return urlunsplit(url._replace(netloc=netloc)), env
+
+
+class MirrorCache:
+    """
+    Keeps bare mirrors of repositories up to date. Working clones are made from them by
+    `utils.git_clone`.
+
+    Args:
+        cache_dir (str): The directory holding the mirrors.
+        update_interval (float, optional): Mirrors fetched longer ago than this many seconds
+            are fetched again before use. Defaults to one hour.
+    """
+
+    FETCH_STAMP = "LAST_FETCH"
+
+    def __init__(self, cache_dir, update_interval=3600):
+        self.cache_dir = Path(cache_dir).resolve()
+        self.update_interval = update_interval
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def get_mirror_path(self, repo_url):
+        """
+        Returns where the mirror of `repo_url` is kept. Credentials in the URL are ignored, so
+        `https://<token>@github.com/swe-bench/astropy__astropy.git` is mirrored in
+        `<cache_dir>/github.com/swe-bench__astropy__astropy.git`.
+        """
+        url = urlsplit(repo_url)
+        path = url.path.strip("/")
+        if path.endswith(".git"):
+            path = path[: -len(".git")]
+        return Path(self.cache_dir, url.hostname or "local", path.replace("/", "__") + ".git")
+
+    def _git(self, *args, cwd=None, env=None, check=True):
+        if env is not None:
+            args = ("-c", f"credential.helper={CREDENTIAL_HELPER}") + args
+        subprocess.run(
+            ["git", *args],
+            cwd=cwd,
+            env=env,
+            check=check,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+        )
+
+    def _set_refspecs(self, mirror_path):
+        self._git("config", "--unset-all", "remote.origin.mirror", cwd=mirror_path, check=False)
+        self._git("config", "--unset-all", "remote.origin.fetch", cwd=mirror_path, check=False)
+        for refspec in FETCH_REFSPECS:
+            self._git("config", "--add", "remote.origin.fetch", refspec, cwd=mirror_path)
+
+    def _maintain(self, mirror_path):
+        """
+        Writes the commit-graph and multi-pack-index of a mirror and records the fetch time.
+        """
+        # pack any loose objects (e.g. from a clone of a local path) into one more pack, without
+        # touching the existing packs, so the multi-pack-index covers every object
+        self._git("repack", "-d", "--quiet", cwd=mirror_path)
+        if any(Path(mirror_path, "objects", "pack").glob("*.pack")):
+            self._git("multi-pack-index", "write", cwd=mirror_path)
+        self._git("commit-graph", "write", "--reachable", cwd=mirror_path)
+        Path(mirror_path, self.FETCH_STAMP).write_text(f"{time.time()}\n")
+
+    def _is_stale(self, mirror_path):
+        stamp = Path(mirror_path, self.FETCH_STAMP)
+        if not stamp.exists():
+            return True
+        return time.time() - stamp.stat().st_mtime > self.update_interval
+
+    def get(self, repo, repo_url):
+        """
+        Returns the path to an up-to-date mirror of `repo`, creating it from `repo_url` if it
+        is not in the cache yet.
+
+        Args:
+            repo (str): The repository, as `<owner>/<name>`, for log messages.
+            repo_url (str): The URL to fetch the repository from, which the mirror is keyed by.
+
+        Returns:
+            Path: The path to the bare mirror.
+        """
+        mirror_path = self.get_mirror_path(repo_url)
+        repo_url, env = split_credentials(repo_url)
+        mirror_path.parent.mkdir(parents=True, exist_ok=True)
+        with FileLock(mirror_path.with_suffix(".lock").as_posix()):
+            if not mirror_path.exists():
+                logger.info(f"Mirroring {repo} into {self.cache_dir} {os.getpid()}")
+                # clone next to the final path so a failed clone is never picked up
+                tmp_path = mirror_path.with_name(mirror_path.name + f".tmp{os.getpid()}")
+                shutil.rmtree(tmp_path, ignore_errors=True)
+                self._git("clone", "--quiet", "--bare", repo_url, tmp_path.as_posix(), env=env)
+                self._set_refspecs(tmp_path)
+                self._git("config", "gc.auto", "0", cwd=tmp_path)
+                self._git("config", "fetch.writeCommitGraph", "true", cwd=tmp_path)
+                # keep fetched objects packed instead of exploding small fetches into loose files
+                self._git("config", "transfer.unpackLimit", "1", cwd=tmp_path)
+                self._maintain(tmp_path)
+                os.replace(tmp_path, mirror_path)
+            elif self._is_stale(mirror_path):
+                logger.info(f"Updating the mirror of {repo} {os.getpid()}")
+                # mirrors made with `git clone --mirror` kept the token and fetched every ref
+                self._git("remote", "set-url", "origin", repo_url, cwd=mirror_path)
+                self._set_refspecs(mirror_path)
+                self._git("fetch", "--quiet", "--prune", "origin", cwd=mirror_path, env=env)
+                self._maintain(mirror_path)
+        return mirror_path
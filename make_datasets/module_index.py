@@ -0,0 +1,168 @@
+"""
+Resolves the imports of a repository snapshot to files, for `utils.ingest_file_directory_contents`.
+
+`resolve_module_to_file` walked the whole repository with `os.walk` for every import
+statement, and the import closure checked membership in lists, so following the imports of
+one file took O(imports x tree size + n^2). `ModuleIndex` lists the directories of a snapshot
+once, from the FileManifest when the commit is known. It memoizes the resolution of each
+module and the imports of each file. The import graph of a snapshot is therefore built at most
+once per process, and closures are computed over sets.
+
+Resolution keeps the rules of `resolve_module_to_file`. The module name loses its last `level`
+components, and the result is the Python files of the first directory, in top-down walk order
+with sorted names, whose path ends with the remaining components.
+"""
+
+import os
+import ast
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def get_imported_modules(filename):
+    with open(filename) as file:
+        tree = ast.parse(file.read(), filename)
+    return [
+        node
+        for node in ast.iter_child_nodes(tree)
+        if isinstance(node, (ast.Import, ast.ImportFrom))
+    ]
+
+
+class ModuleIndex:
+    """
+    The directories and Python files of one snapshot of a repository, with memoized import
+    resolution.
+
+    Args:
+        root_dir (str): The path to the checkout. Files are returned joined to it.
+        relative_paths (iterable): The paths of the files in the snapshot, relative to root_dir.
+    """
+
+    def __init__(self, root_dir, relative_paths):
+        self.root_dir = root_dir
+        py_files = {"": list()}
+        for relative_path in relative_paths:
+            parent, name = os.path.split(relative_path)
+            ancestor = parent
+            while ancestor not in py_files:
+                py_files[ancestor] = list()
+                ancestor = os.path.dirname(ancestor)
+            if name.endswith(".py"):
+                py_files[parent].append(name)
+        # the order os.walk visits directories in, with every listing sorted
+        self.dirs = sorted(py_files, key=lambda d: d.split(os.sep) if d else [])
+        self.dir_paths = [os.path.join(root_dir, d) if d else root_dir for d in self.dirs]
+        self.py_files = {
+            dir_path: [os.path.join(dir_path, name) for name in sorted(py_files[d])]
+            for d, dir_path in zip(self.dirs, self.dir_paths)
+        }
+        self._resolved = dict()
+        self._imports = dict()
+        self._closures = dict()
+
+    @classmethod
+    def from_directory(cls, root_dir):
+        """
+        Indexes the files under `root_dir`, skipping `.git`.
+        """
+        relative_paths = list()
+        for dirpath, dirnames, filenames in os.walk(root_dir):
+            dirnames[:] = [name for name in dirnames if name != ".git"]
+            relative_dir = os.path.relpath(dirpath, root_dir)
+            for filename in filenames:
+                relative_paths.append(os.path.normpath(os.path.join(relative_dir, filename)))
+            if not filenames and not dirnames and relative_dir != os.curdir:
+                relative_paths.append(os.path.join(relative_dir, ""))  # keep empty directories
+        return cls(root_dir, relative_paths)
+
+    @classmethod
+    def from_manifest(cls, root_dir, manifest, commit):
+        """
+        Indexes the files of `commit` listed in a FileManifest.
+        """
+        return cls(root_dir, manifest.list_blobs(commit))
+
+    def resolve(self, module, level=0):
+        """
+        Returns the Python files of the directory a module resolves to, like
+        `resolve_module_to_file`.
+
+        Args:
+            module (str): The dotted module name, or None for `from . import x`.
+            level (int, optional): The number of leading dots of a relative import.
+
+        Returns:
+            list: The paths of the files, joined to root_dir.
+        """
+        key = (module, level)
+        if key not in self._resolved:
+            components = (module or "").split(".")
+            if level > 0:
+                components = components[:-level]
+            suffix = os.sep.join(components)
+            files = list()
+            for dir_path in self.dir_paths:
+                if dir_path.endswith(suffix):
+                    files = self.py_files[dir_path]
+                    break
+            self._resolved[key] = files
+        return self._resolved[key]
+
+    def get_imported_files(self, filename):
+        """
+        Returns the files that the top-level imports of a file resolve to, in import order.
+        """
+        if filename not in self._imports:
+            files = list()
+            for node in get_imported_modules(filename):
+                if isinstance(node, ast.Import):
+                    for alias in node.names:
+                        files.extend(self.resolve(alias.name, 0))
+                elif isinstance(node, ast.ImportFrom):
+                    files.extend(self.resolve(node.module, node.level))
+            self._imports[filename] = files
+        return self._imports[filename]
+
+    def get_import_closure(self, target_file):
+        """
+        Returns `target_file` and every file reachable from it through imports, in the order
+        `ingest_file_directory_contents` visits them.
+        """
+        if target_file not in self._closures:
+            visited = list()
+            seen = {target_file}
+            files_to_check = [target_file]
+            while files_to_check:
+                current_file = files_to_check.pop()
+                visited.append(current_file)
+                for file in self.get_imported_files(current_file):
+                    if file not in seen:
+                        seen.add(file)
+                        files_to_check.append(file)
+            self._closures[target_file] = visited
+        return list(self._closures[target_file])
+
+
+_MODULE_INDEXES = OrderedDict()
+MAX_MODULE_INDEXES = 8
+
+
+def get_module_index(root_dir, commit=None, manifest=None):
+    """
+    Returns the ModuleIndex of a snapshot. With a `commit`, it is built from `manifest` and
+    kept for later calls in this process, up to MAX_MODULE_INDEXES snapshots. Without one, the
+    checkout is walked and nothing is kept, since it may change between calls.
+    """
+    if commit is None or manifest is None:
+        return ModuleIndex.from_directory(root_dir)
+    key = (os.path.abspath(root_dir), commit, os.getpid())
+    if key in _MODULE_INDEXES:
+        _MODULE_INDEXES.move_to_end(key)
+    else:
+        _MODULE_INDEXES[key] = ModuleIndex.from_manifest(root_dir, manifest, commit)
+        while len(_MODULE_INDEXES) > MAX_MODULE_INDEXES:
+            _MODULE_INDEXES.popitem(last=False)
+    return _MODULE_INDEXES[key]
@@ -0,0 +1,461 @@
+#!/usr/bin/env python
+
+"""
+Compares repair_patch, extract_minimal_patch and extract_diff with the regex implementation
+they replaced, on patches generated from a corpus of Python files, on fuzzed copies of them and
+optionally on model predictions, and times both on adversarial inputs.
+"""
+
+import re
+import json
+import time
+import random
+import difflib
+from argparse import ArgumentParser
+from pathlib import Path
+from tqdm.auto import tqdm
+
+try:
+    from utils import list_files, string_to_bool
+    from utils import repair_patch, extract_minimal_patch, extract_diff
+except:
+    from .utils import list_files, string_to_bool
+    from .utils import repair_patch, extract_minimal_patch, extract_diff
+
+import logging
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+logger = logging.getLogger(__name__)
+
+
+# the regex implementation, kept as the reference
+DIFF_PATTERN = re.compile(r"^diff(?:.*)")
+PATCH_PATTERN = re.compile(
+    r"(?:diff[\w\_\.\ \/\-]+\n)?\-\-\-\s+a\/(?:.*?)\n\+\+\+\s+b\/(?:.*?)(?=diff\ |\-\-\-\ a\/|\Z)",
+    re.DOTALL,
+)
+PATCH_FILE_PATTERN = re.compile(r"\-\-\-\s+a\/(?:.+)\n\+\+\+\s+b\/(?:.+)")
+PATCH_HUNK_PATTERN = re.compile(
+    r"\@\@\s+\-(\d+),(\d+)\s+\+(\d+),(\d+)\s+\@\@(.+?)(?=diff\ |\-\-\-\ a\/|\@\@\ \-|\Z)",
+    re.DOTALL,
+)
+
+
+def get_first_idx(charlist):
+    first_min = charlist.index("-") if "-" in charlist else len(charlist)
+    first_plus = charlist.index("+") if "+" in charlist else len(charlist)
+    return min(first_min, first_plus)
+
+
+def get_last_idx(charlist):
+    char_idx = get_first_idx(charlist[::-1])
+    last_idx = len(charlist) - char_idx
+    return last_idx + 1
+
+
+def strip_content(hunk):
+    first_chars = list(map(lambda x: None if not len(x) else x[0], hunk.split("\n")))
+    first_idx = get_first_idx(first_chars)
+    last_idx = get_last_idx(first_chars)
+    new_lines = list(map(lambda x: x.rstrip(), hunk.split("\n")[first_idx:last_idx]))
+    new_hunk = "\n" + "\n".join(new_lines) + "\n"
+    return new_hunk, first_idx - 1
+
+
+def get_hunk_stats(pre_start, pre_len, post_start, post_len, hunk, total_delta):
+    stats = {"context": 0, "added": 0, "subtracted": 0}
+    hunk = hunk.split("\n", 1)[-1].strip("\n")
+    for line in hunk.split("\n"):
+        if line.startswith("-"):
+            stats["subtracted"] += 1
+        elif line.startswith("+"):
+            stats["added"] += 1
+        else:
+            stats["context"] += 1
+    context = stats["context"]
+    added = stats["added"]
+    subtracted = stats["subtracted"]
+    pre_len = context + subtracted
+    post_start = pre_start + total_delta
+    post_len = context + added
+    total_delta = total_delta + (post_len - pre_len)
+    return pre_start, pre_len, post_start, post_len, total_delta
+
+
+def regex_repair_patch(model_patch):
+    if model_patch is None:
+        return None
+    model_patch = model_patch.lstrip("\n")
+    new_patch = ""
+    for patch in PATCH_PATTERN.findall(model_patch):
+        total_delta = 0
+        diff_header = DIFF_PATTERN.findall(patch)
+        if diff_header:
+            new_patch += diff_header[0] + "\n"
+        patch_header = PATCH_FILE_PATTERN.findall(patch)[0]
+        if patch_header:
+            new_patch += patch_header + "\n"
+        for hunk in PATCH_HUNK_PATTERN.findall(patch):
+            pre_start, pre_len, post_start, post_len, content = hunk
+            pre_start, pre_len, post_start, post_len, total_delta = get_hunk_stats(
+                *list(map(lambda x: int(x) if x.isnumeric() else x, hunk)), total_delta
+            )
+            new_patch += f"@@ -{pre_start},{pre_len} +{post_start},{post_len} @@{content}"
+    return new_patch
+
+
+def regex_extract_minimal_patch(model_patch):
+    model_patch = model_patch.lstrip("\n")
+    new_patch = ""
+    for patch in PATCH_PATTERN.findall(model_patch):
+        total_delta = 0
+        patch_header = PATCH_FILE_PATTERN.findall(patch)[0]
+        if patch_header:
+            new_patch += patch_header + "\n"
+        for hunk in PATCH_HUNK_PATTERN.findall(patch):
+            pre_start, pre_len, post_start, post_len, content = list(
+                map(lambda x: int(x) if x.isnumeric() else x, hunk)
+            )
+            content, adjust_pre_start = strip_content(content)
+            pre_start += adjust_pre_start
+            pre_start, pre_len, post_start, post_len, total_delta = get_hunk_stats(
+                pre_start, pre_len, post_start, post_len, content, total_delta
+            )
+            new_patch += f"@@ -{pre_start},{pre_len} +{post_start},{post_len} @@{content}"
+    return new_patch
+
+
+def regex_extract_diff(response):
+    if response is None:
+        return None
+    diff_matches = []
+    other_matches = []
+    pattern = re.compile(r"\<([\w-]+)\>(.*?)\<\/\1\>", re.DOTALL)
+    for code, match in pattern.findall(response):
+        if code in {"diff", "patch"}:
+            diff_matches.append(match)
+        else:
+            other_matches.append(match)
+    pattern = re.compile(r"```(\w+)?\n(.*?)```", re.DOTALL)
+    for code, match in pattern.findall(response):
+        if code in {"diff", "patch"}:
+            diff_matches.append(match)
+        else:
+            other_matches.append(match)
+    if diff_matches:
+        return diff_matches[0]
+    if other_matches:
+        return other_matches[0]
+    return response.split("</s>")[0]
+
+
+FUNCTIONS = {
+    "extract_diff": (regex_extract_diff, extract_diff),
+    "repair_patch": (regex_repair_patch, repair_patch),
+    "extract_minimal_patch": (regex_extract_minimal_patch, extract_minimal_patch),
+}
+# the known causes of differences between the implementations, see `get_cause`:
+# a line holding one of these after its first character ends a patch or hunk for the regexes
+INLINE_MARKER_PATTERN = re.compile(r"^.+?(?:diff |--- a/|@@ -)", re.MULTILINE)
+# a `--- a/` line is not directly followed by a `+++ b/` line, so the regexes pair it with a
+# later `+++ b/` line across the lines between them
+FILE_HEADER_PATTERN = re.compile(r"---\s+a/")
+FILE_TARGET_PATTERN = re.compile(r"\+\+\+\s+b/.")
+# a hunk header whose whitespace the regexes match across a line break, e.g. a header cut
+# short before its closing `@@` and followed by another header
+HUNK_HEADER_PATTERN = re.compile(r"@@\s+-\d+,\d+\s+\+\d+,\d+\s+@@")
+CAUSES = ["inline markers", "orphaned file header", "split hunk header", "regexes raise"]
+FUZZ_LINES = [
+    "--- a/",
+    "--- a/fuzz.py",
+    "+++ b/fuzz.py",
+    "@@ -1,3 +1,4 @@",
+    "@@ -7 +7 @@",
+    "diff --git a/fuzz.py b/fuzz.py",
+    "<patch>",
+    "</patch>",
+    "```diff",
+    "```",
+    "",
+    " ",
+    "+",
+    "-",
+]
+
+
+def make_patch(rng, files):
+    """
+    Edits a few files at random and returns the unified diff of the edits, wrapped the way
+    models answer.
+    """
+    patch = list()
+    for relative_path, source in files:
+        lines = source.splitlines(keepends=True)
+        new_lines = list(lines)
+        for _ in range(rng.randint(1, 4)):
+            position = rng.randrange(len(new_lines) + 1)
+            edit = rng.choice(["insert", "delete", "replace"])
+            if edit != "insert" and position < len(new_lines):
+                del new_lines[position]
+            if edit != "delete":
+                new_lines.insert(position, f"    value = {rng.randint(0, 99)}  # edited\n")
+        diff = "".join(
+            difflib.unified_diff(
+                lines,
+                new_lines,
+                fromfile=f"a/{relative_path}",
+                tofile=f"b/{relative_path}",
+                n=rng.choice([0, 1, 3]),
+            )
+        )
+        if not diff.endswith("\n"):
+            diff += "\n"
+        if rng.random() < 0.5:
+            diff = f"diff --git a/{relative_path} b/{relative_path}\n" + diff
+        patch.append(diff)
+    patch = "".join(patch)
+    wrapper = rng.choice(["tag", "fence", "none"])
+    if wrapper == "tag":
+        return f"Here is the fix.\n<patch>\n{patch}</patch>\n"
+    if wrapper == "fence":
+        return f"Here is the fix.\n```diff\n{patch}```\n</s>"
+    return patch
+
+
+def fuzz(rng, text):
+    """
+    Corrupts a response with random line edits and truncation.
+    """
+    lines = text.split("\n")
+    for _ in range(rng.randint(1, 4)):
+        position = rng.randrange(len(lines) + 1)
+        mutation = rng.choice(["insert", "delete", "duplicate", "truncate_line"])
+        if mutation == "insert":
+            lines.insert(position, rng.choice(FUZZ_LINES))
+        elif position < len(lines):
+            if mutation == "delete":
+                del lines[position]
+            elif mutation == "duplicate":
+                lines.insert(position, lines[position])
+            else:
+                lines[position] = lines[position][: rng.randrange(len(lines[position]) + 1)]
+    text = "\n".join(lines)
+    if rng.random() < 0.2:
+        text = text[: rng.randrange(len(text) + 1)]
+    return text
+
+
+def get_adversarial_inputs(size):
+    """
+    Returns inputs of about `size` characters on which the regexes take quadratic time.
+    """
+    return {
+        "headers_without_targets": "--- a/x.py\n" * (size // 11),
+        "unclosed_tags": "<patch>\n" * (size // 8),
+    }
+
+
+def has_orphaned_file_header(text):
+    lines = text.split("\n")
+    return any(
+        FILE_HEADER_PATTERN.match(line)
+        and not (i + 1 < len(lines) and FILE_TARGET_PATTERN.match(lines[i + 1]))
+        for i, line in enumerate(lines)
+    )
+
+
+def has_split_hunk_header(text):
+    return any("\n" in match.group() for match in HUNK_HEADER_PATTERN.finditer(text))
+
+
+def get_cause(text, regex_error):
+    """
+    Returns the first of CAUSES that applies to an input the implementations disagree on, or
+    None if none does.
+    """
+    if INLINE_MARKER_PATTERN.search(text) is not None:
+        return "inline markers"
+    if has_orphaned_file_header(text):
+        return "orphaned file header"
+    if has_split_hunk_header(text):
+        return "split hunk header"
+    if regex_error is not None:
+        return "regexes raise"
+    return None
+
+
+def run(function, text):
+    """
+    Returns the output of a function, or None and the exception it raised, with the time it
+    took.
+    """
+    start = time.perf_counter()
+    output, error = None, None
+    try:
+        output = function(text)
+    except Exception as e:
+        error = type(e).__name__
+    return output, error, time.perf_counter() - start
+
+
+def compare(kind, text):
+    """
+    Runs every function of both implementations on a response, and the patch functions on the
+    diff it contains.
+
+    Returns:
+        list: A result per function, with both timings, whether the outputs are equal and, if
+            they are not, the cause of the difference.
+    """
+    results = list()
+    diff = regex_extract_diff(text)
+    for name, (regex_function, parser_function) in FUNCTIONS.items():
+        value = text if name == "extract_diff" else diff
+        if value is None:
+            continue
+        regex_output, regex_error, regex_time = run(regex_function, value)
+        parser_output, parser_error, parser_time = run(parser_function, value)
+        result = {
+            "kind": kind,
+            "function": name,
+            "regex_time": regex_time,
+            "parser_time": parser_time,
+            "equal": (regex_output, regex_error) == (parser_output, parser_error),
+            "cause": None,
+            "regex_error": regex_error,
+            "parser_error": parser_error,
+        }
+        if not result["equal"]:
+            result["cause"] = get_cause(value, regex_error)
+            result["input"] = value
+            result["regex_output"] = regex_output
+            result["parser_output"] = parser_output
+        results.append(result)
+    return results
+
+
+def get_corpus(paths, include_tests):
+    corpus = list()
+    for path in paths:
+        path = Path(path)
+        if path.is_dir():
+            for relative_path in sorted(list_files(path, include_tests=include_tests)):
+                source = Path(path, relative_path).read_text(errors="replace")
+                if source.strip():
+                    corpus.append((relative_path, source))
+        else:
+            corpus.append((path.name, path.read_text(errors="replace")))
+    return corpus
+
+
+def main(
+    paths,
+    include_tests,
+    num_patches,
+    num_fuzzed,
+    predictions_file,
+    adversarial_sizes,
+    seed,
+    output_file,
+):
+    rng = random.Random(seed)
+    corpus = get_corpus(paths, include_tests)
+    logger.info(f"Found {len(corpus)} source files")
+    results = list()
+    patches = [
+        make_patch(rng, rng.sample(corpus, min(len(corpus), rng.randint(1, 3))))
+        for _ in range(num_patches)
+    ]
+    for patch in tqdm(patches, desc="Generated patches"):
+        results.extend(compare("generated", patch))
+    for _ in tqdm(range(num_fuzzed), desc="Fuzzed patches"):
+        results.extend(compare("fuzzed", fuzz(rng, rng.choice(patches))))
+    if predictions_file is not None:
+        with open(predictions_file) as f:
+            predictions = [json.loads(line) for line in f]
+        for prediction in tqdm(predictions, desc="Predictions"):
+            text = prediction.get("full_output") or prediction.get("model_patch")
+            if text:
+                results.extend(compare("predictions", text))
+    if output_file is not None:
+        with open(output_file, "w") as f:
+            for result in results:
+                print(json.dumps(result), file=f)
+        logger.info(f"Saved results to {output_file}")
+    num_failures = 0
+    for kind in ["generated", "fuzzed", "predictions"]:
+        for name in FUNCTIONS:
+            subset = [r for r in results if r["kind"] == kind and r["function"] == name]
+            if not subset:
+                continue
+            different = [r for r in subset if not r["equal"]]
+            counts = ", ".join(
+                f"{sum(r['cause'] == cause for r in different)} {cause}" for cause in CAUSES
+            )
+            unattributed = [r for r in different if r["cause"] is None]
+            parser_errors = [r for r in subset if r["parser_error"]]
+            regex_time = sum(r["regex_time"] for r in subset)
+            parser_time = sum(r["parser_time"] for r in subset)
+            logger.info(
+                f"{kind} {name}: {len(subset) - len(different)}/{len(subset)} identical; "
+                f"differ on {counts}, {len(unattributed)} unattributed; "
+                f"regex {regex_time:.3f}s, parser {parser_time:.3f}s"
+            )
+            for result in parser_errors[:3]:
+                logger.error(f"Parser raised {result['parser_error']} on {result['input']!r}")
+            for result in unattributed[:3]:
+                logger.error(
+                    f"Differs without a known cause:\n{result['input']!r}\n"
+                    f"regex: {result['regex_output']!r}\nparser: {result['parser_output']!r}"
+                )
+            num_failures += len(set(map(id, parser_errors + unattributed)))
+    for size in adversarial_sizes:
+        for name, text in get_adversarial_inputs(size).items():
+            timings = list()
+            for function_name in ["extract_diff", "repair_patch"]:
+                regex_function, parser_function = FUNCTIONS[function_name]
+                _, _, regex_time = run(regex_function, text)
+                _, _, parser_time = run(parser_function, text)
+                timings.append(
+                    f"{function_name} regex {regex_time:.3f}s, parser {parser_time:.4f}s"
+                )
+            logger.info(f"{name} ({len(text)} chars): " + "; ".join(timings))
+    if num_failures:
+        raise SystemExit(
+            f"{num_failures} comparisons differ without a known cause or the parser raised"
+        )
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "paths",
+        nargs="*",
+        default=[Path(__file__).resolve().parent.as_posix()],
+        help="Python files, or directories to search for Python files, to generate patches of. Defaults to this package.",
+    )
+    parser.add_argument("--include_tests", type=string_to_bool, default=False)
+    parser.add_argument("--num_patches", type=int, default=2000)
+    parser.add_argument("--num_fuzzed", type=int, default=5000)
+    parser.add_argument(
+        "--predictions_file",
+        type=str,
+        default=None,
+        help="Path to a .jsonl file of predictions, whose full_output or model_patch fields are compared too.",
+    )
+    parser.add_argument(
+        "--adversarial_sizes",
+        type=int,
+        nargs="*",
+        default=[10_000, 40_000],
+        help="Sizes in characters of the adversarial inputs to time. The regexes take quadratic time on them.",
+    )
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument(
+        "--output_file",
+        type=str,
+        default=None,
+        help="Path to a .jsonl file with the timings of every comparison and the outputs of those that differ.",
+    )
+    args = parser.parse_args()
+    main(**vars(args))
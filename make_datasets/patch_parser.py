@@ -0,0 +1,226 @@
+"""
+A single-pass parser for the unified diffs in model outputs, behind `utils.repair_patch`,
+`utils.extract_minimal_patch` and `utils.extract_diff`.
+
+Those functions used to find file patches and hunks with DOTALL regexes whose lazy quantifiers
+ran until a lookahead for `diff `, `--- a/` or `@@ -`. On malformed outputs, such as a
+`--- a/` line without a `+++ b/` line or an unclosed `<patch>` tag, every candidate start
+scanned to the end of the text, so the time was quadratic in the length of the output. The
+hunk statistics then split each hunk several times. Here, patches are read line by line in one
+pass. File and hunk boundaries are recognized where the regexes found them, but only at the
+start of a line. Each hunk is split into lines once. Code blocks are found with one scan for
+opening and closing markers. Every step takes time linear in the length of the text.
+
+On well-formed patches the results differ from the regexes only in lines that contain
+`diff `, `--- a/` or `@@ -` after their first character, such as a context line
+`# the diff of a and b`. These no longer cut the patch or the hunk short. Such lines are
+common in code that handles diffs: about 4% of the patches that `patch_parity.py` generates
+from this package differ for this reason. Malformed patches also differ where a `--- a/` line is not directly
+followed by a `+++ b/` line, which the regexes paired with a later `+++ b/` line, and where a
+hunk header is cut short before its closing `@@`, which the regexes took from the next line.
+Run `python patch_parity.py` to compare both implementations on generated and fuzzed patches;
+it fails on any difference without one of these causes.
+"""
+
+import re
+from collections import defaultdict, namedtuple
+
+# a file patch starts at a `--- a/` line directly followed by a `+++ b/` line
+FILE_START_PATTERN = re.compile(r"---\s+a/.")
+FILE_TARGET_PATTERN = re.compile(r"\+\+\+\s+b/.")
+# the `diff` line kept in front of a file patch by repair_patch
+DIFF_HEADER_PATTERN = re.compile(r"diff[\w_. /-]+")
+HUNK_HEADER_PATTERN = re.compile(r"@@\s+-(\d+),(\d+)\s+\+(\d+),(\d+)\s+@@")
+# lines that end the current file patch, and the current hunk
+FILE_BOUNDARIES = ("diff ", "--- a/")
+HUNK_BOUNDARIES = FILE_BOUNDARIES + ("@@ -",)
+
+OPEN_TAG_PATTERN = re.compile(r"<([\w-]+)>")
+CLOSE_TAG_PATTERN = re.compile(r"</([\w-]+)>")
+FENCE_PATTERN = re.compile(r"`{3,}")
+FENCE_INFO_PATTERN = re.compile(r"(\w+)?\n")
+
+FilePatch = namedtuple("FilePatch", ["diff_header", "file_header", "hunks"])
+# lines holds the text after the closing `@@` of the header, then the lines of the hunk
+Hunk = namedtuple("Hunk", ["pre_start", "pre_len", "post_start", "post_len", "lines"])
+
+
+def parse_patch(text):
+    """
+    Splits a patch into the patches of its files.
+
+    Args:
+        text (str): The patch.
+
+    Returns:
+        list: A FilePatch per file. `diff_header` is the `diff` line before the `---` line, or
+            None; `file_header` is the `---` and `+++` lines. Hunks whose header lacks a line
+            count are skipped, like the lines before the first hunk.
+    """
+    lines = text.split("\n")
+    file_patches = list()
+    file_patch = None
+    hunk = None
+    # whether the previous line belonged to no file patch, so it can be a diff header
+    previous_outside = False
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        if hunk is not None and line.startswith(HUNK_BOUNDARIES):
+            # the hunk keeps the newline before the boundary
+            hunk.lines.append("")
+            hunk = None
+        if line.startswith(FILE_BOUNDARIES):
+            file_patch = None
+        if (
+            file_patch is None
+            and FILE_START_PATTERN.match(line)
+            and i + 1 < len(lines)
+            and FILE_TARGET_PATTERN.match(lines[i + 1])
+        ):
+            diff_header = None
+            if previous_outside and DIFF_HEADER_PATTERN.fullmatch(lines[i - 1]):
+                diff_header = lines[i - 1]
+            file_patch = FilePatch(diff_header, line + "\n" + lines[i + 1], list())
+            file_patches.append(file_patch)
+            previous_outside = False
+            i += 2
+            continue
+        previous_outside = file_patch is None
+        i += 1
+        if file_patch is None:
+            continue
+        if hunk is not None:
+            hunk.lines.append(line)
+            continue
+        match = HUNK_HEADER_PATTERN.match(line)
+        if match is not None:
+            hunk = Hunk(*map(int, match.groups()), [line[match.end() :]])
+            file_patch.hunks.append(hunk)
+    if hunk is not None and hunk.lines == [""]:
+        # a header at the very end, with no text after it, is not a hunk
+        file_patch.hunks.pop()
+    return file_patches
+
+
+def count_hunk_lines(lines):
+    """
+    Counts the context, added and removed lines of a hunk body. Empty lines at either end are
+    not counted, except that an empty body counts as one context line.
+
+    Returns:
+        tuple: (context, added, subtracted)
+    """
+    start, end = 0, len(lines)
+    while start < end and not lines[start]:
+        start += 1
+    while end > start and not lines[end - 1]:
+        end -= 1
+    if start == end:
+        return 1, 0, 0
+    added = subtracted = 0
+    for line in lines[start:end]:
+        if line.startswith("-"):
+            subtracted += 1
+        elif line.startswith("+"):
+            added += 1
+    return end - start - added - subtracted, added, subtracted
+
+
+def strip_hunk(lines):
+    """
+    Drops the context lines before the first change of a hunk and all but one after the last,
+    and strips trailing whitespace.
+
+    Args:
+        lines (list): The lines of a hunk, as in Hunk.lines.
+
+    Returns:
+        tuple: (lines, dropped), where `lines` starts with an empty header remainder and ends
+            with an empty line, and `dropped` is the number of leading context lines removed.
+    """
+    changed = [i for i, line in enumerate(lines) if line[:1] in {"-", "+"}]
+    first = changed[0] if changed else len(lines)
+    last = changed[-1] + 2 if changed else 1
+    kept = [line.rstrip() for line in lines[first:last]] or [""]
+    return [""] + kept + [""], first - 1
+
+
+def format_hunks(hunks, minimal=False):
+    """
+    Writes hunks back out with their line counts recomputed from their bodies, and with each
+    start line in the new file shifted by the lines the earlier hunks added or removed.
+
+    Args:
+        hunks (list): The Hunks of one file.
+        minimal (bool, optional): Whether to strip the context around the changes of each hunk
+            first, see `strip_hunk`. Defaults to False.
+
+    Returns:
+        str: The hunks, each with its header.
+    """
+    text = list()
+    total_delta = 0
+    for hunk in hunks:
+        pre_start, lines = hunk.pre_start, hunk.lines
+        if minimal:
+            lines, dropped = strip_hunk(lines)
+            pre_start += dropped
+        context, added, subtracted = count_hunk_lines(lines[1:] if len(lines) > 1 else lines)
+        pre_len = context + subtracted
+        post_start = pre_start + total_delta
+        post_len = context + added
+        total_delta += post_len - pre_len
+        text.append(f"@@ -{pre_start},{pre_len} +{post_start},{post_len} @@")
+        text.append("\n".join(lines))
+    return "".join(text)
+
+
+def iter_tagged_blocks(text):
+    """
+    Yields (tag, body) for every `<tag>body</tag>` block, in order, like
+    `re.findall(r"<([\w-]+)>(.*?)</\1>", text, re.DOTALL)`.
+    """
+    closing = defaultdict(list)
+    for match in CLOSE_TAG_PATTERN.finditer(text):
+        closing[match.group(1)].append(match.start())
+    next_closing = defaultdict(int)
+    end = 0
+    for match in OPEN_TAG_PATTERN.finditer(text):
+        tag = match.group(1)
+        if match.start() < end or tag not in closing:
+            continue
+        # openings only move forward, so each list of closings is walked once
+        positions, j = closing[tag], next_closing[tag]
+        while j < len(positions) and positions[j] < match.end():
+            j += 1
+        next_closing[tag] = j
+        if j == len(positions):
+            continue
+        yield tag, text[match.end() : positions[j]]
+        end = positions[j] + len(tag) + 3
+
+
+def iter_fenced_blocks(text):
+    """
+    Yields (info, body) for every fenced code block, in order, like
+    `re.findall(r"```(\w+)?\n(.*?)```", text, re.DOTALL)`.
+    """
+    # every position a run of backticks can open or close a fence at
+    fences = list()
+    for match in FENCE_PATTERN.finditer(text):
+        fences.extend(range(match.start(), match.end() - 2))
+    j = 0
+    end = 0
+    for position in fences:
+        if position < end:
+            continue
+        match = FENCE_INFO_PATTERN.match(text, position + 3)
+        if match is None:
+            continue
+        while j < len(fences) and fences[j] < match.end():
+            j += 1
+        if j == len(fences):
+            return
+        yield match.group(1) or "", text[match.end() : fences[j]]
+        end = fences[j] + 3
@@ -0,0 +1,97 @@
+"""
+A small staged pipeline with bounded queues between stages.
+
+Each stage runs its function on a pool of worker threads, reading from the queue of the
+previous stage and writing to its own. Queues are bounded, so a fast stage blocks instead
+of running arbitrarily far ahead of a slow one, and items reach the end of the pipeline as
+soon as they have passed every stage. CPU-bound stages can hand their work to a process
+pool from inside the stage function.
+"""
+
+import logging
+import threading
+import traceback
+from queue import Queue
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class Stage:
+    """
+    One step of a pipeline.
+
+    Args:
+        name (str): The name of the stage, used in log messages.
+        func (function): Called with each input item. Returns the item passed to the next stage,
+            or None to drop it. Exceptions are logged and the item is dropped.
+        num_workers (int, optional): The number of threads running `func`. Defaults to 1.
+    """
+
+    def __init__(self, name, func, num_workers=1):
+        self.name = name
+        self.func = func
+        self.num_workers = num_workers
+
+
+def _run_stage(stage, in_queue, out_queue, remaining_workers, lock):
+    while True:
+        item = in_queue.get()
+        if item is _STOP:
+            in_queue.put(_STOP)  # let the other workers of this stage see it too
+            with lock:
+                remaining_workers[0] -= 1
+                if remaining_workers[0] == 0:
+                    out_queue.put(_STOP)
+            return
+        try:
+            result = stage.func(item)
+        except Exception:
+            logger.error(f"Stage {stage.name} failed")
+            logger.error(traceback.format_exc())
+            continue
+        if result is not None:
+            out_queue.put(result)
+
+
+def run_pipeline(items, stages, queue_size=8):
+    """
+    Runs items through the stages and yields the output of the last stage as it is produced.
+
+    Args:
+        items (iterable): The inputs of the first stage.
+        stages (list): The `Stage`s to run, in order.
+        queue_size (int, optional): The capacity of each queue between stages. Defaults to 8.
+
+    Yields:
+        The outputs of the last stage, in completion order.
+    """
+    queues = [Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+
+    def feed():
+        for item in items:
+            queues[0].put(item)
+        queues[0].put(_STOP)
+
+    threads = [threading.Thread(target=feed, daemon=True)]
+    for i, stage in enumerate(stages):
+        remaining_workers = [stage.num_workers]
+        lock = threading.Lock()
+        for _ in range(stage.num_workers):
+            threads.append(
+                threading.Thread(
+                    target=_run_stage,
+                    args=(stage, queues[i], queues[i + 1], remaining_workers, lock),
+                    daemon=True,
+                )
+            )
+    for thread in threads:
+        thread.start()
+    while True:
+        item = queues[-1].get()
+        if item is _STOP:
+            break
+        yield item
+    for thread in threads:
+        thread.join()
@@ -0,0 +1,281 @@
+"""
+Single-writer output for retrieval results.
+
+Instead of every writer taking a FileLock on the final `.retrieval.jsonl` for each line, each
+process appends batches of lines to its own segment file from one writer thread, next to a
+plain text file of the instance IDs it completed. Segments are merged and deduplicated into the
+final file once, at the end of a run, and the completed IDs of the final file are kept in a
+sidecar `.ids` file so resuming does not have to parse the results. A segment is locked while
+its process writes to it, so segments left behind by a crashed run are merged by the next one.
+
+Layout for an output file `<name>.retrieval.jsonl`:
+    <name>.retrieval.jsonl                               merged results
+    <name>.retrieval.jsonl.ids                           instance IDs in the merged results
+    <name>.retrieval.jsonl.segments/<shard>-<pid>.jsonl  results of one process, not merged yet
+    <name>.retrieval.jsonl.segments/<shard>-<pid>.ids    instance IDs in that segment
+    <name>.retrieval.jsonl.segments/<shard>-<pid>.lock   held while the process writes
+"""
+
+import os
+import json
+import logging
+import threading
+from filelock import FileLock, Timeout
+from pathlib import Path
+from queue import Queue, Empty
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+def get_segments_dir(output_file):
+    output_file = Path(output_file)
+    return output_file.with_name(output_file.name + ".segments")
+
+
+def get_output_ids_path(output_file):
+    output_file = Path(output_file)
+    return output_file.with_name(output_file.name + ".ids")
+
+
+def _read_ids(ids_path):
+    with open(ids_path) as f:
+        return {line.rstrip("\n") for line in f if line.strip()}
+
+
+def _truncate_partial_line(path):
+    """
+    Cuts off a last line without a newline, left by a crash in the middle of a write, so lines
+    appended later do not run into it.
+    """
+    with open(path, "rb+") as f:
+        size = end = f.seek(0, os.SEEK_END)
+        while end > 0:
+            start = max(end - 4096, 0)
+            f.seek(start)
+            newline = f.read(end - start).rfind(b"\n")
+            if newline >= 0:
+                end = start + newline + 1
+                break
+            end = start
+        if end < size:
+            f.truncate(end)
+
+
+def _parse_ids(results_path):
+    instance_ids = set()
+    with open(results_path) as f:
+        for line in f:
+            try:
+                instance_ids.add(json.loads(line)["instance_id"])
+            except (json.JSONDecodeError, KeyError):
+                continue  # a line cut short by a crash
+    return instance_ids
+
+
+def _load_output_ids(output_file):
+    """
+    Returns the instance IDs in the merged output file, rebuilding the `.ids` sidecar if it is
+    missing or older than the output file (e.g. a results file written by an earlier version).
+    """
+    output_file = Path(output_file)
+    if not output_file.exists():
+        return set()
+    ids_path = get_output_ids_path(output_file)
+    if ids_path.exists() and ids_path.stat().st_mtime >= output_file.stat().st_mtime:
+        return _read_ids(ids_path)
+    instance_ids = _parse_ids(output_file)
+    tmp_path = ids_path.with_name(ids_path.name + ".tmp")
+    with open(tmp_path, "w") as f:
+        f.writelines(f"{instance_id}\n" for instance_id in instance_ids)
+    os.replace(tmp_path, ids_path)
+    return instance_ids
+
+
+def load_completed_ids(output_file):
+    """
+    Returns the IDs of every instance with results, merged or still in a segment.
+
+    Args:
+        output_file (Path): The path to the final `.retrieval.jsonl` file.
+
+    Returns:
+        set: The completed instance IDs.
+    """
+    with FileLock(Path(output_file).as_posix() + ".lock"):
+        instance_ids = _load_output_ids(output_file)
+    segments_dir = get_segments_dir(output_file)
+    if segments_dir.exists():
+        for ids_path in segments_dir.glob("*.ids"):
+            instance_ids |= _read_ids(ids_path)
+    return instance_ids
+
+
+def merge_segments(output_file, segment_paths=None):
+    """
+    Appends the results of segments to the output file, skipping instances that are already
+    there, and removes the merged segments. Segments that another process is still writing to
+    are left alone.
+
+    Args:
+        output_file (Path): The path to the final `.retrieval.jsonl` file.
+        segment_paths (list, optional): The segment `.jsonl` files to merge. Defaults to every
+            segment.
+
+    Returns:
+        int: The number of results added to the output file.
+    """
+    output_file = Path(output_file)
+    if segment_paths is None:
+        segment_paths = sorted(get_segments_dir(output_file).glob("*.jsonl"))
+    segment_locks = list()
+    for segment_path in map(Path, segment_paths):
+        segment_lock = FileLock(segment_path.with_suffix(".lock").as_posix())
+        try:
+            segment_lock.acquire(timeout=0)
+        except Timeout:
+            continue  # still being written
+        if not segment_path.exists():  # merged by another process
+            segment_lock.release()
+            continue
+        segment_locks.append((segment_path, segment_lock))
+    if not segment_locks:
+        return 0
+    segment_paths = [segment_path for segment_path, _ in segment_locks]
+    num_added = 0
+    with FileLock(output_file.as_posix() + ".lock"):
+        instance_ids = _load_output_ids(output_file)
+        new_ids = list()
+        with open(output_file, "a") as out_file:
+            for segment_path in segment_paths:
+                with open(segment_path) as f:
+                    for line in f:
+                        if not line.endswith("\n"):
+                            break  # cut short by a crash
+                        try:
+                            instance_id = json.loads(line)["instance_id"]
+                        except (json.JSONDecodeError, KeyError):
+                            continue
+                        if instance_id in instance_ids:
+                            continue
+                        instance_ids.add(instance_id)
+                        new_ids.append(instance_id)
+                        out_file.write(line)
+        with open(get_output_ids_path(output_file), "a") as f:
+            f.writelines(f"{instance_id}\n" for instance_id in new_ids)
+        num_added = len(new_ids)
+        for segment_path, segment_lock in segment_locks:
+            segment_path.unlink()
+            segment_path.with_suffix(".ids").unlink(missing_ok=True)
+            segment_lock.release()
+            segment_path.with_suffix(".lock").unlink(missing_ok=True)
+    logger.info(
+        f"Merged {len(segment_paths)} segments into {output_file} ({num_added} new results)"
+    )
+    return num_added
+
+
+class ResultSink:
+    """
+    Writes retrieval results to the segment of one shard from a single background thread.
+
+    `write` can be called from any thread; lines are queued and written in batches. The segment
+    is named after the shard and the pid of this process, so no other process writes to it, and
+    it is locked until `close` so `merge_segments` leaves it alone.
+
+    Args:
+        output_file (Path): The path to the final `.retrieval.jsonl` file.
+        shard_id (int, optional): The shard this process handles, used to name the segment.
+        batch_size (int, optional): The maximum number of results written per batch. Defaults to 64.
+
+    Attributes:
+        segment_path (Path): The segment file this sink appends to.
+        num_written (int): The number of results written so far.
+        error (Exception): What stopped the writer thread, or None.
+    """
+
+    def __init__(self, output_file, shard_id=None, batch_size=64):
+        self.output_file = Path(output_file)
+        self.batch_size = batch_size
+        shard_name = "main" if shard_id is None else f"shard{shard_id}"
+        segments_dir = get_segments_dir(self.output_file)
+        segments_dir.mkdir(parents=True, exist_ok=True)
+        self.segment_path = Path(segments_dir, f"{shard_name}-{os.getpid()}.jsonl")
+        self.segment_lock = FileLock(self.segment_path.with_suffix(".lock").as_posix())
+        self.segment_lock.acquire()
+        self.num_written = 0
+        self.error = None
+        self.queue = Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def write(self, results):
+        """
+        Queues the results of one instance. None (a failed instance) is ignored.
+
+        Raises:
+            RuntimeError: If the writer thread has stopped on an error.
+        """
+        self._check_error()
+        if results is not None:
+            self.queue.put(results)
+
+    def _check_error(self):
+        if self.error is not None:
+            raise RuntimeError(f"Writing to {self.segment_path} failed") from self.error
+
+    def _run(self):
+        try:
+            self._write_batches()
+        except BaseException as e:
+            self.error = e
+            logger.error(f"Writing to {self.segment_path} failed: {e!r}")
+
+    def _write_batches(self):
+        ids_path = self.segment_path.with_suffix(".ids")
+        # a segment of an earlier process with the same pid may end in a partial line
+        for path in (self.segment_path, ids_path):
+            if path.exists():
+                _truncate_partial_line(path)
+        with open(self.segment_path, "a") as out_file, open(ids_path, "a") as ids_file:
+            stop = False
+            while not stop:
+                batch = [self.queue.get()]
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(self.queue.get_nowait())
+                    except Empty:
+                        break
+                if batch[-1] is _STOP:
+                    stop = True
+                    batch.pop()
+                if not batch:
+                    continue
+                out_file.write("".join(json.dumps(results) + "\n" for results in batch))
+                out_file.flush()
+                os.fsync(out_file.fileno())
+                # only record the IDs once their results are on disk
+                ids_file.write("".join(f"{results['instance_id']}\n" for results in batch))
+                ids_file.flush()
+                self.num_written += len(batch)
+
+    def close(self):
+        """
+        Writes the remaining queued results, stops the writer thread and unlocks the segment.
+
+        Raises:
+            RuntimeError: If the writer thread stopped on an error.
+        """
+        if self.thread.is_alive():
+            self.queue.put(_STOP)
+            self.thread.join()
+        if self.segment_lock.is_locked:
+            self.segment_lock.release()
+        self._check_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
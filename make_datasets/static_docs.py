@@ -0,0 +1,409 @@
+"""
+Static extraction of the definitions and docstrings that `file_name_and_docs_jedi` indexes.
+
+`file_name_and_docs_jedi` asks jedi for every name defined in a file and resolves each one with
+`goto(follow_imports=True)` to drop names that come from other modules, which costs seconds on
+a large module. The same listing can be read off the syntax tree in one walk: imports are the
+only definitions that resolve to another module, and jedi's docstrings of functions and classes
+are their signatures followed by their docstrings. Module names are derived from the file's
+path relative to the project root that jedi would pick, with directory lookups memoized.
+
+Signatures that jedi infers across modules cannot be read off the tree and differ: classes
+whose `__init__` is inherited from an imported class, `*args, **kwargs` forwarded to another
+function, and decorators other than the common builtin ones. `docs_parity.py` compares both
+encoders on a corpus and reports such differences.
+"""
+
+import os
+import ast
+import inspect
+import builtins
+import functools
+
+# the files and directories jedi looks for to find the root of a project
+PROJECT_MARKERS = ("setup.py", ".git", ".hg", "requirements.txt", "MANIFEST.in", "pyproject.toml")
+# decorators whose functions jedi documents by their docstring only, without a signature
+DOC_ONLY_DECORATORS = {"property", "cached_property", "classmethod", "setter", "getter", "deleter"}
+# functools decorators that jedi resolves to their typeshed wrapper when used without arguments
+CACHE_DECORATORS = {"lru_cache", "cache"}
+CACHE_WRAPPER_SIGNATURE = "_lru_cache_wrapper(*args: Hashable, **kwargs: Hashable) -> _T"
+# the parameters jedi reads from typeshed for classes derived from common builtins
+BUILTIN_CLASS_PARAMS = {
+    "list": ["", "iterable: Iterable[_T]"],
+    "set": ["iterable: Iterable[_T]=..."],
+    "tuple": ["iterable: Iterable[_T_co]=..."],
+    "str": ["o: object=...", "o: bytes, encoding: str=..., errors: str=..."],
+    "int": [
+        "x: Union[str, bytes, SupportsInt, _SupportsIndex, _SupportsTrunc]=...",
+        "x: Union[str, bytes, bytearray], base: int",
+    ],
+    "dict": [
+        "**kwargs: _VT",
+        "map: Mapping[_KT, _VT], **kwargs: _VT",
+        "iterable: Iterable[Tuple[_KT, _VT]], **kwargs: _VT",
+    ],
+    "type": ["o: object", "name: str, bases: Tuple[type, ...], dict: Dict[str, Any]"],
+}
+BUILTIN_EXCEPTIONS = {
+    name
+    for name, value in vars(builtins).items()
+    if isinstance(value, type) and issubclass(value, BaseException)
+}
+
+
+@functools.lru_cache(maxsize=65536)
+def _dir_info(dirpath, mtime_ns):
+    """
+    Returns (is_package, is_project) for a directory. The modification time is part of the key,
+    so adding or removing an `__init__.py`, e.g. by checking out another commit, is noticed.
+    """
+    if mtime_ns is None:
+        return False, False
+    is_package = os.path.isfile(os.path.join(dirpath, "__init__.py"))
+    is_project = any(
+        os.path.exists(os.path.join(dirpath, marker)) for marker in PROJECT_MARKERS
+    )
+    manage_py = os.path.join(dirpath, "manage.py")
+    if not is_project and os.path.isfile(manage_py):
+        with open(manage_py, "rb") as f:
+            is_project = b"DJANGO_SETTINGS_MODULE" in f.read()
+    return is_package, is_project
+
+
+def _get_dir_info(dirpath):
+    try:
+        mtime_ns = os.stat(dirpath).st_mtime_ns
+    except OSError:
+        mtime_ns = None
+    return _dir_info(dirpath, mtime_ns)
+
+
+def get_project_root(filename):
+    """
+    Returns the directory jedi would use as the project root of `filename`: the closest
+    ancestor with a project marker, skipping the packages directly around the file.
+    """
+    filename = os.path.abspath(filename)
+    first_non_package = None
+    dirpath = os.path.dirname(filename)
+    while True:
+        is_package, is_project = _get_dir_info(dirpath)
+        if first_non_package is None and is_package:
+            pass  # a package sits at least one level below its project
+        else:
+            if first_non_package is None:
+                first_non_package = dirpath
+            if is_project:
+                return dirpath
+        parent = os.path.dirname(dirpath)
+        if parent == dirpath:
+            break
+        dirpath = parent
+    if first_non_package is not None:
+        return first_non_package
+    return os.path.dirname(filename)
+
+
+def get_module_name(filename):
+    """
+    Returns the dotted module name jedi gives `filename`, e.g. `pkg.sub` for `pkg/sub/__init__.py`.
+    """
+    filename = os.path.abspath(filename)
+    relative_path = os.path.relpath(filename, get_project_root(filename))
+    if relative_path.endswith(".py"):
+        relative_path = relative_path[: -len(".py")]
+    parts = relative_path.split(os.sep)
+    if len(parts) > 1 and parts[-1] == "__init__":
+        parts = parts[:-1]
+    return ".".join(parts)
+
+
+def _decorator_name(decorator):
+    if isinstance(decorator, ast.Call):
+        decorator = decorator.func
+    if isinstance(decorator, ast.Attribute):
+        return decorator.attr
+    if isinstance(decorator, ast.Name):
+        return decorator.id
+    return None
+
+
+class _DocExtractor:
+    def __init__(self, source):
+        # ast.get_source_segment splits the whole source on every call, so split it once
+        self.lines = [
+            line.encode("utf-8")
+            for line in source.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+        ]
+        self.entries = list()
+        self.classes = dict()
+        self.overloads = dict()
+        self.statement_docs = dict()
+        self.statement_doc = ""
+
+    def segment(self, node):
+        """
+        Returns the source text of a node. Column offsets are in UTF-8 bytes.
+        """
+        first, last = node.lineno - 1, node.end_lineno - 1
+        if first == last:
+            return self.lines[first][node.col_offset : node.end_col_offset].decode("utf-8")
+        lines = [self.lines[first][node.col_offset :]]
+        lines += self.lines[first + 1 : last]
+        lines.append(self.lines[last][: node.end_col_offset])
+        return b"\n".join(lines).decode("utf-8")
+
+    def format_param(self, arg, default=None, prefix=""):
+        # jedi treats parameters starting with __ as positional-only and drops the underscores
+        name = arg.arg[2:] if arg.arg.startswith("__") else arg.arg
+        text = prefix + name
+        if arg.annotation is not None:
+            text += f": {self.segment(arg.annotation)}"
+        if default is not None:
+            text += f"={self.segment(default)}"
+        return text
+
+    def format_params(self, args, skip_first=False):
+        """
+        Formats parameters like jedi's `Signature.to_string`, inserting `/` after the
+        positional-only parameters and `*` before keyword-only ones without `*args`.
+        """
+        positional = args.posonlyargs + args.args
+        defaults = [None] * (len(positional) - len(args.defaults)) + args.defaults
+        params = [
+            (arg in args.posonlyargs or arg.arg.startswith("__"), self.format_param(arg, default))
+            for arg, default in zip(positional, defaults)
+        ]
+        if skip_first:
+            params = params[1:]
+        strings = list()
+        is_positional = False
+        for positional_only, text in params:
+            is_positional |= positional_only
+            if is_positional and not positional_only:
+                strings.append("/")
+                is_positional = False
+            strings.append(text)
+        if is_positional:
+            strings.append("/")
+        if args.vararg is not None:
+            strings.append(self.format_param(args.vararg, prefix="*"))
+        elif args.kwonlyargs:
+            strings.append("*")
+        strings += [
+            self.format_param(arg, default)
+            for arg, default in zip(args.kwonlyargs, args.kw_defaults)
+        ]
+        if args.kwarg is not None:
+            strings.append(self.format_param(args.kwarg, prefix="**"))
+        return ", ".join(strings)
+
+    def function_signature(self, node, name=None, skip_first=False):
+        signature = f"{name or node.name}({self.format_params(node.args, skip_first)})"
+        # a class named after its __init__ shows no return annotation
+        if node.returns is not None and name is None:
+            signature += f" -> {self.segment(node.returns)}"
+        return signature
+
+    def function_docstring(self, node):
+        docstring = ast.get_docstring(node) or ""
+        decorators = [_decorator_name(d) for d in node.decorator_list]
+        if any(decorator in DOC_ONLY_DECORATORS for decorator in decorators):
+            return docstring
+        if any(
+            decorator in CACHE_DECORATORS and not isinstance(d, ast.Call)
+            for decorator, d in zip(decorators, node.decorator_list)
+        ):
+            signature = CACHE_WRAPPER_SIGNATURE
+        else:
+            signature = "\n".join(
+                self.function_signature(overload)
+                for overload in self.overloads.get(node, [node])
+            )
+        return f"{signature}\n\n{docstring}" if docstring else signature
+
+    def class_signatures(self, node, seen=None):
+        seen = set() if seen is None else seen
+        seen.add(node.name)
+        for child in node.body:
+            if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef)) and child.name == "__init__":
+                return [
+                    self.function_signature(overload, node.name, skip_first=True)
+                    for overload in self.overloads.get(child, [child])
+                ]
+        if any(_decorator_name(d) == "dataclass" for d in node.decorator_list):
+            params = ", ".join(
+                f"{child.target.id}: {self.segment(child.annotation)}"
+                + (f"={self.segment(child.value)}" if child.value is not None else "")
+                for child in node.body
+                if isinstance(child, ast.AnnAssign) and isinstance(child.target, ast.Name)
+            )
+            return [f"{node.name}({params})"]
+        for base in node.bases:
+            if not isinstance(base, ast.Name):
+                continue
+            if base.id in self.classes and base.id not in seen:
+                return [
+                    node.name + signature[signature.index("(") :]
+                    for signature in self.class_signatures(self.classes[base.id], seen)
+                ]
+            if base.id in BUILTIN_CLASS_PARAMS:
+                return [f"{node.name}({params})" for params in BUILTIN_CLASS_PARAMS[base.id]]
+            if base.id in BUILTIN_EXCEPTIONS:
+                return [f"{node.name}(*args: object)"]
+        return [f"{node.name}()"]
+
+    def class_docstring(self, node):
+        docstring = ast.get_docstring(node) or ""
+        signature = "\n".join(self.class_signatures(node))
+        return f"{signature}\n\n{docstring}" if docstring else signature
+
+    def index_blocks(self, tree):
+        """
+        Finds what jedi reads from neighbouring statements of the same block:
+
+        - the `@overload` functions preceding a function of the same name, which jedi shows as
+          its signatures, plus the function itself if it is an overload too, and
+        - the string literal following an assignment, which jedi shows as the docstring of the
+          assigned names.
+        """
+        for node in ast.walk(tree):
+            for field in ("body", "orelse", "finalbody"):
+                block = getattr(node, field, None)
+                if not isinstance(block, list):
+                    continue
+                chains = dict()
+                for child, next_child in zip(block, block[1:] + [None]):
+                    if isinstance(child, (ast.Assign, ast.AnnAssign, ast.AugAssign)):
+                        if (
+                            isinstance(next_child, ast.Expr)
+                            and isinstance(next_child.value, ast.Constant)
+                            and isinstance(next_child.value.value, str)
+                        ):
+                            self.statement_docs[child] = inspect.cleandoc(next_child.value.value)
+                    if not isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                        continue
+                    chain = chains.pop(child.name, list())
+                    # like jedi, only a plain `@overload` counts, not `@typing.overload`
+                    if any(
+                        isinstance(d, ast.Name) and d.id == "overload"
+                        for d in child.decorator_list
+                    ):
+                        chain = chain + [child]
+                        chains[child.name] = chain
+                    if chain:
+                        self.overloads[child] = chain
+
+    def add(self, node, full_name, docstring="", col_offset=None):
+        col_offset = node.col_offset if col_offset is None else col_offset
+        self.entries.append(((node.lineno, col_offset), full_name, docstring))
+
+    def visit(self, node, scope, at_module, in_function=False):
+        """
+        Records the definitions under `node`.
+
+        Args:
+            node (ast.AST): The node whose children are visited.
+            scope (str): The qualified name of the enclosing function or class, or None where
+                jedi gives no qualified names, i.e. below a function that is not the
+                immediate parent.
+            at_module (bool): Whether the enclosing scope is the module itself, the only scope
+                whose variables jedi lists.
+            in_function (bool): Whether the enclosing scope is a function.
+        """
+        for child in ast.iter_child_nodes(node):
+            if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                full_name = None if scope is None else f"{scope}.{child.name}"
+                if isinstance(child, ast.ClassDef):
+                    self.add(child, full_name, self.class_docstring(child))
+                    outer = child.decorator_list + child.bases + child.keywords
+                else:
+                    self.add(child, full_name, self.function_docstring(child))
+                    outer = list(child.decorator_list)
+                    if child.returns is not None:
+                        outer.append(child.returns)
+                    # lambdas among the defaults of a function are not listed
+                    self.visit(child.args, scope, False)
+                for outer_node in outer:
+                    self.visit_node(outer_node, scope, at_module)
+                body_scope = None if in_function else full_name
+                for body_node in child.body:
+                    self.visit_node(
+                        body_node, body_scope, False, not isinstance(child, ast.ClassDef)
+                    )
+            elif isinstance(child, ast.Lambda):
+                if at_module:
+                    # jedi lists the parameters of module-level lambdas without a name
+                    args = child.args
+                    for arg in args.posonlyargs + args.args + args.kwonlyargs:
+                        self.add(arg, None)
+                    for arg in (args.vararg, args.kwarg):
+                        if arg is not None:
+                            self.add(arg, None)
+                self.visit(child, scope, at_module, in_function)
+            elif at_module and isinstance(child, (ast.Assign, ast.AnnAssign, ast.AugAssign)):
+                # only the assigned names get the docstring of the statement
+                targets = child.targets if isinstance(child, ast.Assign) else [child.target]
+                self.statement_doc = self.statement_docs.get(child, "")
+                for target in targets:
+                    self.visit_node(target, scope, at_module, in_function)
+                self.statement_doc = ""
+                for value in (getattr(child, "annotation", None), child.value):
+                    if value is not None:
+                        self.visit_node(value, scope, at_module, in_function)
+            elif isinstance(child, ast.Name):
+                if at_module and isinstance(child.ctx, (ast.Store, ast.Del)):
+                    self.add(child, f"{scope}.{child.id}", self.statement_doc)
+            elif isinstance(child, ast.ExceptHandler):
+                if at_module and child.name is not None:
+                    self.add(child, f"{scope}.{child.name}", col_offset=child.col_offset + 1)
+                self.visit(child, scope, at_module, in_function)
+            elif isinstance(child, (ast.Import, ast.ImportFrom, ast.Global, ast.Nonlocal)):
+                continue  # imports resolve to other modules and are never listed
+            else:
+                if at_module and isinstance(child, (ast.MatchAs, ast.MatchStar)) and child.name:
+                    self.add(child, f"{scope}.{child.name}")
+                if at_module and isinstance(child, ast.MatchMapping) and child.rest:
+                    self.add(child, f"{scope}.{child.rest}")
+                self.visit(child, scope, at_module, in_function)
+
+    def visit_node(self, node, scope, at_module, in_function=False):
+        # visit() looks at the children of a node, so wrap single nodes to look at them too
+        if isinstance(node, ast.stmt):
+            wrapper = ast.Module(body=[node], type_ignores=[])
+        else:
+            wrapper = ast.Expr(value=node)
+        self.visit(wrapper, scope, at_module, in_function)
+
+
+def extract_docs(source, module_name):
+    """
+    Lists the definitions of a module with their docstrings, as `file_name_and_docs_jedi` does.
+
+    Args:
+        source (str): The source code of the module.
+        module_name (str): The dotted name of the module, see `get_module_name`.
+
+    Returns:
+        str: The module name and docstring, then the qualified name and docstring of every
+            definition, in source order.
+
+    Raises:
+        SyntaxError: If the source cannot be parsed.
+    """
+    tree = ast.parse(source)
+    extractor = _DocExtractor(source)
+    extractor.classes = {
+        node.name: node for node in tree.body if isinstance(node, ast.ClassDef)
+    }
+    extractor.index_blocks(tree)
+    extractor.visit(tree, module_name, True)
+    text = f"{module_name}\n"
+    docstring = ast.get_docstring(tree)
+    if docstring:
+        text += f"{docstring}\n\n"
+    for _, full_name, docstring in sorted(extractor.entries, key=lambda x: x[0]):
+        text += f"{full_name}\n"
+        if docstring:
+            text += f"{docstring}\n\n"
+    return text
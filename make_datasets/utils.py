@@ -1,110 +1,56 @@
 import os
 import re
-import ast
-import chardet
+import threading
 import subprocess
 from argparse import ArgumentTypeError
+from filelock import FileLock
 from git import Repo
 from pathlib import Path
 from tempfile import TemporaryDirectory
 
-
-DIFF_PATTERN = re.compile(r"^diff(?:.*)")
-PATCH_PATTERN = re.compile(
-    r"(?:diff[\w\_\.\ \/\-]+\n)?\-\-\-\s+a\/(?:.*?)\n\+\+\+\s+b\/(?:.*?)(?=diff\ |\-\-\-\ a\/|\Z)",
-    re.DOTALL,
-)
-PATCH_FILE_PATTERN = re.compile(r"\-\-\-\s+a\/(?:.+)\n\+\+\+\s+b\/(?:.+)")
-PATCH_HUNK_PATTERN = re.compile(
-    r"\@\@\s+\-(\d+),(\d+)\s+\+(\d+),(\d+)\s+\@\@(.+?)(?=diff\ |\-\-\-\ a\/|\@\@\ \-|\Z)",
-    re.DOTALL,
-)
-
-
-def get_first_idx(charlist):
-    first_min = charlist.index('-')  if '-' in charlist else len(charlist)
-    first_plus = charlist.index('+') if '+' in charlist else len(charlist)
-    return min(first_min, first_plus)
-
-def get_last_idx(charlist):
-    char_idx = get_first_idx(charlist[::-1])
-    last_idx = len(charlist) - char_idx
-    return last_idx + 1
-
-def strip_content(hunk):
-    first_chars = list(map(lambda x: None if not len(x) else x[0], hunk.split('\n')))
-    first_idx = get_first_idx(first_chars)
-    last_idx = get_last_idx(first_chars)
-    new_lines = list(map(lambda x: x.rstrip(), hunk.split('\n')[first_idx:last_idx]))
-    new_hunk = '\n' + '\n'.join(new_lines) + '\n'
-    return new_hunk, first_idx - 1
-
-
-def get_hunk_stats(pre_start, pre_len, post_start, post_len, hunk, total_delta):
-    stats = {"context": 0, "added": 0, "subtracted": 0}
-    hunk = hunk.split("\n", 1)[-1].strip("\n")
-    for line in hunk.split("\n"):
-        if line.startswith("-"):
-            stats["subtracted"] += 1
-        elif line.startswith("+"):
-            stats["added"] += 1
-        else:
-            stats["context"] += 1
-    context = stats["context"]
-    added = stats["added"]
-    subtracted = stats["subtracted"]
-    pre_len = context + subtracted
-    post_start = pre_start + total_delta
-    post_len = context + added
-    total_delta = total_delta + (post_len - pre_len)
-    return pre_start, pre_len, post_start, post_len, total_delta
+try:
+    from worktree_pool import WorktreePool
+    from mirror_cache import MirrorCache
+    from file_manifest import FileManifest
+    from file_ingestion import decode_bytes, read_files
+    from module_index import ModuleIndex, get_module_index, get_imported_modules
+    from patch_parser import parse_patch, format_hunks, iter_tagged_blocks, iter_fenced_blocks
+except:
+    from .worktree_pool import WorktreePool
+    from .mirror_cache import MirrorCache
+    from .file_manifest import FileManifest
+    from .file_ingestion import decode_bytes, read_files
+    from .module_index import ModuleIndex, get_module_index, get_imported_modules
+    from .patch_parser import parse_patch, format_hunks, iter_tagged_blocks, iter_fenced_blocks
 
 
 def repair_patch(model_patch):
+    """
+    Rewrites the line counts of every hunk header from the lines of the hunk, and the start
+    lines in the new file from the changes of the earlier hunks. See `patch_parser`.
+    """
     if model_patch is None:
         return None
-    model_patch = model_patch.lstrip("\n")
-    new_patch = ""
-    for patch in PATCH_PATTERN.findall(model_patch):
-        total_delta = 0
-        diff_header = DIFF_PATTERN.findall(patch)
-        if diff_header:
-            new_patch += diff_header[0] + "\n"
-        patch_header = PATCH_FILE_PATTERN.findall(patch)[0]
-        if patch_header:
-            new_patch += patch_header + "\n"
-        for hunk in PATCH_HUNK_PATTERN.findall(patch):
-            pre_start, pre_len, post_start, post_len, content = hunk
-            pre_start, pre_len, post_start, post_len, total_delta = get_hunk_stats(
-                *list(map(lambda x: int(x) if x.isnumeric() else x, hunk)), total_delta
-            )
-            new_patch += (
-                f"@@ -{pre_start},{pre_len} +{post_start},{post_len} @@{content}"
-            )
-    return new_patch
+    new_patch = list()
+    for file_patch in parse_patch(model_patch.lstrip("\n")):
+        if file_patch.diff_header is not None:
+            new_patch.append(file_patch.diff_header + "\n")
+        new_patch.append(file_patch.file_header + "\n")
+        new_patch.append(format_hunks(file_patch.hunks))
+    return "".join(new_patch)
 
 
 def extract_minimal_patch(model_patch):
+    """
+    Like `repair_patch`, but drops the `diff` lines and the context before the first and after
+    the last change of each hunk, and strips trailing whitespace.
+    """
     model_patch = model_patch.lstrip("\n")
-    new_patch = ""
-    for patch in PATCH_PATTERN.findall(model_patch):
-        total_delta = 0
-        diff_header = DIFF_PATTERN.findall(patch)
-        patch_header = PATCH_FILE_PATTERN.findall(patch)[0]
-        if patch_header:
-            new_patch += patch_header + "\n"
-        for hunk in PATCH_HUNK_PATTERN.findall(patch):
-            pre_start, pre_len, post_start, post_len, content = hunk
-            pre_start, pre_len, post_start, post_len, content = list(map(lambda x: int(x) if x.isnumeric() else x, hunk))
-            content, adjust_pre_start = strip_content(content)
-            pre_start += adjust_pre_start
-            pre_start, pre_len, post_start, post_len, total_delta = get_hunk_stats(
-                pre_start, pre_len, post_start, post_len, content, total_delta
-            )
-            new_patch += (
-                f"@@ -{pre_start},{pre_len} +{post_start},{post_len} @@{content}"
-            )
-    return new_patch
+    new_patch = list()
+    for file_patch in parse_patch(model_patch):
+        new_patch.append(file_patch.file_header + "\n")
+        new_patch.append(format_hunks(file_patch.hunks, minimal=True))
+    return "".join(new_patch)
 
 
 def extract_diff(response):
@@ -113,24 +59,15 @@ def extract_diff(response):
     """
     if response is None:
         return None
-    diff_matches = []
-    other_matches = []
-    pattern = re.compile(r"\<([\w-]+)\>(.*?)\<\/\1\>", re.DOTALL)
-    for code, match in pattern.findall(response):
-        if code in {"diff", "patch"}:
-            diff_matches.append(match)
-        else:
-            other_matches.append(match)
-    pattern = re.compile(r"```(\w+)?\n(.*?)```", re.DOTALL)
-    for code, match in pattern.findall(response):
-        if code in {"diff", "patch"}:
-            diff_matches.append(match)
-        else:
-            other_matches.append(match)
-    if diff_matches:
-        return diff_matches[0]
-    if other_matches:
-        return other_matches[0]
+    other_match = None
+    for blocks in (iter_tagged_blocks(response), iter_fenced_blocks(response)):
+        for code, match in blocks:
+            if code in {"diff", "patch"}:
+                return match
+            if other_match is None:
+                other_match = match
+    if other_match is not None:
+        return other_match
     return response.split("</s>")[0]
 
 
@@ -142,44 +79,115 @@ def is_test(name, test_phrases=None):
 
 
 class ContextManager:
-    def __init__(self, repo_path, base_commit, verbose=False):
+    """
+    A context manager for reading a Git repository at a specific commit.
+
+    The working directory of the process is never changed: git commands run with
+    `cwd=repo_path`, and files are read through `get_path` or `read_files`. Contexts on
+    different repositories, on leased worktrees or with `checkout=False` can therefore be used
+    from several threads at once.
+
+    Args:
+        repo_path (str): The path to the Git repository.
+        base_commit (str): The commit hash to switch to.
+        verbose (bool, optional): Whether to print the output of git. Defaults to False.
+        checkout (bool, optional): If False, the working tree is left alone and files are read
+            from the object database with a GitObjectReader. Defaults to True.
+        worktree_pool (WorktreePool, optional): If given, the commit is checked out in a leased
+            worktree instead of the repository itself. Defaults to None.
+
+    Attributes:
+        repo_path (str): The path to the checkout; the leased worktree while inside the context.
+        reader (GitObjectReader): The reader of base_commit while inside a checkout-free context.
+    """
+
+    def __init__(
+        self, repo_path, base_commit, verbose=False, checkout=True, worktree_pool=None
+    ):
         self.repo_path = Path(repo_path).resolve().as_posix()
-        self.old_dir = os.getcwd()
+        self.clone_path = self.repo_path
         self.base_commit = base_commit
         self.verbose = verbose
+        self.checkout = checkout
+        self.worktree_pool = worktree_pool
+        self.reader = None
 
     def __enter__(self):
-        os.chdir(self.repo_path)
-        cmd = f"git reset --hard {self.base_commit} && git clean -fdxq"
-        if self.verbose:
-            subprocess.run(cmd, shell=True, check=True)
-        else:
-            subprocess.run(
-                cmd,
-                shell=True,
-                check=True,
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.DEVNULL,
-            )
+        if not self.checkout:
+            # leave the working tree alone and read base_commit from the object database
+            self.reader = GitObjectReader(self.repo_path)
+            return self
+        if self.worktree_pool is not None:
+            # check out into a leased worktree so other instances of this repo can run concurrently
+            self.repo_path = self.worktree_pool.acquire(self.base_commit).as_posix()
+            return self
+        output = None if self.verbose else subprocess.DEVNULL
+        for cmd in (["git", "reset", "--hard", self.base_commit], ["git", "clean", "-fdxq"]):
+            subprocess.run(cmd, cwd=self.repo_path, check=True, stdout=output, stderr=output)
         return self
 
     def get_environment(self):
         raise NotImplementedError()  # TODO: activate conda environment and return the environment file
 
     def get_readme_files(self):
-        files = os.listdir(self.repo_path)
-        files = list(filter(lambda x: os.path.isfile(x), files))
-        files = list(filter(lambda x: x.lower().startswith("readme"), files))
-        return files
+        if self.reader is not None:
+            return self.reader.get_readme_files(self.base_commit)
+        return get_file_manifest(self.repo_path).get_readme_files(self.base_commit)
+
+    def get_path(self, relative_path):
+        """
+        Returns the path of a file of the checkout, relative to repo_path.
+        """
+        return os.path.join(self.repo_path, relative_path)
+
+    def read_files(self, relative_paths):
+        """
+        Reads files of base_commit, from the object database in a checkout-free context and
+        from the checkout otherwise.
+
+        Args:
+            relative_paths (list): The paths of the files, relative to the repository root.
+
+        Returns:
+            dict: The text of each file, keyed by its relative path.
+        """
+        if self.reader is not None:
+            files = dict()
+            for relative_path in relative_paths:
+                content = self.reader.read_text(f"{self.base_commit}:{relative_path}")
+                if content is None:
+                    raise FileNotFoundError(f"{relative_path} not found in {self.base_commit}")
+                files[relative_path] = content
+            return files
+        filenames = [self.get_path(relative_path) for relative_path in relative_paths]
+        return {
+            relative_path: text
+            for relative_path, (text, _) in zip(relative_paths, read_files(filenames))
+        }
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        os.chdir(self.old_dir)
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+        if self.repo_path != self.clone_path:
+            self.worktree_pool.release(self.repo_path)
+            self.repo_path = self.clone_path
 
 
 class AutoContextManager(ContextManager):
     """Automatically clones the repo if it doesn't exist"""
 
-    def __init__(self, instance, root_dir=None, verbose=False, token=None):
+    def __init__(
+        self,
+        instance,
+        root_dir=None,
+        verbose=False,
+        token=None,
+        checkout=True,
+        max_worktrees=0,
+        sparse=False,
+        mirror_dir=None,
+    ):
         if token is None:
             token = os.environ.get("GITHUB_TOKEN", "git")
         self.tempdir = None
@@ -188,16 +196,36 @@ class AutoContextManager(ContextManager):
             root_dir = self.tempdir.name
         self.root_dir = root_dir
         repo_dir = os.path.join(self.root_dir, instance["repo"].replace("/", "__"))
-        if not os.path.exists(repo_dir):
-            repo_url = (
-                f"https://{token}@github.com/swe-bench/"
-                + instance["repo"].replace("/", "__")
-                + ".git"
-            )
-            if verbose:
-                print(f"Cloning {instance['repo']} to {root_dir}")
-            Repo.clone_from(repo_url, repo_dir)
-        super().__init__(repo_dir, instance["base_commit"], verbose=verbose)
+        # other processes may be cloning the same repo into the same root_dir
+        with FileLock(repo_dir + ".lock"):
+            if not os.path.exists(repo_dir):
+                repo_url = (
+                    f"https://{token}@github.com/swe-bench/"
+                    + instance["repo"].replace("/", "__")
+                    + ".git"
+                )
+                if verbose:
+                    print(f"Cloning {instance['repo']} to {root_dir}")
+                mirror = None
+                if mirror_dir is not None:
+                    mirror = MirrorCache(mirror_dir).get(instance["repo"], repo_url)
+                git_clone(
+                    repo_url,
+                    repo_dir,
+                    sparse=sparse,
+                    no_checkout=not checkout,
+                    mirror=mirror,
+                )
+        worktree_pool = None
+        if max_worktrees > 0:
+            worktree_pool = WorktreePool(repo_dir, max_worktrees=max_worktrees)
+        super().__init__(
+            repo_dir,
+            instance["base_commit"],
+            verbose=verbose,
+            checkout=checkout,
+            worktree_pool=worktree_pool,
+        )
         self.instance = instance
 
     def __exit__(self, exc_type, exc_val, exc_tb):
@@ -206,85 +234,344 @@ class AutoContextManager(ContextManager):
         return super().__exit__(exc_type, exc_val, exc_tb)
 
 
-def get_imported_modules(filename):
-    with open(filename) as file:
-        tree = ast.parse(file.read(), filename)
-    return [
-        node
-        for node in ast.iter_child_nodes(tree)
-        if isinstance(node, (ast.Import, ast.ImportFrom))
-    ]
+def resolve_module_to_file(module, level, root_dir):
+    return list(ModuleIndex.from_directory(root_dir).resolve(module, level))
 
 
-def resolve_module_to_file(module, level, root_dir):
-    components = module.split(".")
-    if level > 0:
-        components = components[:-level]
-    for dirpath, dirnames, filenames in os.walk(root_dir):
-        if dirpath.endswith(os.sep.join(components)):
-            return [
-                os.path.join(dirpath, filename)
-                for filename in filenames
-                if filename.endswith(".py")
-            ]
-    return []
-
-
-def ingest_file_directory_contents(target_file, root_dir):
-    imported_files = []
-    files_to_check = [target_file]
-    while files_to_check:
-        current_file = files_to_check.pop()
-        imported_files.append(current_file)
-        imports = get_imported_modules(current_file)
-        for node in imports:
-            if isinstance(node, ast.Import):
-                for alias in node.names:
-                    files = resolve_module_to_file(alias.name, 0, root_dir)
-                    for file in files:
-                        if file not in imported_files and file not in files_to_check:
-                            files_to_check.append(file)
-            elif isinstance(node, ast.ImportFrom):
-                files = resolve_module_to_file(node.module, node.level, root_dir)
-                for file in files:
-                    if file not in imported_files and file not in files_to_check:
-                        files_to_check.append(file)
-    return imported_files
+def ingest_file_directory_contents(target_file, root_dir, commit=None):
+    """
+    Returns `target_file` and the files it imports, directly or indirectly, resolved with
+    `resolve_module_to_file`. If `root_dir` is a checkout of `commit`, its files are listed
+    from the FileManifest and the import graph is kept for later calls on the same snapshot.
+    """
+    manifest = get_file_manifest(root_dir) if commit is not None else None
+    return get_module_index(root_dir, commit, manifest).get_import_closure(target_file)
 
 
 def detect_encoding(filename):
     """
-    Detect the encoding of a file
+    Detect the encoding of a file, or None for a binary file. See `file_ingestion.decode_bytes`.
     """
     with open(filename, "rb") as file:
         rawdata = file.read()
-    return chardet.detect(rawdata)["encoding"]
+    return decode_bytes(rawdata)[1]
+
+
+def list_blobs(repo_dir, commit):
+    """
+    Maps the path of every regular file in a commit to its git blob SHA, from the repository's
+    FileManifest.
+    """
+    return get_file_manifest(repo_dir).list_blobs(commit)
 
 
-def list_files(root_dir, include_tests=False):
+# the paths kept by sparse clones: Python sources anywhere and READMEs at the root, matched
+# case-insensitively like `get_readme_files`
+SPARSE_CHECKOUT_PATTERNS = ["/**/*.py", "/[Rr][Ee][Aa][Dd][Mm][Ee]*"]
+
+
+def is_sparse_path(relative_path):
+    """
+    Returns whether a path is matched by SPARSE_CHECKOUT_PATTERNS.
+    """
+    if relative_path.endswith(".py"):
+        return True
+    return "/" not in relative_path and relative_path.lower().startswith("readme")
+
+
+def git_clone(repo_url, repo_dir, sparse=False, no_checkout=False, mirror=None):
+    """
+    Clones a repository.
+
+    A sparse clone is a partial clone (`--filter=blob:none`) whose checkouts are limited to
+    SPARSE_CHECKOUT_PATTERNS. It downloads commits and trees but no file contents; the blobs of
+    the Python files and READMEs of a commit are fetched when that commit is checked out or
+    read with a GitObjectReader, and other blobs only if something asks for them.
+
+    Args:
+        repo_url (str): The URL or path of the repository. With `sparse`, local paths are
+            cloned through a `file://` URL, since git ignores filters on local clones.
+        repo_dir (str): The directory to clone into.
+        sparse (bool, optional): Whether to make a sparse, partial clone. Defaults to False.
+        no_checkout (bool, optional): Whether to skip checking out the default branch.
+        mirror (Path, optional): A local mirror of the repository, see `MirrorCache`. If given,
+            the clone is made from the mirror with `--shared` and borrows its objects instead
+            of fetching them, and `sparse` only limits what is checked out.
+    """
+    if mirror is not None:
+        subprocess.run(
+            ["git", "clone", "--quiet", "--shared", "--no-checkout", str(mirror), str(repo_dir)],
+            check=True,
+        )
+    elif not sparse:
+        Repo.clone_from(repo_url, repo_dir, no_checkout=no_checkout)
+        return
+    else:
+        if os.path.isdir(repo_url):
+            repo_url = Path(repo_url).resolve().as_uri()
+        subprocess.run(
+            ["git", "clone", "--quiet", "--filter=blob:none", "--no-checkout", repo_url, str(repo_dir)],
+            check=True,
+        )
+    if sparse:
+        subprocess.run(
+            ["git", "sparse-checkout", "set", "--no-cone"] + SPARSE_CHECKOUT_PATTERNS,
+            cwd=repo_dir,
+            check=True,
+        )
+    if not no_checkout:
+        subprocess.run(["git", "checkout", "--quiet"], cwd=repo_dir, check=True)
+
+
+def is_partial_clone(repo_path):
+    output = subprocess.run(
+        ["git", "config", "--get", "remote.origin.promisor"],
+        cwd=repo_path,
+        capture_output=True,
+    ).stdout.decode("utf-8")
+    return output.strip() == "true"
+
+
+def prefetch_blobs(repo_path, commit, blobs):
+    """
+    Fetches the blobs of `commit` that a partial clone is missing and that match
+    SPARSE_CHECKOUT_PATTERNS, in a single request instead of one per file read.
+
+    Args:
+        repo_path (str): The path to the partial clone.
+        commit (str): The commit to fetch blobs of.
+        blobs (dict): Maps the paths of the commit to their blob SHAs, see `list_blobs`.
+
+    Returns:
+        int: The number of blobs fetched.
+    """
+    # --missing=print lists missing objects with a "?" prefix instead of fetching them
+    output = subprocess.run(
+        ["git", "rev-list", "--objects", "--no-walk", "--missing=print", commit],
+        cwd=repo_path,
+        check=True,
+        capture_output=True,
+    ).stdout.decode("utf-8", errors="surrogateescape")
+    missing = {line[1:] for line in output.splitlines() if line.startswith("?")}
+    wanted = sorted(
+        {sha for path, sha in blobs.items() if sha in missing and is_sparse_path(path)}
+    )
+    if wanted:
+        subprocess.run(
+            [
+                "git",
+                "-c",
+                "fetch.negotiationAlgorithm=noop",
+                "fetch",
+                "--quiet",
+                "--no-tags",
+                "--no-write-fetch-head",
+                "--recurse-submodules=no",
+                "--filter=blob:none",
+                "--stdin",
+                "origin",
+            ],
+            cwd=repo_path,
+            input="\n".join(wanted).encode("utf-8"),
+            check=True,
+        )
+    return len(wanted)
+
+
+class GitObjectReader:
+    """
+    Reads the files of any commit straight from the git object database, without a checkout.
+
+    Paths are listed with `git ls-tree -r <commit>` and contents are streamed from a single
+    long-lived `git cat-file --batch` process, so the working tree is never touched and any
+    number of commits can be read side by side. Reads are serialized with a lock, so one
+    reader can be shared between threads. In a partial clone (see `git_clone`), the missing
+    blobs of a commit's Python files and READMEs are fetched in one request when it is listed.
+    Files are listed from the repository's FileManifest.
+
+    Args:
+        repo_path (str): The path to the Git repository.
+    """
+
+    def __init__(self, repo_path):
+        self.repo_path = Path(repo_path).resolve().as_posix()
+        self._proc = None
+        self._lock = threading.Lock()
+        self._blobs = dict()
+        self.partial = is_partial_clone(self.repo_path)
+        self.manifest = get_file_manifest(self.repo_path)
+        self._inode = None
+
+    def _get_proc(self):
+        # a clone evicted by a DiskBudget and cloned again is a new directory at the same path
+        inode = os.stat(self.repo_path).st_ino
+        if self._proc is not None and inode != self._inode:
+            self.close()
+        if self._proc is None or self._proc.poll() is not None:
+            self._inode = inode
+            self._proc = subprocess.Popen(
+                ["git", "cat-file", "--batch"],
+                cwd=self.repo_path,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+            )
+        return self._proc
+
+    def read_bytes(self, obj):
+        """
+        Returns the raw contents of a git object, given as a SHA or as `<commit>:<path>`,
+        or None if the object does not exist.
+        """
+        with self._lock:
+            proc = self._get_proc()
+            proc.stdin.write(obj.encode("utf-8") + b"\n")
+            proc.stdin.flush()
+            header = proc.stdout.readline().split()
+            if len(header) != 3:
+                return None  # "<obj> missing" or "<obj> ambiguous"
+            data = proc.stdout.read(int(header[2]))
+            proc.stdout.read(1)  # trailing newline
+        return data
+
+    def read_text(self, obj, encoding=None):
+        """
+        Returns the contents of a git object decoded by `file_ingestion.decode_bytes`, or None
+        if the object does not exist.
+        """
+        data = self.read_bytes(obj)
+        return None if data is None else decode_bytes(data, encoding)[0]
+
+    def list_blobs(self, commit):
+        """
+        Maps the path of every regular file in a commit to its blob SHA.
+        """
+        if commit not in self._blobs:
+            blobs = self.manifest.list_blobs(commit)
+            if self.partial:
+                prefetch_blobs(self.repo_path, commit, blobs)
+            self._blobs = {commit: blobs}
+        return self._blobs[commit]
+
+    def list_files(self, commit, include_tests=False):
+        """
+        Same as `list_files` on a checkout of `commit`, but read from `git ls-tree`.
+        """
+        self.list_blobs(commit)  # fetches the blobs of a partial clone
+        return self.manifest.list_files(commit, include_tests=include_tests)
+
+    def get_readme_files(self, commit):
+        self.list_blobs(commit)
+        return self.manifest.get_readme_files(commit)
+
+    def close(self):
+        if self._proc is not None:
+            self._proc.stdin.close()
+            self._proc.wait()
+            self._proc = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+_GIT_OBJECT_READERS = dict()
+_FILE_MANIFESTS = dict()
+
+
+def _get_cached(cache, repo_path, factory):
+    """
+    Returns the object `cache` holds for a repository in this process, made with `factory` the
+    first time. Entries are keyed by the inode of the repository's `.git` too, so a repository
+    that was deleted, e.g. evicted by a DiskBudget, and cloned again at the same path gets a new
+    object, and the one still using the deleted files is closed.
+    """
+    git_path = Path(repo_path, ".git")
+    stat = os.stat(git_path if git_path.exists() else repo_path)
+    key = (Path(repo_path).resolve().as_posix(), os.getpid(), stat.st_dev, stat.st_ino)
+    if key not in cache:
+        for stale_key in [other for other in cache if other[:2] == key[:2]]:
+            cache.pop(stale_key).close()
+        cache[key] = factory()
+    return cache[key]
+
+
+def get_file_manifest(repo_path):
+    """
+    Returns the FileManifest of a repository that is reused across calls in this process.
+    """
+    return _get_cached(
+        _FILE_MANIFESTS,
+        repo_path,
+        lambda: FileManifest(repo_path, is_test, sizes=not is_partial_clone(repo_path)),
+    )
+
+
+def get_git_object_reader(repo_path):
+    """
+    Returns a GitObjectReader for the repository that is reused across calls in this process.
+    """
+    return _get_cached(_GIT_OBJECT_READERS, repo_path, lambda: GitObjectReader(repo_path))
+
+
+def list_files(root_dir, include_tests=False, commit=None):
+    """
+    Lists the Python files under `root_dir`, relative to it. If `commit` is given, `root_dir`
+    is a repository and the files of `commit` are listed from its FileManifest.
+    """
+    if commit is not None:
+        return get_file_manifest(root_dir).list_files(commit, include_tests=include_tests)
     files = []
     for filename in Path(root_dir).rglob("*.py"):
-        if not include_tests and is_test(filename.as_posix()):
+        relative_path = filename.relative_to(root_dir).as_posix()
+        if not include_tests and is_test(relative_path):
             continue
-        files.append(filename.relative_to(root_dir).as_posix())
+        files.append(relative_path)
     return files
 
 
-def ingest_directory_contents(root_dir, include_tests=False):
-    files_content = {}
-    for relative_path in list_files(root_dir, include_tests=include_tests):
-        filename = os.path.join(root_dir, relative_path)
-        encoding = detect_encoding(filename)
-        if encoding is None:
-            content = "[BINARY DATA FILE]"
-        else:
-            try:
-                with open(filename, encoding=encoding) as file:
-                    content = file.read()
-            except (UnicodeDecodeError, LookupError):
-                content = "[BINARY DATA FILE]"
-        files_content[relative_path] = content
-    return files_content
+def ingest_directory_contents(root_dir, include_tests=False, reader=None, commit=None):
+    """
+    Reads every Python file of the repository. If `reader` is given, the files of `commit`
+    are read from the git object database instead of the working tree. Given a `commit`, the
+    files are listed from the repository's FileManifest, which also keeps the encoding
+    found for each blob, so a blob that is not UTF-8 only goes through chardet once.
+    """
+    if commit is None:
+        relative_paths = list_files(root_dir, include_tests=include_tests)
+        filenames = [os.path.join(root_dir, path) for path in relative_paths]
+        return {
+            relative_path: text
+            for relative_path, (text, _) in zip(relative_paths, read_files(filenames))
+        }
+    if reader is not None:
+        manifest = reader.manifest
+        blobs = reader.list_blobs(commit)
+    else:
+        manifest = get_file_manifest(root_dir)
+        blobs = manifest.list_blobs(commit)
+    relative_paths = manifest.list_files(commit, include_tests=include_tests)
+    blob_shas = [blobs[path] for path in relative_paths]
+    known = manifest.get_encodings(blob_shas)
+    if reader is not None:
+        decoded = [
+            decode_bytes(reader.read_bytes(blob_sha), known.get(blob_sha))
+            for blob_sha in blob_shas
+        ]
+    else:
+        decoded = read_files(
+            [os.path.join(root_dir, path) for path in relative_paths],
+            encodings=[known.get(blob_sha) for blob_sha in blob_shas],
+        )
+    manifest.put_encodings(
+        {
+            blob_sha: encoding
+            for blob_sha, (_, encoding) in zip(blob_shas, decoded)
+            if blob_sha not in known
+        }
+    )
+    return {relative_path: text for relative_path, (text, _) in zip(relative_paths, decoded)}
 
 
 def string_to_bool(v):
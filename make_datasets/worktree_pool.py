@@ -0,0 +1,192 @@
+"""
+A pool of `git worktree` checkouts so several commits of one repository can be on disk at once.
+
+All checkouts used to go through a single clone directory per repository, which meant two
+instances of the same repository could never be processed at the same time. The pool keeps
+up to `max_worktrees` worktrees next to the clone, leases one out per commit, reuses a worktree
+that is already at the requested commit and otherwise recycles the least recently used one.
+Leases are recorded in a JSON file guarded by a FileLock, so the pool can be shared by
+several processes.
+"""
+
+import os
+import json
+import time
+import shutil
+import logging
+import threading
+import subprocess
+from contextlib import contextmanager
+from filelock import FileLock
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class WorktreePool:
+    """
+    Leases out worktrees of a repository, one commit at a time.
+
+    Args:
+        repo_path (str): The path to the main clone of the repository.
+        pool_dir (str, optional): Where to create worktrees. Defaults to `<repo_path>.worktrees`.
+        max_worktrees (int, optional): The maximum number of worktrees. Defaults to 4.
+        poll_interval (float, optional): Seconds to wait before retrying when every worktree is leased.
+
+    Methods:
+        acquire(commit): Leases a worktree checked out at `commit` and returns its path.
+        release(path): Returns a leased worktree to the pool.
+        lease(commit): Context manager around acquire and release.
+    """
+
+    STATE_FILE = "pool.json"
+
+    def __init__(self, repo_path, pool_dir=None, max_worktrees=4, poll_interval=1.0):
+        self.repo_path = Path(repo_path).resolve()
+        if pool_dir is None:
+            pool_dir = self.repo_path.with_name(self.repo_path.name + ".worktrees")
+        self.pool_dir = Path(pool_dir).resolve()
+        self.max_worktrees = max_worktrees
+        self.poll_interval = poll_interval
+        self.pool_dir.mkdir(parents=True, exist_ok=True)
+        self.lock = FileLock(Path(self.pool_dir, "pool.lock").as_posix())
+
+    @property
+    def state_path(self):
+        return Path(self.pool_dir, self.STATE_FILE)
+
+    def _load_state(self):
+        if not self.state_path.exists():
+            return dict()
+        with open(self.state_path) as f:
+            return json.load(f)
+
+    def _save_state(self, state):
+        tmp_path = self.state_path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.state_path)
+
+    def _git(self, *args, cwd=None):
+        subprocess.run(
+            ["git", *args],
+            cwd=(cwd or self.repo_path).as_posix(),
+            check=True,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+        )
+
+    def _lease_owner(self):
+        return f"{os.getpid()}:{threading.get_ident()}"
+
+    def _claim(self, commit):
+        """
+        Picks a worktree for `commit` while holding the pool lock.
+
+        Returns:
+            tuple: (name, needs_checkout), or (None, None) if every worktree is leased.
+        """
+        state = self._load_state()
+        for entry in state.values():
+            owner = entry["leased_by"]
+            if owner is not None and not _pid_alive(int(owner.split(":")[0])):
+                entry["leased_by"] = None  # the process holding the lease died
+        free = {
+            name: entry
+            for name, entry in state.items()
+            if entry["leased_by"] is None and Path(self.pool_dir, name).exists()
+        }
+        needs_checkout = True
+        name = next((n for n, e in free.items() if e["commit"] == commit), None)
+        if name is not None:
+            needs_checkout = False
+        elif len(state) < self.max_worktrees or any(
+            not Path(self.pool_dir, n).exists() for n in state
+        ):
+            name = next(
+                f"wt{i}"
+                for i in range(len(state) + 1)
+                if f"wt{i}" not in state or not Path(self.pool_dir, f"wt{i}").exists()
+            )
+            path = Path(self.pool_dir, name)
+            shutil.rmtree(path, ignore_errors=True)
+            self._git("worktree", "prune")
+            # adding a worktree writes to the main repository, so do it under the lock
+            self._git("worktree", "add", "--force", "--detach", path.as_posix(), commit)
+            needs_checkout = False
+        elif free:
+            name = min(free, key=lambda n: free[n]["last_used"])
+        else:
+            self._save_state(state)
+            return None, None
+        state[name] = {
+            "commit": commit if not needs_checkout else None,
+            "leased_by": self._lease_owner(),
+            "last_used": time.time(),
+        }
+        self._save_state(state)
+        return name, needs_checkout
+
+    def acquire(self, commit):
+        """
+        Leases a worktree checked out at `commit`, waiting if all worktrees are leased.
+
+        Args:
+            commit (str): The commit hash to check out.
+
+        Returns:
+            Path: The path to the worktree.
+        """
+        while True:
+            with self.lock:
+                name, needs_checkout = self._claim(commit)
+            if name is not None:
+                break
+            time.sleep(self.poll_interval)
+        path = Path(self.pool_dir, name)
+        if needs_checkout:
+            try:
+                self._git("checkout", "--force", "--detach", commit, cwd=path)
+                self._git("clean", "-fdxq", cwd=path)
+            except Exception:
+                self.release(path)
+                raise
+            with self.lock:
+                state = self._load_state()
+                state[name]["commit"] = commit
+                self._save_state(state)
+        logger.debug(f"Leased {path} at {commit}")
+        return path
+
+    def release(self, path):
+        """
+        Returns a leased worktree to the pool.
+
+        Args:
+            path (Path): The path returned by `acquire`.
+        """
+        with self.lock:
+            state = self._load_state()
+            name = Path(path).name
+            if name in state:
+                state[name]["leased_by"] = None
+                state[name]["last_used"] = time.time()
+                self._save_state(state)
+
+    @contextmanager
+    def lease(self, commit):
+        path = self.acquire(commit)
+        try:
+            yield path
+        finally:
+            self.release(path)
@@ -17,16 +17,15 @@ from datetime import datetime
 from tqdm.auto import tqdm
 from make_datasets.utils import ContextManager, string_to_bool, extract_diff, extract_minimal_patch
 from make_datasets.bm25_retrieval import (
-    make_index,
     clone_repo,
-    search,
+    search_ephemeral,
     DOCUMENT_ENCODING_FUNCTIONS,
+    RETRIEVAL_BACKENDS,
 )
 from make_datasets.create_instance import (
     PROMPT_FUNCTIONS,
     TOKENIZER_FUNCS,
     make_code_text,
-    ingest_files,
 )
 from run_api import call_chat, call_anthropic
 import logging
@@ -78,6 +77,7 @@ def make_instance(
     prompt_style,
     max_context_len,
     include_readmes,
+    backend="pyserini",
 ):
     """
     Creates an instance for a given query and repository.
@@ -97,29 +97,25 @@ def make_instance(
         prompt_style (str): The style of prompt to use.
         max_context_len (int): The maximum length of the context.
         include_readmes (bool): Whether to include README files in the instance.
+        backend (str, optional): The retrieval backend, one of RETRIEVAL_BACKENDS. The index is
+            built in memory or on tmpfs and discarded after the search. Defaults to "pyserini".
 
     Returns:
         dict: The instance.
     """
-    thread_id = 0
     instance = {"instance_id": instance_id, "problem_statement": query}
     logger.info(f"Cloning repo {owner}/{repo}")
-    repo_dir = clone_repo(f"{owner}/{repo}", root_dir, token, False, thread_id)
+    repo_dir = clone_repo(f"{owner}/{repo}", root_dir, token)
     if commit is None:
         commit = subprocess.check_output(
             ["git", "rev-parse", "HEAD"], cwd=repo_dir
         ).decode("utf-8").strip()
     logger.info(f"Buidling BM25 retrieval index for {owner}/{repo}@{commit}")
-    index_dir = make_index(
-        repo_dir,
-        root_dir,
-        commit,
-        document_encoding_func,
-        python,
-        thread_id,
-        instance_id,
+    (results,) = search_ephemeral(
+        [instance], repo_dir, commit, document_encoding_func, python=python, backend=backend
     )
-    results = search(instance, index_dir)
+    if results is None:
+        raise RuntimeError(f"Failed to retrieve documents for {instance_id}")
     hits = results["hits"]
     logger.info(f"Retrieved {len(hits)} documents")
     with ContextManager(repo_dir, commit) as cm:
@@ -127,9 +123,10 @@ def make_instance(
             readmes = get_readme_files(cm.repo_path)
         else:
             readmes = list()
-        instance["readmes"] = ingest_files(readmes)
+        instance["readmes"] = cm.read_files(readmes)
+        file_contents = cm.read_files([x["docid"] for x in hits])
         for hit in hits:
-            hit["file_contents"] = open(hit["docid"]).read()
+            hit["file_contents"] = file_contents[hit["docid"]]
         instance["file_contents"] = dict()
         base_text_inputs = PROMPT_FUNCTIONS[prompt_style](instance)
         base_text_input_length = len(tokenizer_func(base_text_inputs, tokenizer))
@@ -175,6 +172,7 @@ def main(
     output_dir,
     root_dir,
     include_readmes,
+    backend,
 ):
     if base_commit is not None and len(instance_id) != len(base_commit):
         raise ValueError(
@@ -186,6 +184,7 @@ def main(
     if gh_token is not None:
         logger.warning(f'Using GitHub token: {"*" * 8}{gh_token[-4:]}')
     gh = GhApi(token=gh_token)
+    clone_token = gh_token if gh_token is not None else "git"
     tokenizer, tokenizer_func = TOKENIZER_FUNCS["cl100k"]
     document_encoding_func = DOCUMENT_ENCODING_FUNCTIONS[document_encoding_func]
     python = subprocess.check_output(["which", "python"]).decode("utf-8").strip()
@@ -203,7 +202,7 @@ def main(
             problem_statement,
             commit,
             root_dir,
-            gh_token,
+            clone_token,
             document_encoding_func,
             python,
             inst_id,
@@ -212,6 +211,7 @@ def main(
             prompt_style,
             max_context_length,
             include_readmes,
+            backend=backend,
         )
         logger.info(f"Calling model {model_name}")
         start = time.time()
@@ -273,5 +273,12 @@ if __name__ == "__main__":
     parser.add_argument("--output_dir", type=str, default="./live_outputs")
     parser.add_argument("--root_dir", type=str, default="./run_live_data")
     parser.add_argument("--include_readmes", type=string_to_bool, default=False)
+    parser.add_argument(
+        "--backend",
+        type=str,
+        choices=RETRIEVAL_BACKENDS,
+        default="pyserini",
+        help="Retrieval backend. Indexes are kept in memory (numpy) or on tmpfs (pyserini) and never written to root_dir.",
+    )
     args = parser.parse_args()
     main(**vars(args))
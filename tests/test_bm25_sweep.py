@@ -0,0 +1,41 @@
+import json
+from pathlib import Path
+
+from make_datasets.bm25_engine import BM25Index
+from make_datasets.bm25_sweep import run_sweep
+
+
+def make_instance(instance_id, problem_statement, edited_file):
+    return {
+        "instance_id": instance_id,
+        "problem_statement": problem_statement,
+        "patch": f"--- a/{edited_file}\n+++ b/{edited_file}\n@@ -1,1 +1,1 @@\n-x\n+y\n",
+    }
+
+
+def test_sweep_skips_pyserini_indexes(tmp_path):
+    numpy_index = Path(tmp_path, "index__owner__repo__abc", "index")
+    BM25Index.from_documents(
+        {
+            "parser.py": "parser.py\ndef parse_header(line): return line.split(':')",
+            "README.md": "README.md\nHow to install the package",
+        }
+    ).save(numpy_index)
+    # a Lucene index directory, as written by `pyserini.index`
+    pyserini_index = Path(tmp_path, "index__owner__repo__def", "index")
+    pyserini_index.mkdir(parents=True)
+    Path(pyserini_index, "segments_1").write_bytes(b"")
+    instances_by_index = {
+        numpy_index.as_posix(): [make_instance("a", "parse_header fails", "parser.py")],
+        pyserini_index.as_posix(): [make_instance("b", "install fails", "README.md")],
+    }
+    sweep_dir = Path(tmp_path, "sweep")
+    summary = run_sweep(instances_by_index, sweep_dir, [0.9, 1.2], [0.4], [1, 2], [64])
+    assert len(summary) == 4
+    for row in summary:
+        assert row["num_instances"] == 1
+        assert row["avg_recall"] == 1.0
+        with open(Path(sweep_dir, f"{row['setting']}.retrieval.jsonl")) as f:
+            results = [json.loads(line) for line in f]
+        assert [result["instance_id"] for result in results] == ["a"]
+        assert results[0]["hits"][0]["docid"] == "parser.py"
@@ -0,0 +1,33 @@
+import json
+
+from make_datasets.bm25_retrieval import file_name_and_documentation
+from make_datasets.chunking import MAX_CHUNK_LINES, ChunkEncoder, split_into_chunks
+
+
+def make_class_source(num_methods, method_lines):
+    lines = ["class Big:", '    """A class too long to keep whole."""', ""]
+    for i in range(num_methods):
+        lines.append(f"    def method_{i}(self):")
+        lines.append(f'        """Docstring of method_{i}."""')
+        lines.extend(f"        value = {j}" for j in range(method_lines))
+        lines.append("")
+    return "\n".join(lines) + "\n"
+
+
+def test_methods_of_oversized_class_are_encoded(tmp_path):
+    source = make_class_source(10, 25)
+    assert len(source.split("\n")) > MAX_CHUNK_LINES
+    filename = tmp_path / "big.py"
+    filename.write_text(source)
+    encoder = ChunkEncoder(file_name_and_documentation)
+    chunks = json.loads(encoder(str(filename), "big.py"))
+    assert len(chunks) > 10
+    for i in range(10):
+        # a method chunk that failed to parse would hold the raw source instead
+        assert any(f"method_{i}\nDocstring of method_{i}." in text for _, _, text in chunks)
+    assert not any("value = 0" in text for _, _, text in chunks)
+
+
+def test_spans_follow_ast_line_ends():
+    source = "x = 1\r\ndef f():\r    return 1\ry = 2  # a\x0cb\u2028c\ndef g():\n    pass\n"
+    assert split_into_chunks(source) == [(1, 1), (2, 3), (4, 4), (5, 6)]
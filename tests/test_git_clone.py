@@ -0,0 +1,46 @@
+import subprocess
+from pathlib import Path
+
+from make_datasets.utils import SPARSE_CHECKOUT_PATTERNS, git_clone, is_partial_clone
+
+
+def git(*args, cwd):
+    return subprocess.run(
+        ["git", *args], cwd=cwd, check=True, capture_output=True, text=True
+    ).stdout
+
+
+def make_repo(repo_dir):
+    Path(repo_dir, "pkg").mkdir(parents=True)
+    Path(repo_dir, "pkg", "module.py").write_text("def f():\n    return 1\n")
+    Path(repo_dir, "README.md").write_text("# Example\n")
+    Path(repo_dir, "data.csv").write_text("a,b\n1,2\n")
+    git("init", "--quiet", cwd=repo_dir)
+    # let clones of this repository ask for partial clones
+    git("config", "uploadpack.allowFilter", "true", cwd=repo_dir)
+    git("add", ".", cwd=repo_dir)
+    git("-c", "user.name=a", "-c", "user.email=a@b", "commit", "--quiet", "-m", "init", cwd=repo_dir)
+
+
+def get_missing_objects(repo_dir):
+    output = git("rev-list", "--objects", "--all", "--missing=print", cwd=repo_dir)
+    return {line[1:] for line in output.splitlines() if line.startswith("?")}
+
+
+def test_sparse_clone(tmp_path):
+    source_dir = Path(tmp_path, "source")
+    make_repo(source_dir)
+    blobs = {
+        path: git("rev-parse", f"HEAD:{path}", cwd=source_dir).strip()
+        for path in ["pkg/module.py", "README.md", "data.csv"]
+    }
+    clone_dir = Path(tmp_path, "clone")
+    git_clone(source_dir.as_uri(), clone_dir, sparse=True)
+    assert is_partial_clone(clone_dir)
+    patterns = git("sparse-checkout", "list", cwd=clone_dir).split()
+    assert patterns == SPARSE_CHECKOUT_PATTERNS
+    # the checkout fetched the blobs it wrote and nothing else
+    assert Path(clone_dir, "pkg", "module.py").read_text() == "def f():\n    return 1\n"
+    assert Path(clone_dir, "README.md").exists()
+    assert not Path(clone_dir, "data.csv").exists()
+    assert get_missing_objects(clone_dir) == {blobs["data.csv"]}